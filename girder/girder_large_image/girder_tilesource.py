@@ -1,3 +1,6 @@
+import cachetools
+import threading
+
 from girder.constants import AccessType
 from girder.exceptions import ValidationException, FilePathException
 from girder.models.file import File
@@ -14,6 +17,10 @@ KnownExtensions = set()
 KnownMimeTypesWithAdjacentFiles = set()
 KnownExtensionsWithAdjacentFiles = set()
 
+# Remember which source opened each large image file, keyed by file id.
+_sourceNameMemo = cachetools.LRUCache(maxsize=1000)
+_sourceNameMemoLock = threading.Lock()
+
 
 class GirderTileSource(tilesource.FileTileSource):
     girderSource = True
@@ -118,20 +125,41 @@ def loadGirderTileSources():
                 if key is not None})
 
 
-def getGirderTileSourceName(item, file=None, *args, **kwargs):
+def _readSniffHeader(file):
     """
-    Get a Girder tilesource name using the known sources.  If tile sources have
-    not yet been loaded, load them.
+    Read the start of a Girder file so that sources can cheaply check its
+    format.
+
+    :param file: a Girder file document.
+    :returns: the first bytes of the file, or None if they cannot be read.
+    """
+    try:
+        with File().open(file) as handle:
+            return handle.read(tilesource.SniffHeaderSize)
+    except Exception:
+        return None
+
+
+def _getGirderSourceNames(item, file=None):
+    """
+    Get the names of the Girder tile sources that might read an item, in the
+    order they should be tried.  If tile sources have not yet been loaded,
+    load them.
 
     :param item: a Girder item.
     :param file: if specified, the Girder file object to use as the large image
-        file; used here only to check extensions.
-    :returns: The name of a tilesource that can read the Girder item.
+        file.
+    :returns: a list of source names and a key to memoize the name of the
+        source that reads the item.
     """
     if not len(AvailableGirderTileSources):
         loadGirderTileSources()
     if not file:
         file = File().load(item['largeImage']['fileId'], force=True)
+    memoKey = str(file['_id'])
+    with _sourceNameMemoLock:
+        preferred = _sourceNameMemo.get(memoKey)
+    header = _readSniffHeader(file)
     extensions = [entry.lower().split()[0] for entry in file['exts']]
     sourceList = []
     for sourceName in AvailableGirderTileSources:
@@ -144,9 +172,27 @@ def getGirderTileSourceName(item, file=None, *args, **kwargs):
                 priority = min(priority, sourceExtensions[ext])
         if priority >= SourcePriority.MANUAL:
             continue
-        sourceList.append((priority, sourceName))
-    for _priority, sourceName in sorted(sourceList):
+        if header is not None and not AvailableGirderTileSources[sourceName].sniff(header):
+            continue
+        sourceList.append((sourceName != preferred, priority, sourceName))
+    return [entry[-1] for entry in sorted(sourceList)], memoKey
+
+
+def getGirderTileSourceName(item, file=None, *args, **kwargs):
+    """
+    Get a Girder tilesource name using the known sources.  If tile sources have
+    not yet been loaded, load them.
+
+    :param item: a Girder item.
+    :param file: if specified, the Girder file object to use as the large image
+        file; used here only to check extensions.
+    :returns: The name of a tilesource that can read the Girder item.
+    """
+    sourceNames, memoKey = _getGirderSourceNames(item, file)
+    for sourceName in sourceNames:
         if AvailableGirderTileSources[sourceName].canRead(item):
+            with _sourceNameMemoLock:
+                _sourceNameMemo[memoKey] = sourceName
             return sourceName
 
 
@@ -161,6 +207,10 @@ def getGirderTileSource(item, file=None, *args, **kwargs):
     """
     if not isinstance(item, dict):
         item = Item().load(item, user=kwargs.get('user', None), level=AccessType.READ)
-    sourceName = getGirderTileSourceName(item, file, *args, **kwargs)
-    if sourceName:
-        return AvailableGirderTileSources[sourceName](item, *args, **kwargs)
+    sourceNames, memoKey = _getGirderSourceNames(item, file)
+    for sourceName in sourceNames:
+        source = AvailableGirderTileSources[sourceName].openIfReadable(item, *args, **kwargs)
+        if source is not None:
+            with _sourceNameMemoLock:
+                _sourceNameMemo[memoKey] = sourceName
+            return source
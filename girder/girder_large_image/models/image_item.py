@@ -178,6 +178,9 @@ class ImageItem(Item):
         imageParams = {}
         if 'frame' in kwargs:
             imageParams['frame'] = int(kwargs['frame'])
+        if kwargs.get('style'):
+            tileData = tileSource.getCompositeTile(x, y, z, kwargs['style'])
+            return tileData, tileSource.getTileMimeType()
         tileData = tileSource.getTile(x, y, z, mayRedirect=mayRedirect, **imageParams)
         tileMimeType = tileSource.getTileMimeType()
         return tileData, tileMimeType
@@ -361,6 +364,37 @@ class ImageItem(Item):
         tileSource = self._loadTileSource(item, **kwargs)
         return tileSource.getPixel(**kwargs)
 
+    def getStatistics(self, item, **kwargs):
+        """
+        Get per-channel statistics and histograms of a large image.  The
+        results are computed once and stored on the item.
+
+        :param item: the item with the tile source.
+        :param **kwargs: optional arguments.  Some options are level, sample,
+            bins, frame, and threads.  This is also passed to the tile source.
+        :returns: a dictionary of statistics.  See the tile source's
+            getStatistics method.
+        """
+        statsArgs = {k: kwargs[k] for k in (
+            'level', 'sample', 'bins', 'frame') if kwargs.get(k) is not None}
+        key = json.dumps(statsArgs, sort_keys=True, separators=(',', ':'))
+        # Mongo keys can't contain periods, so store a list of keyed entries
+        stored = item.get('largeImage', {}).get('statistics', [])
+        for entry in stored:
+            if entry.get('key') == key:
+                return entry['statistics']
+        tileSource = self._loadTileSource(item, **kwargs)
+        statistics = tileSource.getStatistics(
+            threads=kwargs.get('threads'), **statsArgs)
+        item['largeImage']['statistics'] = [
+            entry for entry in stored if entry.get('key') != key] + [{
+                'key': key,
+                'statistics': statistics,
+            }]
+        self.update({'_id': item['_id']}, {'$set': {
+            'largeImage.statistics': item['largeImage']['statistics']}})
+        return statistics
+
     def tileSource(self, item, **kwargs):
         """
         Get a tile source for an item.
@@ -17,6 +17,7 @@
 #############################################################################
 
 import cherrypy
+import json
 import math
 import os
 import re
@@ -42,6 +43,7 @@ MimeTypeExtensions = {
     'image/jpeg': 'jpg',
     'image/png': 'png',
     'image/tiff': 'tiff',
+    'image/webp': 'webp',
 }
 ImageMimeTypes = list(MimeTypeExtensions)
 
@@ -86,6 +88,8 @@ class TilesItemResource(ItemResource):
                            self.getTilesRegion)
         apiRoot.item.route('GET', (':itemId', 'tiles', 'pixel'),
                            self.getTilesPixel)
+        apiRoot.item.route('GET', (':itemId', 'tiles', 'statistics'),
+                           self.getTilesStatistics)
         apiRoot.item.route('GET', (':itemId', 'tiles', 'zxy', ':z', ':x', ':y'),
                            self.getTile)
         apiRoot.item.route('GET', (':itemId', 'tiles', 'fzxy', ':frame', ':z', ':x', ':y'),
@@ -347,6 +351,12 @@ class TilesItemResource(ItemResource):
                'must match the image encoding but disregards quality, and '
                '"any" will redirect to any image if possible.', required=False,
                enum=['false', 'exact', 'encoding', 'any'], default='false')
+        .param('style', 'A JSON object to blend several frames into one tile.  '
+               'This has "bands", a list of objects with "frame", and '
+               'optionally "band", "palette" (a color such as "#ff0000"), '
+               '"min", and "max", and optionally "composite", either '
+               '"lighten" or "add".  When this is set, redirect is ignored.',
+               required=False)
         .produces(ImageMimeTypes)
         .errorResponse('ID was invalid.')
         .errorResponse('Read access was denied for the item.', 403)
@@ -370,6 +380,12 @@ class TilesItemResource(ItemResource):
         redirect = params.get('redirect', False)
         if redirect not in ('any', 'exact', 'encoding'):
             redirect = False
+        if params.get('style'):
+            try:
+                params['style'] = json.loads(params['style'])
+            except ValueError:
+                raise RestException('The style parameter must be a JSON object.', code=400)
+            redirect = False
         return self._getTile(item, z, x, y, params, mayRedirect=redirect)
     getTile.accessLevel = 'public'
     getTile.cookieAuth = True
@@ -530,7 +546,7 @@ class TilesItemResource(ItemResource):
                'This is ignored on non-multiframe images.', required=False,
                dataType='int')
         .param('encoding', 'Thumbnail output encoding', required=False,
-               enum=['JPEG', 'PNG', 'TIFF'], default='JPEG')
+               enum=['JPEG', 'PNG', 'TIFF', 'WEBP'], default='JPEG')
         .param('contentDisposition', 'Specify the Content-Disposition response '
                'header disposition-type value.', required=False,
                enum=['inline', 'attachment'])
@@ -626,7 +642,7 @@ class TilesItemResource(ItemResource):
                'This is ignored on non-multiframe images.', required=False,
                dataType='int')
         .param('encoding', 'Output image encoding', required=False,
-               enum=['JPEG', 'PNG', 'TIFF'], default='JPEG')
+               enum=['JPEG', 'PNG', 'TIFF', 'WEBP'], default='JPEG')
         .param('jpegQuality', 'Quality used for generating JPEG images',
                required=False, dataType='int', default=95)
         .param('jpegSubsampling', 'Chroma subsampling used for generating '
@@ -721,6 +737,41 @@ class TilesItemResource(ItemResource):
             raise RestException('Value Error: %s' % e.args[0])
         return pixel
 
+    @describeRoute(
+        Description('Get per-channel statistics and histograms of a large '
+                    'image item.')
+        .notes('The statistics are computed once for each set of parameters '
+               'and stored on the item.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('level', 'The tile level to use.  By default, a low resolution '
+               'level is used, or the maximum resolution if sample is set.',
+               required=False, dataType='int')
+        .param('sample', 'If set, use this many randomly chosen tiles.',
+               required=False, dataType='int')
+        .param('bins', 'The number of histogram bins.', required=False,
+               dataType='int', default=256)
+        .param('frame', 'For multiframe images, the 0-based frame number.  '
+               'This is ignored on non-multiframe images.', required=False,
+               dataType='int')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the item.', 403)
+    )
+    @access.public(cookie=True)
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.READ)
+    def getTilesStatistics(self, item, params):
+        params = self._parseParams(params, False, [
+            ('level', int),
+            ('sample', int),
+            ('bins', int),
+            ('frame', int),
+        ])
+        try:
+            return self.imageItemModel.getStatistics(item, **params)
+        except TileGeneralException as e:
+            raise RestException(e.args[0])
+        except ValueError as e:
+            raise RestException('Value Error: %s' % e.args[0])
+
     @describeRoute(
         Description('Get a list of additional images associated with a large image.')
         .param('itemId', 'The ID of the item.', paramType='path')
@@ -746,7 +797,7 @@ class TilesItemResource(ItemResource):
         .param('height', 'The maximum height of the image in pixels.',
                required=False, dataType='int')
         .param('encoding', 'Image output encoding', required=False,
-               enum=['JPEG', 'PNG', 'TIFF'], default='JPEG')
+               enum=['JPEG', 'PNG', 'TIFF', 'WEBP'], default='JPEG')
         .param('contentDisposition', 'Specify the Content-Disposition response '
                'header disposition-type value.', required=False,
                enum=['inline', 'attachment'])
@@ -810,6 +810,36 @@ def testPixel(server, admin, fsAssetstore):
     assert resp.json == {}
 
 
+@pytest.mark.usefixtures('unbindLargeImage')
+@pytest.mark.plugin('large_image')
+def testStatistics(server, admin, fsAssetstore):
+    file = utilities.uploadExternalFile(
+        'data/sample_image.ptif.sha512', admin, fsAssetstore)
+    itemId = str(file['itemId'])
+
+    resp = server.request(path='/item/%s/tiles/statistics' % itemId,
+                          user=admin, params={'bins': 'invalid'})
+    assert utilities.respStatus(resp) == 400
+    assert 'incorrect type' in resp.json['message']
+
+    resp = server.request(path='/item/%s/tiles/statistics' % itemId,
+                          user=admin, params={'bins': 16})
+    assert utilities.respStatus(resp) == 200
+    stats = resp.json
+    assert [entry['channel'] for entry in stats['channels']] == ['r', 'g', 'b']
+    assert len(stats['channels'][0]['histogram']) == 16
+    assert sum(stats['channels'][0]['histogram']) == stats['pixels']
+    # The result is stored on the item
+    item = Item().load(itemId, force=True)
+    assert item['largeImage']['statistics'][0]['statistics'] == stats
+    with mock.patch('large_image.tilesource.TileSource.getStatistics') as getStatistics:
+        resp = server.request(path='/item/%s/tiles/statistics' % itemId,
+                              user=admin, params={'bins': 16})
+        assert utilities.respStatus(resp) == 200
+        assert resp.json == stats
+        assert not getStatistics.called
+
+
 @pytest.mark.usefixtures('unbindLargeImage')
 @pytest.mark.plugin('large_image')
 def testGetTileSource(server, admin, fsAssetstore):
@@ -1104,3 +1134,33 @@ def testTilesWithFrameNumbers(server, admin, fsAssetstore):
                           user=admin, isJson=False)
     assert utilities.respStatus(resp) == 200
     assert utilities.getBody(resp, text=False) == image1
+
+
+@pytest.mark.usefixtures('unbindLargeImage')
+@pytest.mark.plugin('large_image')
+def testTilesWithCompositeStyle(server, admin, fsAssetstore):
+    import json
+
+    file = utilities.uploadExternalFile(
+        'data/sample.ome.tif.sha512', admin, fsAssetstore)
+    itemId = str(file['itemId'])
+    style = {'bands': [
+        {'frame': 0, 'palette': '#ff0000', 'max': 4000},
+        {'frame': 1, 'palette': '#00ff00'},
+        {'frame': 2, 'palette': '#0000ff', 'min': 100}]}
+    resp = server.request(path='/item/%s/tiles/zxy/0/0/0' % itemId,
+                          user=admin, isJson=False,
+                          params={'style': json.dumps(style), 'encoding': 'PNG'})
+    assert utilities.respStatus(resp) == 200
+    image = utilities.getBody(resp, text=False)
+    assert image[:len(utilities.PNGHeader)] == utilities.PNGHeader
+    resp = server.request(path='/item/%s/tiles/zxy/0/0/0' % itemId,
+                          user=admin, isJson=False, params={'style': json.dumps(style)})
+    assert utilities.respStatus(resp) == 200
+    assert utilities.getBody(resp, text=False) != image
+    resp = server.request(path='/item/%s/tiles/zxy/0/0/0' % itemId,
+                          user=admin, params={'style': '{"bands": '})
+    assert utilities.respStatus(resp) == 400
+    resp = server.request(path='/item/%s/tiles/zxy/0/0/0' % itemId,
+                          user=admin, params={'style': json.dumps({'bands': [{'frame': 9}]})})
+    assert utilities.respStatus(resp) == 404
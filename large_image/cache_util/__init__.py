@@ -18,13 +18,14 @@
 
 import atexit
 
-from .cache import (LruCacheMetaclass, strhash, methodcache, getTileCache,
-                    isTileCacheSetup, CacheProperties)
+from .cache import (LruCacheMetaclass, strhash, methodcache, methodcacheContains,
+                    getTileCache, isTileCacheSetup, CacheProperties, MaximumTileSources)
 try:
     from .memcache import MemCache
 except ImportError:
     MemCache = None
 from .cachefactory import CacheFactory, pickAvailableCache
+from .diskcache import DiskTileStore, fileIdentity, trimDiskTileStores
 from cachetools import cached, Cache, LRUCache
 
 
@@ -81,4 +82,5 @@ def cachesInfo(*args, **kwargs):
 
 __all__ = ('CacheFactory', 'getTileCache', 'isTileCacheSetup', 'MemCache',
            'strhash', 'LruCacheMetaclass', 'pickAvailableCache', 'cached',
-           'Cache', 'LRUCache', 'methodcache', 'CacheProperties')
+           'Cache', 'LRUCache', 'methodcache', 'CacheProperties', 'DiskTileStore',
+           'MaximumTileSources', 'methodcacheContains', 'fileIdentity', 'trimDiskTileStores')
@@ -74,6 +74,42 @@ def strhash(*args, **kwargs):
     return '%r' % (args, )
 
 
+def _methodcacheKey(self, key, args, kwargs):
+    """
+    Get the cache key used by methodcache for a call.
+
+    :param self: the object whose method is called.
+    :param key: the key function passed to methodcache or None.
+    :param args: the arguments of the call.
+    :param kwargs: the keyword arguments of the call.
+    :returns: the key.
+    """
+    k = key(*args, **kwargs) if key else self.wrapKey(*args, **kwargs)
+    if hasattr(self, '_classkey'):
+        k = self._classkey + ' ' + k
+    return k
+
+
+def methodcacheContains(self, *args, **kwargs):
+    """
+    Check if the result of calling a method that is wrapped with methodcache
+    (using the default key) is in the cache.  Since the key doesn't include
+    the method's name, this is true for any such method called with the same
+    arguments.  Caches that can't report their contents, such as memcached,
+    never contain anything.
+
+    :param self: the object whose method would be called.
+    :param *args, **kwargs: the arguments of the call.
+    :returns: True if the result is known to be cached.
+    """
+    k = _methodcacheKey(self, None, args, kwargs)
+    lock = getattr(self, 'cache_lock', None)
+    if lock:
+        with lock:
+            return bool(k in self.cache)
+    return bool(k in self.cache)
+
+
 def methodcache(key=None):
     """
     Decorator to wrap a function with a memoizing callable that saves results
@@ -86,9 +122,7 @@ def methodcache(key=None):
     def decorator(func):
         @six.wraps(func)
         def wrapper(self, *args, **kwargs):
-            k = key(*args, **kwargs) if key else self.wrapKey(*args, **kwargs)
-            if hasattr(self, '_classkey'):
-                k = self._classkey + ' ' + k
+            k = _methodcacheKey(self, key, args, kwargs)
             lock = getattr(self, 'cache_lock', None)
             try:
                 if lock:
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import errno
+import hashlib
+import os
+import PIL.Image
+import threading
+import uuid
+
+from .. import config
+
+# The bytes written to each root directory of tile stores since its size was
+# last checked
+_written = {}
+_writtenLock = threading.Lock()
+
+
+def fileIdentity(path, sampleSize=65536):
+    """
+    Get a value that identifies the contents of a file, so that copies of a
+    file in different places or with different modification times have the
+    same value.  This is based on the size of the file and its first and last
+    bytes, which, for image files, usually include the headers and
+    directories.
+
+    :param path: the path of the file.
+    :param sampleSize: the number of bytes to read from each end of the file.
+    :returns: a hex string.
+    """
+    hash = hashlib.sha256()
+    with open(path, 'rb') as fptr:
+        fptr.seek(0, os.SEEK_END)
+        size = fptr.tell()
+        hash.update(str(size).encode('utf8'))
+        fptr.seek(0)
+        hash.update(fptr.read(sampleSize))
+        if size > sampleSize:
+            fptr.seek(max(sampleSize, size - sampleSize))
+            hash.update(fptr.read(sampleSize))
+    return hash.hexdigest()
+
+
+def trimDiskTileStores(root, maxSize):
+    """
+    Remove the least recently used tiles of the stores in a root directory
+    until they use no more than 90% of a maximum size.
+
+    :param root: the directory used by the stores.
+    :param maxSize: the maximum size in bytes.  Nothing is removed if the
+        stores use less than this.
+    """
+    files = []
+    total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if not name.endswith('.png'):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    if total <= maxSize:
+        return
+    for _, size, path in sorted(files):
+        if total <= maxSize * 0.9:
+            break
+        try:
+            os.unlink(path)
+            total -= size
+        except OSError:
+            pass
+
+
+class DiskTileStore(object):
+    """
+    Store tiles that are expensive to compute as image files on disk so that
+    they persist between processes.  Tiles are stored losslessly as PNG
+    files.  Each file is written to a temporary name and then renamed, so
+    concurrent readers never see partial tiles.  When the stores in a root
+    directory exceed the cache_overview_max_size config value, the least
+    recently used tiles are removed.
+    """
+
+    def __init__(self, root, *key):
+        """
+        Create a store for the tiles of one image.
+
+        :param root: the directory used by all stores.
+        :param *key: values that identify the image and its tiling, such as
+            the fileIdentity of the file and its tile size.  Tiles are stored
+            in a directory based on a hash of these values.
+        """
+        self.root = root
+        hash = hashlib.sha256(repr(key).encode('utf8')).hexdigest()
+        self.path = os.path.join(root, hash[:2], hash)
+
+    def _tilePath(self, z, x, y, frame=None):
+        name = '%d_%d' % (x, y)
+        if frame is not None:
+            name += '_%s' % frame
+        return os.path.join(self.path, str(z), name + '.png')
+
+    def get(self, z, x, y, frame=None):
+        """
+        Get a stored tile.
+
+        :param z: the level of the tile.
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param frame: the frame of the tile, if any.
+        :returns: a PIL image or None if the tile isn't stored.
+        """
+        path = self._tilePath(z, x, y, frame)
+        try:
+            with open(path, 'rb') as fptr:
+                image = PIL.Image.open(fptr)
+                image.load()
+        except (IOError, OSError):
+            return None
+        try:
+            # Mark the tile as recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+        return image
+
+    def put(self, image, z, x, y, frame=None):
+        """
+        Store a tile.  Failures are logged but not raised, since the tile can
+        always be computed again.
+
+        :param image: a PIL image.
+        :param z: the level of the tile.
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param frame: the frame of the tile, if any.
+        """
+        path = self._tilePath(z, x, y, frame)
+        try:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            # Unlike mkstemp, this honors the umask, so other users that share
+            # the store can read the tiles.
+            tempPath = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+            fd = os.open(tempPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            try:
+                with os.fdopen(fd, 'wb') as fptr:
+                    # A low compression level is much faster to write
+                    image.save(fptr, 'PNG', compress_level=1)
+                    size = fptr.tell()
+                os.rename(tempPath, path)
+            except Exception:
+                os.unlink(tempPath)
+                raise
+        except (IOError, OSError) as exc:
+            config.getConfig('logger').warning('Failed to store tile %s: %s', path, exc)
+            return
+        self._noteWritten(size)
+
+    def _noteWritten(self, size):
+        """
+        Keep track of the bytes written to the root directory, and remove old
+        tiles if the stores may have grown too large.  The size of the stores
+        is checked each time a sixteenth of the maximum size is written.
+
+        :param size: the number of bytes that were written.
+        """
+        maxSize = config.getConfig('cache_overview_max_size')
+        if not maxSize:
+            return
+        with _writtenLock:
+            _written[self.root] = _written.get(self.root, 0) + size
+            if _written[self.root] < maxSize // 16:
+                return
+            _written[self.root] = 0
+        trimDiskTileStores(self.root, maxSize)
@@ -21,6 +21,54 @@ ConfigValues = {
     'cache_memcached_password': None,
 
     'max_small_image_size': 4096,
+    # The tile size used to serve images read with PIL as a multi-resolution
+    # pyramid.  The reduced resolution levels are built in memory when first
+    # used.  None serves each image as a single tile.
+    'pil_tile_size': None,
+
+    # PNG compression level from 0 (none) to 9 (smallest).  None uses PIL's
+    # default of 6.  1 is much faster at a modest cost in size.
+    'png_compress_level': None,
+
+    # When many tiles are read from a TIFF file, tiles whose data is within
+    # this many bytes of each other are read together, as long as each read is
+    # no larger than the maximum size.  A maximum size of 0 reads and decodes
+    # each tile separately when it is used.
+    'tiff_coalesce_gap': 64 * 1024,
+    'tiff_coalesce_max_read': 16 * 1024 * 1024,
+    # The most bytes of tile data that each image reader keeps from bulk reads
+    # until the tiles are used.
+    'prefetch_max_bytes': 64 * 1024 ** 2,
+    # The number of threads used to decode uncompressed, LZW, and deflate TIFF
+    # tiles that are read in bulk.  None uses one per CPU.  1 decodes tiles as
+    # they are used.
+    'tiff_decode_threads': None,
+    # The number of threads OpenJPEG uses to decode each JPEG 2000 read.  None
+    # uses glymur's default.  This requires OpenJPEG 2.4 or later.
+    'openjpeg_decode_threads': None,
+    # The number of glymur handles shared by all JPEG 2000 files.  These are
+    # in addition to the handle each tile source keeps for its metadata.  None
+    # allows four per tile source that can be cached, up to 64.  Handles that
+    # haven't been used for the idle time in seconds are closed.
+    'openjpeg_max_handles': None,
+    'openjpeg_handle_idle_time': 60,
+
+    # The number of mapnik maps each mapnik tile source renders with in
+    # parallel.  None uses one per CPU.
+    'mapnik_map_pool_size': None,
+    # Mapnik renders blocks of this many tiles across and down at once and
+    # splits them into tiles.  This avoids seams between the tiles of a block.
+    # 1 renders each tile separately.
+    'mapnik_metatile': 1,
+
+    # A directory where tiles that are synthesized for levels missing from
+    # sparse TIFF pyramids are stored, so that each is only computed once.
+    # None only keeps them in the tile cache.
+    'cache_overview_path': None,
+    # The most bytes of tiles kept in the cache_overview_path directory.  The
+    # least recently used tiles are removed when this is exceeded.  None or 0
+    # doesn't limit the size.
+    'cache_overview_max_size': 10 * 1024 ** 3,
 }
 
 
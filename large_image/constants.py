@@ -41,6 +41,7 @@ TileOutputMimeTypes = {
     'JPEG': 'image/jpeg',
     'PNG': 'image/png',
     'TIFF': 'image/tiff',
+    'WEBP': 'image/webp',
 }
 TileOutputPILFormat = {
     'JFIF': 'JPEG'
@@ -63,3 +64,7 @@ TileInputUnits = {
     'millimeters': 'mm',
     'fraction': 'fraction',
 }
+
+# Blend modes for compositing frames.  'lighten' keeps the brightest value of
+# each color channel and 'add' sums the channels of all bands.
+CompositeModes = ('lighten', 'add')
@@ -1,28 +1,120 @@
 # -*- coding: utf-8 -*-
 
+import cachetools
 import os
+import threading
 from pkg_resources import iter_entry_points
 
 from .base import TileSource, FileTileSource, TileOutputMimeTypes, \
     TILE_FORMAT_IMAGE, TILE_FORMAT_PIL, TILE_FORMAT_NUMPY, nearPowerOfTwo, \
-    etreeToDict
+    etreeToDict, TileEncoders, registerTileEncoder, sniffMagicBytes, PrefetchedTiles, \
+    tileRuns
 from ..exceptions import TileGeneralException, TileSourceException, TileSourceAssetstoreException
 from .. import config
 from ..constants import SourcePriority
+from .manifest import SourceManifest
 
 
 AvailableTileSources = {}
 
+# The number of bytes read from the start of a file to check its format.
+SniffHeaderSize = 64
+
+# Remember which source opened a file, keyed by the file's path, size, and
+# modification time, so that later opens can skip sources that failed.
+_sourceNameMemo = cachetools.LRUCache(maxsize=1000)
+_sourceNameMemoLock = threading.Lock()
+
+
+class LazyTileSource(object):
+    """
+    A stand-in for a tile source class that is imported the first time it is
+    needed.  The attributes used to pick candidate sources come from the
+    source manifest; anything else imports the source class.
+    """
+
+    def __init__(self, entryPoint, manifest):
+        """
+        :param entryPoint: the entry point of the tile source class.
+        :param manifest: a dictionary of the class attributes of the source.
+            This must include name, extensions, and mimeTypes.
+        """
+        self._entryPoint = entryPoint
+        self._manifest = manifest
+        self._sourceClass = None
+        self._failed = False
+
+    def __repr__(self):
+        return '<LazyTileSource %s%s>' % (
+            self._entryPoint, ' (loaded)' if self._sourceClass else '')
+
+    def load(self):
+        """
+        Import the tile source class if it hasn't been imported.
+
+        :returns: the tile source class or None if it could not be imported.
+        """
+        if self._sourceClass is None and not self._failed:
+            try:
+                self._sourceClass = self._entryPoint.load()
+                config.getConfig('logprint').debug(
+                    'Loaded tile source %s' % self._entryPoint.name)
+            except Exception:
+                self._failed = True
+                config.getConfig('logprint').exception(
+                    'Failed to load tile source %s' % self._entryPoint.name)
+        return self._sourceClass
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        if self._sourceClass is None and key in self._manifest:
+            return self._manifest[key]
+        sourceClass = self.load()
+        if sourceClass is None:
+            raise AttributeError(key)
+        return getattr(sourceClass, key)
+
+    def __call__(self, *args, **kwargs):
+        sourceClass = self.load()
+        if sourceClass is None:
+            raise TileSourceException(
+                'Tile source %s could not be loaded' % self._entryPoint.name)
+        return sourceClass(*args, **kwargs)
+
+    def sniff(self, header):
+        if self._sourceClass is not None:
+            return self._sourceClass.sniff(header)
+        return sniffMagicBytes(
+            header, self._manifest.get('magicBytes'), self._manifest.get('notMagicBytes'))
+
+    def canRead(self, *args, **kwargs):
+        sourceClass = self.load()
+        return sourceClass is not None and sourceClass.canRead(*args, **kwargs)
+
+    def openIfReadable(self, *args, **kwargs):
+        sourceClass = self.load()
+        if sourceClass is None:
+            return None
+        return sourceClass.openIfReadable(*args, **kwargs)
+
 
 def loadTileSources(entryPointName='large_image.source', sourceDict=AvailableTileSources):
     """
     Load all tilesources from entrypoints and add them to the
-    AvailableTileSources dictionary.
+    AvailableTileSources dictionary.  Sources that are listed in the source
+    manifest are added as LazyTileSource objects and are not imported until
+    they are needed.
 
     :param entryPointName: the name of the entry points to load.
     :param sourceDict: a dictionary to populate with the loaded sources.
     """
+    manifests = SourceManifest.get(entryPointName, {})
     for entryPoint in iter_entry_points(entryPointName):
+        manifest = manifests.get(entryPoint.name)
+        if manifest and manifest['module'] == entryPoint.module_name:
+            sourceDict[entryPoint.name] = LazyTileSource(entryPoint, manifest)
+            continue
         try:
             sourceClass = entryPoint.load()
             if sourceClass.name and None in sourceClass.extensions:
@@ -34,18 +126,49 @@ def loadTileSources(entryPointName='large_image.source', sourceDict=AvailableTil
             pass
 
 
-def getTileSourceFromDict(availableSources, pathOrUri, *args, **kwargs):
+def _readSniffHeader(path):
     """
-    Get a tile source based on a ordered dictionary of known sources and a path
-    name or URI.  Additional parameters are passed to the tile source and can
-    be used for properties such as encoding.
+    Read the start of a file so that sources can cheaply check its format.
 
-    :param availableSources: an ordered dictionary of sources to try.
+    :param path: a file path.
+    :returns: the first SniffHeaderSize bytes of the file, or None if it isn't
+        a readable file.
+    """
+    try:
+        with open(path, 'rb') as fptr:
+            return fptr.read(SniffHeaderSize)
+    except (IOError, OSError, TypeError, ValueError):
+        return None
+
+
+def _sourceMemoKey(availableSources, pathOrUri):
+    """
+    Get the key used to memoize the source picked for a file.
+
+    :param availableSources: the dictionary of sources being picked from.
+    :param pathOrUri: the path or URI of the file.
+    :returns: a key or None if the file should not be memoized.
+    """
+    try:
+        stat = os.stat(pathOrUri)
+    except (OSError, TypeError, ValueError):
+        return None
+    return (id(availableSources), pathOrUri, stat.st_size, stat.st_mtime)
+
+
+def _getSortedSourceList(availableSources, pathOrUri, header=None, preferred=None):
+    """
+    Get the names of the sources that might read a path or URI, in the order
+    they should be tried.
+
+    :param availableSources: an ordered dictionary of sources.
     :param pathOrUri: either a file path or a fixed source via
         large_image://<source>.
-    :returns: a tile source instance or and error.
+    :param header: if not None, the first bytes of the file.  Sources whose
+        sniff method rejects this are excluded.
+    :param preferred: if not None, the name of a source to try first.
+    :returns: a list of source names.
     """
-    sourceObj = pathOrUri
     uriWithoutProtocol = pathOrUri.split('://', 1)[-1]
     isLargeImageUri = pathOrUri.startswith('large_image://')
     extensions = [ext.lower() for ext in os.path.basename(uriWithoutProtocol).split('.')[1:]]
@@ -60,10 +183,44 @@ def getTileSourceFromDict(availableSources, pathOrUri, *args, **kwargs):
             priority = SourcePriority.NAMED
         if priority >= SourcePriority.MANUAL:
             continue
-        sourceList.append((priority, sourceName))
-    for _priority, sourceName in sorted(sourceList):
-        if availableSources[sourceName].canRead(sourceObj, *args, **kwargs):
-            return availableSources[sourceName](sourceObj, *args, **kwargs)
+        if header is not None and not availableSources[sourceName].sniff(header):
+            continue
+        sourceList.append((sourceName != preferred, priority, sourceName))
+    return [entry[-1] for entry in sorted(sourceList)]
+
+
+def getTileSourceFromDict(availableSources, pathOrUri, *args, **kwargs):
+    """
+    Get a tile source based on a ordered dictionary of known sources and a path
+    name or URI.  Additional parameters are passed to the tile source and can
+    be used for properties such as encoding.
+
+    Sources are ruled out by checking the start of the file before any are
+    opened, and the source that opens a file is remembered so that it is tried
+    first the next time the same unchanged file is opened.
+
+    :param availableSources: an ordered dictionary of sources to try.
+    :param pathOrUri: either a file path or a fixed source via
+        large_image://<source>.
+    :returns: a tile source instance or and error.
+    """
+    sourceObj = pathOrUri
+    header = None
+    memoKey = None
+    if not pathOrUri.startswith('large_image://'):
+        header = _readSniffHeader(pathOrUri)
+        memoKey = _sourceMemoKey(availableSources, pathOrUri)
+    preferred = None
+    if memoKey is not None:
+        with _sourceNameMemoLock:
+            preferred = _sourceNameMemo.get(memoKey)
+    for sourceName in _getSortedSourceList(availableSources, pathOrUri, header, preferred):
+        source = availableSources[sourceName].openIfReadable(sourceObj, *args, **kwargs)
+        if source is not None:
+            if memoKey is not None:
+                with _sourceNameMemoLock:
+                    _sourceNameMemo[memoKey] = sourceName
+            return source
     raise TileSourceException('No available tilesource for %s' % pathOrUri)
 
 
@@ -84,4 +241,5 @@ __all__ = [
     'exceptions', 'TileGeneralException', 'TileSourceException', 'TileSourceAssetstoreException',
     'TileOutputMimeTypes', 'TILE_FORMAT_IMAGE', 'TILE_FORMAT_PIL', 'TILE_FORMAT_NUMPY',
     'AvailableTileSources', 'getTileSource', 'nearPowerOfTwo', 'etreeToDict',
+    'TileEncoders', 'registerTileEncoder', 'PrefetchedTiles', 'tileRuns',
 ]
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import json
 import math
 import numpy
 import PIL
@@ -7,21 +8,152 @@ import PIL.Image
 import PIL.ImageColor
 import PIL.ImageDraw
 import six
-from collections import defaultdict
+import threading
+from collections import defaultdict, OrderedDict
+from multiprocessing.pool import ThreadPool
 from six import BytesIO
+try:
+    import turbojpeg
+except ImportError:
+    turbojpeg = None
 
-from ..cache_util import getTileCache, strhash, methodcache
-from ..constants import SourcePriority, \
+from ..cache_util import getTileCache, strhash, methodcache, methodcacheContains
+from ..constants import SourcePriority, CompositeModes, \
     TILE_FORMAT_IMAGE, TILE_FORMAT_NUMPY, TILE_FORMAT_PIL, \
     TileOutputMimeTypes, TileOutputPILFormat, TileInputUnits
 from .. import config
 from .. import exceptions
+from . import timing
 
 
 # Turn off decompression warning check
 PIL.Image.MAX_IMAGE_PIXELS = None
 
 
+def _encodePIL(image, encoding, jpegQuality=95, jpegSubsampling=0,
+               tiffCompression='raw', **kwargs):
+    """
+    Encode a PIL image using PIL's own encoders.
+
+    :param image: a PIL image.
+    :param encoding: the PIL format name (e.g., 'JPEG', 'PNG', 'TIFF', or
+        'WEBP').
+    :param jpegQuality: the quality to use when encoding a JPEG.  This is also
+        used as the quality of WebP images.
+    :param jpegSubsampling: the subsampling level to use when encoding a JPEG.
+    :param tiffCompression: the compression format to use when encoding a TIFF.
+    :returns: the encoded image.
+    """
+    params = {}
+    if encoding == 'JPEG':
+        if image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+        params['quality'] = jpegQuality
+        params['subsampling'] = jpegSubsampling
+    elif encoding == 'PNG':
+        compressLevel = config.getConfig('png_compress_level')
+        if compressLevel is not None:
+            params['compress_level'] = int(compressLevel)
+    elif encoding == 'TIFF':
+        params['compression'] = tiffCompression
+    elif encoding == 'WEBP':
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.mode else 'RGB')
+        params['quality'] = jpegQuality
+    output = BytesIO()
+    image.save(output, encoding, **params)
+    return output.getvalue()
+
+
+_turboJPEG = None
+
+
+def _encodeTurboJPEG(image, encoding, jpegQuality=95, jpegSubsampling=0,
+                     **kwargs):
+    """
+    Encode a PIL image as a JPEG using libjpeg-turbo via PyTurboJPEG.  If the
+    libjpeg-turbo library can't be loaded, PIL is used instead.
+
+    :param image: a PIL image.
+    :param encoding: the PIL format name.  This is always 'JPEG'.
+    :param jpegQuality: the quality to use when encoding a JPEG.
+    :param jpegSubsampling: the subsampling level to use when encoding a JPEG
+        (0 is full chroma, 1 is half, 2 is quarter).
+    :returns: the encoded image.
+    """
+    global _turboJPEG
+
+    if _turboJPEG is None:
+        try:
+            _turboJPEG = turbojpeg.TurboJPEG()
+        except Exception:
+            config.getConfig('logger').info(
+                'Cannot load libjpeg-turbo; using PIL to encode JPEGs')
+            _turboJPEG = False
+    if not _turboJPEG:
+        return _encodePIL(image, encoding, jpegQuality, jpegSubsampling, **kwargs)
+    if image.mode not in ('L', 'RGB'):
+        image = image.convert('RGB')
+    if image.mode == 'L':
+        pixelFormat = turbojpeg.TJPF_GRAY
+        subsampling = turbojpeg.TJSAMP_GRAY
+    else:
+        pixelFormat = turbojpeg.TJPF_RGB
+        subsampling = {
+            1: turbojpeg.TJSAMP_422,
+            2: turbojpeg.TJSAMP_420,
+        }.get(jpegSubsampling, turbojpeg.TJSAMP_444)
+    return _turboJPEG.encode(
+        numpy.ascontiguousarray(numpy.asarray(image)), quality=jpegQuality,
+        pixel_format=pixelFormat, jpeg_subsample=subsampling)
+
+
+# TileEncoders maps PIL format names to functions that take a PIL image, the
+# format name, and the jpegQuality, jpegSubsampling, and tiffCompression
+# options, and return the encoded image.  Each format must also be listed in
+# the TileOutputMimeTypes constants.
+TileEncoders = {
+    'JPEG': _encodePIL if turbojpeg is None else _encodeTurboJPEG,
+    'PNG': _encodePIL,
+    'TIFF': _encodePIL,
+    'WEBP': _encodePIL,
+}
+
+
+def registerTileEncoder(encoding, encoder, mimeType=None):
+    """
+    Add or replace a tile encoder.
+
+    :param encoding: the encoding name used in the encoding parameter of tile
+        sources and requests.
+    :param encoder: a function that takes (image, encoding, jpegQuality,
+        jpegSubsampling, tiffCompression) and returns the encoded image, as
+        described for TileEncoders.
+    :param mimeType: the mime type of the encoded image.  This may be None if
+        the encoding is already listed in TileOutputMimeTypes.
+    """
+    if mimeType is not None:
+        TileOutputMimeTypes[encoding] = mimeType
+    if encoding not in TileOutputMimeTypes:
+        raise ValueError('No mime type is known for encoding "%s"' % encoding)
+    TileEncoders[TileOutputPILFormat.get(encoding, encoding)] = encoder
+
+
+def _encodeTile(image, encoding, **kwargs):
+    """
+    Encode a PIL image using the registered tile encoder.
+
+    :param image: a PIL image.
+    :param encoding: an encoding listed in TileOutputMimeTypes.
+    :param **kwargs: jpegQuality, jpegSubsampling, and tiffCompression options
+        passed to the encoder.
+    :returns: the encoded image.
+    """
+    encoding = TileOutputPILFormat.get(encoding, encoding)
+    encoder = TileEncoders.get(encoding, _encodePIL)
+    return encoder(image, encoding, **kwargs)
+
+
 def _encodeImage(image, encoding='JPEG', jpegQuality=95, jpegSubsampling=0,
                  format=(TILE_FORMAT_IMAGE, ), tiffCompression='raw',
                  **kwargs):
@@ -31,7 +163,7 @@ def _encodeImage(image, encoding='JPEG', jpegQuality=95, jpegSubsampling=0,
     :param image: a PIL image.
     :param encoding: a valid PIL encoding (typically 'PNG' or 'JPEG').  Must
         also be in the TileOutputMimeTypes map.
-    :param jpegQuality: the quality to use when encoding a JPEG.
+    :param jpegQuality: the quality to use when encoding a JPEG or WebP.
     :param jpegSubsampling: the subsampling level to use when encoding a JPEG.
     :param format: the desired format or a tuple of allowed formats.  Formats
         are members of (TILE_FORMAT_PIL, TILE_FORMAT_NUMPY, TILE_FORMAT_IMAGE).
@@ -59,18 +191,10 @@ def _encodeImage(image, encoding='JPEG', jpegQuality=95, jpegSubsampling=0,
         if image.width == 0 or image.height == 0:
             imageData = b''
         else:
-            encoding = TileOutputPILFormat.get(encoding, encoding)
-            output = BytesIO()
-            params = {}
-            if encoding == 'JPEG' and image.mode not in ('L', 'RGB'):
-                image = image.convert('RGB')
-            if encoding == 'JPEG':
-                params['quality'] = jpegQuality
-                params['subsampling'] = jpegSubsampling
-            elif encoding == 'TIFF':
-                params['compression'] = tiffCompression
-            image.save(output, encoding, **params)
-            imageData = output.getvalue()
+            imageData = _encodeTile(
+                image, encoding, jpegQuality=jpegQuality,
+                jpegSubsampling=jpegSubsampling,
+                tiffCompression=tiffCompression)
     return imageData, imageFormatOrMimeType
 
 
@@ -96,6 +220,222 @@ def _letterboxImage(image, width, height, fill):
     return result
 
 
+def _imageFromArray(array, bits=None):
+    """
+    Convert a numpy array of any data type to an 8-bit PIL image.  Native
+    data is only reduced to 8 bits here, when an image is needed for encoding.
+    Integer data keeps its most significant byte (negative values are clipped
+    to 0) and floating point data is scaled from [0, 1].
+
+    :param array: a numpy array of shape (height, width) or (height, width,
+        bands).  Only the first four bands are used.
+    :param bits: the number of bits used by integer data, such as 12 for
+        12-bit samples stored in 16-bit integers.  The most significant byte
+        is taken from these bits; larger values are clipped.  If None, all of
+        the bits of the data type are used.
+    :returns: a PIL image.
+    """
+    if array.dtype != numpy.uint8:
+        if array.dtype.kind == 'f':
+            array = numpy.clip(array * 255.0, 0, 255)
+        elif array.dtype.kind in 'iu':
+            if bits is None:
+                bits = array.dtype.itemsize * 8 - (1 if array.dtype.kind == 'i' else 0)
+            if array.dtype.kind == 'i':
+                array = numpy.clip(array, 0, None)
+            array = numpy.clip(array >> max(0, bits - 8), 0, 255)
+        elif array.dtype.kind == 'b':
+            array = array * 255
+        array = array.astype(numpy.uint8)
+    if array.ndim == 3:
+        array = array[:, :, 0] if array.shape[2] == 1 else array[:, :, :4]
+    return PIL.Image.fromarray(array)
+
+
+def _arrayFromTile(tile):
+    """
+    Get a numpy array from a tile returned by getTile.
+
+    :param tile: a numpy array, a PIL image, or an encoded image.
+    :returns: a numpy array.
+    """
+    if isinstance(tile, numpy.ndarray):
+        return tile
+    if not isinstance(tile, PIL.Image.Image):
+        tile = PIL.Image.open(BytesIO(tile))
+    return numpy.asarray(tile)
+
+
+def _resizeArray(array, width, height, resample=PIL.Image.LANCZOS):
+    """
+    Resize a numpy array of any data type.  8-bit arrays that PIL supports
+    directly are resized as images; other arrays are resized one band at a
+    time as 32-bit floating point images.
+
+    :param array: a numpy array of shape (height, width) or (height, width,
+        bands).
+    :param width: the output width.
+    :param height: the output height.
+    :param resample: a PIL resampling filter.
+    :returns: the resized array with the same data type.
+    """
+    if array.dtype == numpy.uint8 and (array.ndim == 2 or array.shape[2] in (3, 4)):
+        return numpy.asarray(PIL.Image.fromarray(array).resize((width, height), resample))
+    bands = array if array.ndim == 3 else array[:, :, numpy.newaxis]
+    result = numpy.empty((height, width, bands.shape[2]), dtype=array.dtype)
+    for band in range(bands.shape[2]):
+        resized = numpy.asarray(PIL.Image.fromarray(
+            bands[:, :, band].astype(numpy.float32)).resize((width, height), resample))
+        if array.dtype.kind in 'iu':
+            limits = numpy.iinfo(array.dtype)
+            resized = numpy.clip(numpy.round(resized), limits.min, limits.max)
+        result[:, :, band] = resized
+    return result if array.ndim == 3 else result[:, :, 0]
+
+
+def _arrayFillColor(fill, array):
+    """
+    Convert a color to the range and number of bands of a numpy array.
+
+    :param fill: a color that PIL.ImageColor understands.
+    :param array: the numpy array that will be filled.
+    :returns: a numpy array of the color values, one per band.
+    """
+    bands = array.shape[2] if array.ndim == 3 else 1
+    mode = {1: 'L', 2: 'LA', 3: 'RGB'}.get(bands, 'RGBA')
+    color = numpy.array(PIL.ImageColor.getcolor(fill, mode), dtype=float).reshape(-1)
+    color = numpy.resize(color, bands)
+    if array.dtype.kind == 'f':
+        color /= 255.0
+    elif array.dtype.kind in 'iu' and array.dtype.itemsize > 1:
+        color *= float(numpy.iinfo(array.dtype).max) / 255
+    return color.astype(array.dtype)
+
+
+def _checkFramesFormat(format, frames):
+    """
+    Check that tiles or regions of multiple frames are requested as numpy
+    arrays, since they cannot be represented as images.
+
+    :param format: a tuple of allowed formats.
+    :param frames: None or a list of frame numbers.
+    :raises: ValueError if the frames cannot be returned in the format.
+    """
+    if frames is not None and TILE_FORMAT_NUMPY not in format:
+        raise ValueError('Frames can only be requested in numpy format')
+
+
+def _parseCompositeStyle(style):
+    """
+    Validate a composite style and fill in its defaults.
+
+    :param style: a dictionary or a JSON string of a dictionary with bands, a
+        list of dictionaries each with frame, and optionally band, palette,
+        min, and max, and composite, the blend mode.  See getCompositeTile.
+    :returns: a dictionary with the same structure and all values present.
+    :raises: TileSourceException if the style is invalid.
+    """
+    try:
+        if isinstance(style, six.string_types):
+            style = json.loads(style)
+        composite = style.get('composite', 'lighten')
+        if composite not in CompositeModes:
+            raise ValueError('unknown composite mode')
+        bands = []
+        for entry in style['bands']:
+            bands.append({
+                'frame': int(entry.get('frame', 0)),
+                'band': int(entry['band']) if entry.get('band') is not None else None,
+                'palette': list(PIL.ImageColor.getrgb(entry.get('palette', '#ffffff'))[:3]),
+                'min': float(entry['min']) if entry.get('min') is not None else None,
+                'max': float(entry['max']) if entry.get('max') is not None else None,
+            })
+        if not bands:
+            raise ValueError('no bands')
+    except (AttributeError, KeyError, TypeError, ValueError) as exc:
+        raise exceptions.TileSourceException('Invalid composite style: %s' % exc)
+    return {'bands': bands, 'composite': composite}
+
+
+def _compositeFrames(stack, style):
+    """
+    Blend the tiles of several frames into one 8-bit RGB tile.  Each band is
+    scaled from its min and max to [0, 1], multiplied by its palette color,
+    and blended in 32-bit floating point.
+
+    :param stack: a numpy array of shape (bands, height, width[, samples]),
+        where the first axis is in the order of the style's bands.
+    :param style: a style from _parseCompositeStyle.
+    :returns: a uint8 numpy array of shape (height, width, 3).
+    """
+    result = numpy.zeros(stack.shape[1:3] + (3, ), dtype=numpy.float32)
+    for data, entry in zip(stack, style['bands']):
+        if data.ndim == 3:
+            data = data[:, :, entry['band'] or 0]
+        if data.dtype.kind in 'iu':
+            limits = (0, numpy.iinfo(data.dtype).max)
+        else:
+            limits = (0, 1)
+        minimum = entry['min'] if entry['min'] is not None else limits[0]
+        maximum = entry['max'] if entry['max'] is not None else limits[1]
+        scale = 1.0 / (maximum - minimum) if maximum != minimum else 0
+        value = data.astype(numpy.float32)
+        value -= minimum
+        value *= scale
+        numpy.clip(value, 0, 1, out=value)
+        color = value[:, :, numpy.newaxis] * (
+            numpy.array(entry['palette'], dtype=numpy.float32) / 255)
+        if style['composite'] == 'add':
+            result += color
+        else:
+            numpy.maximum(result, color, out=result)
+    numpy.clip(result, 0, 1, out=result)
+    return (result * 255 + 0.5).astype(numpy.uint8)
+
+
+def _pasteArray(target, source, x, y):
+    """
+    Copy a numpy array into a larger array, clipping it to the target.
+
+    :param target: the array to modify.
+    :param source: the array to copy.
+    :param x: the horizontal offset of the source within the target.
+    :param y: the vertical offset of the source within the target.
+    """
+    x, y = int(x), int(y)
+    x0, y0 = max(0, -x), max(0, -y)
+    x1 = min(source.shape[1], target.shape[1] - x)
+    y1 = min(source.shape[0], target.shape[0] - y)
+    if x1 <= x0 or y1 <= y0:
+        return
+    if source.ndim == 2 and target.ndim == 3:
+        source = source[:, :, numpy.newaxis]
+    target[y + y0:y + y1, x + x0:x + x1] = source[y0:y1, x0:x1]
+
+
+def _letterboxArray(array, width, height, fill):
+    """
+    Given a numpy array, width, height, and fill color, letterbox or
+    pillarbox the array to make it the specified dimensions.  See
+    _letterboxImage.
+
+    :param array: the source array.
+    :param width: the desired width in pixels.
+    :param height: the desired height in pixels.
+    :param fill: a fill color.
+    """
+    if ((array.shape[1] >= width and array.shape[0] >= height) or
+            not fill or str(fill).lower() == 'none'):
+        return array
+    width = max(width, array.shape[1])
+    height = max(height, array.shape[0])
+    color = _arrayFillColor(fill, array)
+    result = numpy.empty((height, width) + array.shape[2:], dtype=array.dtype)
+    result[:] = color if array.ndim == 3 else color[0]
+    _pasteArray(result, array, (width - array.shape[1]) // 2, (height - array.shape[0]) // 2)
+    return result
+
+
 def etreeToDict(t):
     """
     Convert an xml etree to a nested dictionary without schema names in the
@@ -127,6 +467,26 @@ def etreeToDict(t):
     return d
 
 
+def sniffMagicBytes(header, magicBytes=None, notMagicBytes=None):
+    """
+    Check if the start of a file matches a source's magic bytes.
+
+    :param header: the first bytes of the file.
+    :param magicBytes: None or a list of byte strings, one of which the header
+        must start with.
+    :param notMagicBytes: None or a list of byte strings, none of which the
+        header may start with.
+    :returns: False if the header does not match.
+    """
+    if magicBytes is not None and not any(
+            header.startswith(magic) for magic in magicBytes):
+        return False
+    if notMagicBytes is not None and any(
+            header.startswith(magic) for magic in notMagicBytes):
+        return False
+    return True
+
+
 def nearPowerOfTwo(val1, val2, tolerance=0.02):
     """
     Check if two values are different by nearly a power of two.
@@ -146,6 +506,96 @@ def nearPowerOfTwo(val1, val2, tolerance=0.02):
     return abs(log2ratio - round(log2ratio)) < tolerance
 
 
+def tileRuns(tiles, maxRun):
+    """
+    Split tiles into runs of horizontally adjacent tiles of the same row, so
+    each run can be read at once.
+
+    :param tiles: an iterable of (x, y) tile indices.
+    :param maxRun: the most tiles in a run.
+    :returns: a list of runs, each a list of (x, y) tile indices in order.
+        The runs are ordered by row and then column.
+    """
+    runs = []
+    for x, y in sorted(set(tiles), key=lambda tile: (tile[1], tile[0])):
+        if runs and runs[-1][-1] == (x - 1, y) and len(runs[-1]) < maxRun:
+            runs[-1].append((x, y))
+        else:
+            runs.append([(x, y)])
+    return runs
+
+
+class PrefetchedTiles(object):
+    """
+    Tile data that was read in bulk and is kept until each tile is used.  The
+    total size of the data is limited; when it would be exceeded, the data
+    that was added first is discarded.  This is thread safe.
+    """
+
+    def __init__(self, maxBytes=None):
+        """
+        Create a store for prefetched tile data.
+
+        :param maxBytes: the most bytes of data to keep.  If None, the
+            prefetch_max_bytes config setting is used.
+        """
+        if maxBytes is None:
+            maxBytes = config.getConfig('prefetch_max_bytes')
+        self.maxBytes = int(maxBytes)
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(data):
+        return getattr(data, 'nbytes', None) or len(data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def pop(self, key):
+        """
+        Get and discard the data of a tile.
+
+        :param key: the key of the tile.
+        :returns: the data or None if the tile isn't stored.
+        """
+        if not self._data:
+            return None
+        with self._lock:
+            data = self._data.pop(key, None)
+            if data is not None:
+                self._bytes -= self._size(data)
+        return data
+
+    def update(self, items):
+        """
+        Store the data of some tiles.
+
+        :param items: an iterable of (key, data) tuples.
+        """
+        with self._lock:
+            for key, data in items:
+                if key in self._data:
+                    self._bytes -= self._size(self._data.pop(key))
+                self._data[key] = data
+                self._bytes += self._size(data)
+            while self._data and self._bytes > self.maxBytes:
+                self._bytes -= self._size(self._data.popitem(last=False)[1])
+
+    def clear(self):
+        """
+        Discard all stored data.
+        """
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+
 class LazyTileDict(dict):
     """
     Tiles returned from the tile iterator and dictionaries of information with
@@ -180,6 +630,8 @@ class LazyTileDict(dict):
         self.requestedScale = tileInfo.get('requestedScale')
         self.metadata = tileInfo.get('metadata')
         self.retile = tileInfo.get('retile') and self.metadata
+        self.nativeDtype = tileInfo.get('nativeDtype', False)
+        self.frames = tileInfo.get('frames')
 
         self.deferredKeys = ('tile', 'format')
         self.alwaysAllowPIL = True
@@ -268,6 +720,71 @@ class LazyTileDict(dict):
                     int(y * self.metadata['tileHeight'] - self['y'])))
         return retile
 
+    def _getNativeTiles(self, x, y):
+        """
+        Get a tile from the source as numpy arrays in the source's native data
+        type, one per requested frame.
+
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :returns: a list of numpy arrays.
+        """
+        if self.frames is not None:
+            return list(self.source.getTileFrames(
+                x, y, self.level, frames=self.frames, sparseFallback=True))
+        return [_arrayFromTile(self.source.getTile(
+            x, y, self.level, pilImageAllowed=True, numpyAllowed='always',
+            sparseFallback=True, frame=self.frame))]
+
+    def _retileArray(self):
+        """
+        Given the tile information, merge multiple native data tiles together
+        to form numpy arrays of a different size, one per requested frame.
+        """
+        retile = None
+        xmin = int(max(0, self['x'] // self.metadata['tileWidth']))
+        xmax = int((self['x'] + self.width - 1) // self.metadata['tileWidth'] + 1)
+        ymin = int(max(0, self['y'] // self.metadata['tileHeight']))
+        ymax = int((self['y'] + self.height - 1) // self.metadata['tileHeight'] + 1)
+        for x in range(xmin, xmax):
+            for y in range(ymin, ymax):
+                tiles = self._getNativeTiles(x, y)
+                if retile is None:
+                    retile = [numpy.zeros(
+                        (self.height, self.width) + tileData.shape[2:], dtype=tileData.dtype)
+                        for tileData in tiles]
+                for target, tileData in zip(retile, tiles):
+                    _pasteArray(target, tileData,
+                                x * self.metadata['tileWidth'] - self['x'],
+                                y * self.metadata['tileHeight'] - self['y'])
+        return retile
+
+    def _nativeTile(self):
+        """
+        Get the tile as a numpy array in the source's native data type,
+        cropping and resampling it as needed.  If frames were requested, this
+        is a stack of the tile in each frame.
+
+        :returns: a numpy array.
+        """
+        with timing.stage('tile', source=self.source.name, level=self.level):
+            if not self.retile:
+                tiles = self._getNativeTiles(self.x, self.y)
+            else:
+                tiles = self._retileArray()
+        if self.crop and not self.retile:
+            tiles = [tileData[self.crop[1]:self.crop[3], self.crop[0]:self.crop[2]]
+                     for tileData in tiles]
+        if self.resample not in (False, None) and self.requestedScale:
+            with timing.stage('resample', source=self.source.name):
+                self['width'] = max(1, int(tiles[0].shape[1] / self.requestedScale))
+                self['height'] = max(1, int(tiles[0].shape[0] / self.requestedScale))
+                tiles = [_resizeArray(
+                    tileData, self['width'], self['height'],
+                    PIL.Image.LANCZOS if self.resample is True else self.resample)
+                    for tileData in tiles]
+        return numpy.stack(tiles) if self.frames is not None else tiles[0]
+
     def __getitem__(self, key, *args, **kwargs):
         """
         If this is the first time either the tile or format key is requested,
@@ -276,43 +793,57 @@ class LazyTileDict(dict):
 
         See the base dict class for function details.
         """
+        if (not self.loaded and key in self.deferredKeys and
+                (self.nativeDtype or self.frames is not None) and
+                TILE_FORMAT_NUMPY in (self.format or ())):
+            self.loaded = True
+            self['tile'] = self._nativeTile()
+            self['format'] = TILE_FORMAT_NUMPY
         if not self.loaded and key in self.deferredKeys:
             # Flag this immediately to avoid recursion if we refer to the
             # tile's own values.
             self.loaded = True
 
-            if not self.retile:
-                tileData = self.source.getTile(
-                    self.x, self.y, self.level,
-                    pilImageAllowed=True, sparseFallback=True, frame=self.frame)
-            else:
-                tileData = self._retileTile()
+            with timing.stage('tile', source=self.source.name, level=self.level):
+                if not self.retile:
+                    tileData = self.source.getTile(
+                        self.x, self.y, self.level,
+                        pilImageAllowed=True, sparseFallback=True, frame=self.frame)
+                else:
+                    tileData = self._retileTile()
             tileFormat = TILE_FORMAT_PIL
             # If the tile isn't in PIL format, and it is not in an image format
             # that is the same as a desired output format and encoding, convert
             # it to PIL format.
             if not isinstance(tileData, PIL.Image.Image):
-                pilData = PIL.Image.open(BytesIO(tileData))
-                if (self.format and TILE_FORMAT_IMAGE in self.format and
-                        pilData.format == self.encoding):
-                    tileFormat = TILE_FORMAT_IMAGE
-                else:
-                    tileData = pilData
+                with timing.stage('decode', source=self.source.name) as stage:
+                    stage.bytes = len(tileData)
+                    pilData = PIL.Image.open(BytesIO(tileData))
+                    if (self.format and TILE_FORMAT_IMAGE in self.format and
+                            pilData.format == self.encoding):
+                        tileFormat = TILE_FORMAT_IMAGE
+                    else:
+                        tileData = pilData
+                        if timing.timingEnabled():
+                            # PIL decodes lazily; attribute the time here
+                            pilData.load()
             else:
                 pilData = tileData
             if self.crop and not self.retile:
-                tileData = pilData.crop(self.crop)
+                with timing.stage('crop', source=self.source.name):
+                    tileData = pilData.crop(self.crop)
                 tileFormat = TILE_FORMAT_PIL
 
             # resample if needed
             if self.resample not in (False, None) and self.requestedScale:
-                self['width'] = max(1, int(
-                    tileData.size[0] / self.requestedScale))
-                self['height'] = max(1, int(
-                    tileData.size[1] / self.requestedScale))
-                tileData = tileData.resize(
-                    (self['width'], self['height']),
-                    resample=PIL.Image.LANCZOS if self.resample is True else self.resample)
+                with timing.stage('resample', source=self.source.name):
+                    self['width'] = max(1, int(
+                        tileData.size[0] / self.requestedScale))
+                    self['height'] = max(1, int(
+                        tileData.size[1] / self.requestedScale))
+                    tileData = tileData.resize(
+                        (self['width'], self['height']),
+                        resample=PIL.Image.LANCZOS if self.resample is True else self.resample)
 
             # Reformat the image if required
             if not self.alwaysAllowPIL:
@@ -323,8 +854,10 @@ class LazyTileDict(dict):
                     tileData = numpy.asarray(tileData)
                     tileFormat = TILE_FORMAT_NUMPY
                 elif TILE_FORMAT_IMAGE in self.format:
-                    tileData, mimeType = _encodeImage(
-                        tileData, **self.imageKwargs)
+                    with timing.stage('encode', source=self.source.name) as stage:
+                        tileData, mimeType = _encodeImage(
+                            tileData, **self.imageKwargs)
+                        stage.bytes = len(tileData)
                     tileFormat = TILE_FORMAT_IMAGE
                 if tileFormat not in self.format:
                     raise exceptions.TileSourceException(
@@ -349,6 +882,16 @@ class TileSource(object):
     mimeTypes = {
         None: SourcePriority.FALLBACK
     }
+    # magicBytes is a list of byte strings, one of which the start of every
+    # file this source can read begins with.  If None, any file might be
+    # readable.  notMagicBytes is a list of byte strings that files this
+    # source can read never begin with.  These are used by sniff to rule out
+    # sources before opening them.
+    magicBytes = None
+    notMagicBytes = None
+    # When computing statistics without a specified level, use the lowest
+    # resolution level that is at least this many pixels on its largest side.
+    statisticsSize = 2048
 
     def __init__(self, jpegQuality=95, jpegSubsampling=0,
                  encoding='JPEG', edge=False, tiffCompression='raw', *args,
@@ -359,7 +902,8 @@ class TileSource(object):
         :param jpegQuality: when serving jpegs, use this quality.
         :param jpegSubsampling: when serving jpegs, use this subsampling (0 is
             full chroma, 1 is half, 2 is quarter).
-        :param encoding: 'JPEG', 'PNG', or 'TIFF'.
+        :param encoding: 'JPEG', 'PNG', 'TIFF', 'WEBP', or another encoding
+            listed in TileOutputMimeTypes.
         :param edge: False to leave edge tiles whole, True or 'crop' to crop
             edge tiles, otherwise, an #rrggbb color to fill edges.
         :param tiffCompression: the compression format to use when encoding a
@@ -557,6 +1101,21 @@ class TileSource(object):
 
         return left, top, right, bottom
 
+    def _prefetchTiles(self, level, tiles, frame=None):
+        """
+        Called by the tile iterator before it yields a group of tiles that are
+        likely to be read.  Sources that can read the data of many tiles more
+        efficiently than one at a time can override this to read it in bulk,
+        typically keeping it in a PrefetchedTiles store until getTile uses it.
+        Tiles that are already in the tile cache are not included.  The base
+        class does nothing.
+
+        :param level: the level of the tiles.
+        :param tiles: a list of (x, y) tile indices.
+        :param frame: the frame of the tiles, if any.
+        """
+        return
+
     def _tileIteratorInfo(self, **kwargs):
         """
         Get information necessary to construct a tile iterator.
@@ -621,6 +1180,13 @@ class TileSource(object):
             y: the vertical overlap in pixels.
             edges: if True, then the edge tiles will exclude the overlap
                 distance.  If unset or False, the edge tiles are full size.
+        :param nativeDtype: if True and TILE_FORMAT_NUMPY is an allowed
+            format, tiles are numpy arrays in the source's native data type
+            (such as uint16 or float32) rather than 8-bit images.  Data is
+            only reduced to 8 bits if an image is encoded.
+        :param frames: if not None, a list of frame numbers.  Each tile is a
+            numpy array stacking the tile of each frame in the source's native
+            data type.  See getTileFrames.
         :param **kwargs: optional arguments.  Some options are encoding,
             jpegQuality, jpegSubsampling, tiffCompression, frame.
         :returns: a dictionary of information needed for the tile iterator.
@@ -769,7 +1335,7 @@ class TileSource(object):
                              'ymin': ymin, 'ymax': ymax})
 
         # Use RGB for JPEG, RGBA for PNG
-        mode = 'RGBA' if kwargs.get('encoding') in ('PNG', 'TIFF') else 'RGB'
+        mode = 'RGBA' if kwargs.get('encoding') in ('PNG', 'TIFF', 'WEBP') else 'RGB'
 
         info = {
             'region': {
@@ -793,6 +1359,8 @@ class TileSource(object):
             },
             'frame': kwargs.get('frame'),
             'format': kwargs.get('format', (TILE_FORMAT_NUMPY, )),
+            'nativeDtype': bool(kwargs.get('nativeDtype')),
+            'frames': list(kwargs['frames']) if kwargs.get('frames') is not None else None,
             'encoding': kwargs.get('encoding'),
             'requestedScale': requestedScale,
             'resample': resample,
@@ -802,6 +1370,30 @@ class TileSource(object):
         }
         return info
 
+    def _prefetchUncachedTiles(self, iterInfo, level, tiles):
+        """
+        Prefetch the tiles of a group that the tile iterator will get and that
+        are not already in the tile cache.
+
+        :param iterInfo: tile iterator information.  See _tileIteratorInfo.
+        :param level: the level of the tiles.
+        :param tiles: a list of (x, y) tile indices.
+        """
+        # Tiles of several frames are read with getTileFrames, which reads
+        # each tile's frames together instead.
+        if iterInfo.get('frames') is not None:
+            return
+        # The parameters LazyTileDict uses to get tiles
+        tileKwargs = {
+            'pilImageAllowed': True, 'sparseFallback': True, 'frame': iterInfo.get('frame')}
+        if (iterInfo.get('nativeDtype') and TILE_FORMAT_NUMPY in (
+                iterInfo.get('requestedFormat', iterInfo['format']) or ())):
+            tileKwargs['numpyAllowed'] = 'always'
+        tiles = [(x, y) for x, y in tiles
+                 if not methodcacheContains(self, x, y, level, **tileKwargs)]
+        if len(tiles) > 1:
+            self._prefetchTiles(level, tiles, iterInfo.get('frame'))
+
     def _tileIterator(self, iterInfo):
         """
         Given tile iterator information, iterate through the tiles.
@@ -894,6 +1486,10 @@ class TileSource(object):
                   tileSize['height'] != metadata['tileHeight'] or
                   tileOverlap['x'] or tileOverlap['y'])
         for y in range(ymin, ymax):
+            # Retiled tiles aren't the source's tiles, so they aren't prefetched
+            if xmax - xmin > 1 and not retile:
+                self._prefetchUncachedTiles(
+                    iterInfo, level, [(x, y) for x in range(xmin, xmax)])
             for x in range(xmin, xmax):
                 crop = None
                 posX = int(x * tileSize['width'] - tileOverlap['x'] // 2 +
@@ -936,6 +1532,8 @@ class TileSource(object):
                     'requestedScale': iterInfo['requestedScale'],
                     'retile': retile,
                     'metadata': metadata,
+                    'nativeDtype': iterInfo.get('nativeDtype'),
+                    'frames': iterInfo.get('frames'),
                     'source': self,
                 }, {
                     'x': posX + left,
@@ -1011,10 +1609,44 @@ class TileSource(object):
         # compatibility could be an issue.
         return False
 
-    def _outputTile(self, tile, tileEncoding, x, y, z, pilImageAllowed=False, **kwargs):
+    def _applyEdge(self, tile, contentWidth, contentHeight):
         """
-        Convert a tile from a PIL image or image in memory to the desired
-        encoding.
+        Crop or fill the part of a tile that is past the edge of the image,
+        based on the edge option of the source.
+
+        :param tile: the tile as a PIL image or a numpy array.
+        :param contentWidth: the width of the tile within the image.
+        :param contentHeight: the height of the tile within the image.
+        :returns: the adjusted tile.
+        """
+        if isinstance(tile, numpy.ndarray):
+            if self.edge in (True, 'crop'):
+                return tile[:contentHeight, :contentWidth]
+            color = _arrayFillColor(self.edge, tile)
+            if tile.ndim == 2:
+                color = color[0]
+            tile = tile.copy()
+            tile[:, contentWidth:] = color
+            tile[contentHeight:, :] = color
+            return tile
+        if self.edge in (True, 'crop'):
+            return tile.crop((0, 0, contentWidth, contentHeight))
+        color = PIL.ImageColor.getcolor(self.edge, tile.mode)
+        if contentWidth < self.tileWidth:
+            PIL.ImageDraw.Draw(tile).rectangle(
+                [(contentWidth, 0), (self.tileWidth, contentHeight)],
+                fill=color, outline=None)
+        if contentHeight < self.tileHeight:
+            PIL.ImageDraw.Draw(tile).rectangle(
+                [(0, contentHeight), (self.tileWidth, self.tileHeight)],
+                fill=color, outline=None)
+        return tile
+
+    def _outputTile(self, tile, tileEncoding, x, y, z, pilImageAllowed=False,
+                    numpyAllowed=False, **kwargs):
+        """
+        Convert a tile from a PIL image, a numpy array, or image in memory to
+        the desired encoding.
 
         :param tile: the tile to convert.
         :param tileEncoding: the current tile encoding.
@@ -1022,7 +1654,11 @@ class TileSource(object):
         :param y: tile y value.  Used for cropping or edge adjustment.
         :param z: tile z (level) value.  Used for cropping or edge adjustment.
         :param pilImageAllowed: True if a PIL image may be returned.
-        :returns: either a PIL image or a memory object with an image file.
+        :param numpyAllowed: True if a numpy array may be returned, or
+            'always' to always return a numpy array.  Sources only return data
+            in their native data type when this is 'always'.
+        :returns: either a numpy array, a PIL image, or a memory object with an
+            image file.
         """
         isEdge = False
         if self.edge:
@@ -1031,27 +1667,24 @@ class TileSource(object):
             maxX = (x + 1) * self.tileWidth
             maxY = (y + 1) * self.tileHeight
             isEdge = maxX > sizeX or maxY > sizeY
-        if tileEncoding != TILE_FORMAT_PIL:
-            if tileEncoding == self.encoding and not isEdge:
+            contentWidth = min(self.tileWidth, sizeX - (maxX - self.tileWidth))
+            contentHeight = min(self.tileHeight, sizeY - (maxY - self.tileHeight))
+        if tileEncoding == TILE_FORMAT_NUMPY and (not numpyAllowed or (
+                numpyAllowed != 'always' and tile.dtype != numpy.uint8)):
+            tile = _imageFromArray(tile, self._nativeBits())
+        elif tileEncoding not in (TILE_FORMAT_PIL, TILE_FORMAT_NUMPY):
+            if tileEncoding == self.encoding and not isEdge and numpyAllowed != 'always':
                 return tile
-            tile = PIL.Image.open(BytesIO(tile))
+            with timing.stage('decode', source=self.name, x=x, y=y, z=z) as stage:
+                stage.bytes = len(tile)
+                tile = PIL.Image.open(BytesIO(tile))
         if isEdge:
-            contentWidth = min(self.tileWidth,
-                               sizeX - (maxX - self.tileWidth))
-            contentHeight = min(self.tileHeight,
-                                sizeY - (maxY - self.tileHeight))
-            if self.edge in (True, 'crop'):
-                tile = tile.crop((0, 0, contentWidth, contentHeight))
-            else:
-                color = PIL.ImageColor.getcolor(self.edge, tile.mode)
-                if contentWidth < self.tileWidth:
-                    PIL.ImageDraw.Draw(tile).rectangle(
-                        [(contentWidth, 0), (self.tileWidth, contentHeight)],
-                        fill=color, outline=None)
-                if contentHeight < self.tileHeight:
-                    PIL.ImageDraw.Draw(tile).rectangle(
-                        [(0, contentHeight), (self.tileWidth, self.tileHeight)],
-                        fill=color, outline=None)
+            with timing.stage('edge', source=self.name, x=x, y=y, z=z):
+                tile = self._applyEdge(tile, contentWidth, contentHeight)
+        if isinstance(tile, numpy.ndarray):
+            return tile
+        if numpyAllowed == 'always':
+            return numpy.asarray(tile)
         if pilImageAllowed:
             return tile
         encoding = TileOutputPILFormat.get(self.encoding, self.encoding)
@@ -1062,15 +1695,24 @@ class TileSource(object):
         if hasattr(tile, 'fp') and self._pilFormatMatches(tile):
             tile.fp.seek(0)
             return tile.fp.read()
-        output = BytesIO()
-        params = {}
-        if encoding == 'JPEG':
-            params['quality'] = self.jpegQuality
-            params['subsampling'] = self.jpegSubsampling
-        elif encoding == 'TIFF':
-            params['compression'] = self.tiffCompression
-        tile.save(output, encoding, **params)
-        return output.getvalue()
+        with timing.stage('encode', source=self.name, x=x, y=y, z=z) as stage:
+            tile = _encodeTile(
+                tile, encoding, jpegQuality=self.jpegQuality,
+                jpegSubsampling=self.jpegSubsampling,
+                tiffCompression=self.tiffCompression)
+            stage.bytes = len(tile)
+        return tile
+
+    def _nativeBits(self):
+        """
+        Get the number of bits used by the source's integer data when it is
+        stored in a larger data type, such as 12-bit samples in 16-bit
+        integers.  This is used when native data is reduced to 8 bits.
+
+        :returns: the number of bits or None to use all of the bits of the
+            data type.
+        """
+        return None
 
     def _getAssociatedImage(self, imageKey):
         """
@@ -1091,6 +1733,31 @@ class TileSource(object):
         """
         return False
 
+    @classmethod
+    def sniff(cls, header):
+        """
+        Cheaply check if the start of a file could be read by this class.
+        This is done before any more expensive attempt to open the file.
+
+        :param header: the first bytes of the file.
+        :returns: False if this class definitely cannot read the file.  True
+            if it might be able to.
+        """
+        return sniffMagicBytes(header, cls.magicBytes, cls.notMagicBytes)
+
+    @classmethod
+    def openIfReadable(cls, *args, **kwargs):
+        """
+        Open the input if this class can read it.  This takes the same
+        parameters as __init__.
+
+        :returns: a tile source instance or None if this class cannot read the
+            input.
+        """
+        if cls.canRead(*args, **kwargs):
+            return cls(*args, **kwargs)
+        return None
+
     def getMetadata(self):
         mag = self.getNativeMagnification()
         return {
@@ -1105,9 +1772,80 @@ class TileSource(object):
         }
 
     @methodcache()
-    def getTile(self, x, y, z, pilImageAllowed=False, sparseFallback=False, frame=None):
+    def getTile(self, x, y, z, pilImageAllowed=False, numpyAllowed=False,
+                sparseFallback=False, frame=None):
         raise NotImplementedError()
 
+    def getTileFrames(self, x, y, z, frames=None, sparseFallback=False, **kwargs):
+        """
+        Get the same tile from several frames as a single numpy array in the
+        source's native data type.
+
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param z: the level of the tile.
+        :param frames: a list of frame numbers.  If None, all frames are used.
+        :param sparseFallback: if True and the tile is missing in a level, get
+            it from a lower resolution level.
+        :returns: a numpy array of shape (frames, height, width[, bands]).
+        """
+        if frames is None:
+            frames = list(range(max(1, len(self.getMetadata().get('frames') or []))))
+        return numpy.stack([_arrayFromTile(self.getTile(
+            x, y, z, pilImageAllowed=True, numpyAllowed='always',
+            sparseFallback=sparseFallback, frame=frame, **kwargs)) for frame in frames])
+
+    def getCompositeTile(self, x, y, z, style, pilImageAllowed=False,
+                         numpyAllowed=False, sparseFallback=False, **kwargs):
+        """
+        Get a tile that blends several frames into one RGB image, such as the
+        channels of a fluorescence image.  Composite tiles are cached based on
+        the style.
+
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param z: the level of the tile.
+        :param style: a dictionary or a JSON string of a dictionary with
+            bands: a list of dictionaries, one per frame to blend.  Each has
+                frame: the frame number.
+                band: for frames with more than one sample per pixel, the
+                    sample to use.  Defaults to 0.
+                palette: the color of the band, such as '#ff0000'.  Defaults
+                    to white.
+                min, max: the data values mapped to black and to the full
+                    color.  Default to the range of the data type, or [0, 1]
+                    for floating point data.
+            composite: 'lighten' (the default) to keep the brightest value of
+                each color channel, or 'add' to sum the bands.
+        :param pilImageAllowed: True if a PIL image may be returned.
+        :param numpyAllowed: True if a numpy array may be returned.
+        :param sparseFallback: if True and the tile is missing in a level, get
+            it from a lower resolution level.
+        :returns: the encoded tile, a PIL image, or a numpy array.
+        """
+        style = json.dumps(_parseCompositeStyle(style), sort_keys=True)
+        return self._getCompositeTile(
+            x, y, z, style, pilImageAllowed=pilImageAllowed, numpyAllowed=numpyAllowed,
+            sparseFallback=sparseFallback, **kwargs)
+
+    @methodcache()
+    def _getCompositeTile(self, x, y, z, style, pilImageAllowed=False,
+                          numpyAllowed=False, sparseFallback=False, **kwargs):
+        """
+        Get a composite tile.  See getCompositeTile.
+
+        :param style: the style as a JSON string with sorted keys, so that it
+            can be part of the cache key.
+        """
+        style = json.loads(style)
+        stack = self.getTileFrames(
+            x, y, z, frames=[entry['frame'] for entry in style['bands']],
+            sparseFallback=sparseFallback, **kwargs)
+        with timing.stage('composite', source=self.name, bands=len(style['bands'])):
+            tile = _compositeFrames(stack, style)
+        return self._outputTile(tile, TILE_FORMAT_NUMPY, x, y, z, pilImageAllowed,
+                                numpyAllowed, **kwargs)
+
     def getTileMimeType(self):
         return TileOutputMimeTypes.get(self.encoding, 'image/jpeg')
 
@@ -1272,15 +2010,36 @@ class TileSource(object):
             TILE_FORMAT_IMAGE).  If TILE_FORMAT_IMAGE, encoding may be
             specified.
         :param **kwargs: optional arguments.  Some options are region, output,
-            encoding, jpegQuality, jpegSubsampling, tiffCompression, fill.  See
-            tileIterator.
+            encoding, jpegQuality, jpegSubsampling, tiffCompression, fill, and
+            nativeDtype.  See tileIterator.  If nativeDtype is True and the
+            format is TILE_FORMAT_NUMPY, the region is a numpy array in the
+            source's native data type.  Otherwise, if nativeDtype is True,
+            the region is assembled and resampled in the native data type and
+            only reduced to 8 bits per sample when it is encoded.  If frames
+            is a list of frame numbers, the format must be TILE_FORMAT_NUMPY
+            and the region is a numpy array of shape (frames, height,
+            width[, bands]) in the source's native data type.
         :returns: regionData, formatOrRegionMime: the image data and either the
             mime type, if the format is TILE_FORMAT_IMAGE, or the format.
         """
+        if not isinstance(format, tuple):
+            format = (format, )
+        _checkFramesFormat(format, kwargs.get('frames'))
         if 'tile_position' in kwargs:
             kwargs = kwargs.copy()
             kwargs.pop('tile_position', None)
         iterInfo = self._tileIteratorInfo(**kwargs)
+        if iterInfo is None and kwargs.get('frames') is not None:
+            return numpy.zeros((len(kwargs['frames']), 0, 0), dtype=numpy.uint8), TILE_FORMAT_NUMPY
+        if (iterInfo is not None and (iterInfo['nativeDtype'] or iterInfo['frames'] is not None) and
+                TILE_FORMAT_PIL not in format):
+            region = self._getRegionArray(iterInfo, **kwargs)
+            if TILE_FORMAT_NUMPY in format:
+                return region, TILE_FORMAT_NUMPY
+            # Only reduce the data to 8 bits per sample when it is encoded
+            with timing.stage('encode', source=self.name):
+                return _encodeImage(
+                    _imageFromArray(region, self._nativeBits()), format=format, **kwargs)
         if iterInfo is None:
             # In PIL 3.4.2, you can't directly create a 0 sized image.  It was
             # easier to do this before:
@@ -1294,6 +2053,9 @@ class TileSource(object):
         mode = iterInfo['mode']
         outWidth = iterInfo['output']['width']
         outHeight = iterInfo['output']['height']
+        nativeTile = self._nativeTileForRegion(iterInfo, format, **kwargs)
+        if nativeTile is not None:
+            return nativeTile, TileOutputMimeTypes[self.encoding]
         # We can construct an image using PIL.Image.new:
         #   image = PIL.Image.new('RGB', (regionWidth, regionHeight))
         # but, for large images (larger than 4 Megapixels), PIL allocates one
@@ -1315,20 +2077,140 @@ class TileSource(object):
         for tile in self._tileIterator(iterInfo):
             # Add each tile to the image.  PIL crops these if they are off the
             # edge.
-            image.paste(tile['tile'], (tile['x'] - left, tile['y'] - top))
+            tileImage = tile['tile']
+            with timing.stage('paste', source=self.name):
+                image.paste(tileImage, (tile['x'] - left, tile['y'] - top))
         # Scale if we need to
         outWidth = int(math.floor(outWidth))
         outHeight = int(math.floor(outHeight))
         if outWidth != regionWidth or outHeight != regionHeight:
-            image = image.resize(
-                (outWidth, outHeight),
-                PIL.Image.BICUBIC if outWidth > regionWidth else
-                PIL.Image.LANCZOS)
+            with timing.stage('resample', source=self.name):
+                image = image.resize(
+                    (outWidth, outHeight),
+                    PIL.Image.BICUBIC if outWidth > regionWidth else
+                    PIL.Image.LANCZOS)
         maxWidth = kwargs.get('output', {}).get('maxWidth')
         maxHeight = kwargs.get('output', {}).get('maxHeight')
         if kwargs.get('fill') and maxWidth and maxHeight:
             image = _letterboxImage(image, maxWidth, maxHeight, kwargs['fill'])
-        return _encodeImage(image, format=format, **kwargs)
+        with timing.stage('encode', source=self.name) as stage:
+            result = _encodeImage(image, format=format, **kwargs)
+            if isinstance(result[0], six.binary_type):
+                stage.bytes = len(result[0])
+        return result
+
+    def _getRegionArray(self, iterInfo, **kwargs):
+        """
+        Get a region as a numpy array in the source's native data type.  See
+        getRegion.
+
+        :param iterInfo: tile iterator information.  See _tileIteratorInfo.
+        :param **kwargs: the arguments passed to getRegion.
+        :returns: a numpy array.  If frames were requested, this is a stack of
+            the region of each frame.
+        """
+        regionWidth = iterInfo['region']['width']
+        regionHeight = iterInfo['region']['height']
+        top = iterInfo['region']['top']
+        left = iterInfo['region']['left']
+        frames = iterInfo.get('frames')
+        regions = None
+        for tile in self._tileIterator(iterInfo):
+            tiles = list(tile['tile']) if frames is not None else [tile['tile']]
+            if regions is None:
+                try:
+                    regions = [numpy.zeros(
+                        (regionHeight, regionWidth) + tileData.shape[2:], dtype=tileData.dtype)
+                        for tileData in tiles]
+                except MemoryError:
+                    raise exceptions.TileSourceException(
+                        'Insufficient memory to get region of %d x %d pixels.' % (
+                            regionWidth, regionHeight))
+            with timing.stage('paste', source=self.name):
+                for region, tileData in zip(regions, tiles):
+                    _pasteArray(region, tileData, tile['x'] - left, tile['y'] - top)
+        if regions is None:
+            regions = [numpy.zeros((regionHeight, regionWidth), dtype=numpy.uint8)
+                       for _ in range(len(frames) if frames is not None else 1)]
+        outWidth = int(math.floor(iterInfo['output']['width']))
+        outHeight = int(math.floor(iterInfo['output']['height']))
+        if outWidth != regionWidth or outHeight != regionHeight:
+            with timing.stage('resample', source=self.name):
+                regions = [_resizeArray(
+                    region, outWidth, outHeight,
+                    PIL.Image.BICUBIC if outWidth > regionWidth else PIL.Image.LANCZOS)
+                    for region in regions]
+        maxWidth = kwargs.get('output', {}).get('maxWidth')
+        maxHeight = kwargs.get('output', {}).get('maxHeight')
+        if kwargs.get('fill') and maxWidth and maxHeight:
+            regions = [_letterboxArray(region, maxWidth, maxHeight, kwargs['fill'])
+                       for region in regions]
+        return numpy.stack(regions) if frames is not None else regions[0]
+
+    def _nativeTileForRegion(self, iterInfo, format, **kwargs):
+        """
+        If a region request maps exactly onto a single native tile and the
+        requested encoding matches what the tile source already has stored,
+        get the encoded tile without decoding and reencoding it.
+
+        :param iterInfo: tile iterator information.  See _tileIteratorInfo.
+        :param format: the desired format or a tuple of allowed formats.
+        :param **kwargs: the arguments passed to getRegion.
+        :returns: the encoded tile data or None if the region cannot be served
+            directly from a native tile.
+        """
+        if not isinstance(format, tuple):
+            format = (format, )
+        # _encodeImage prefers PIL and numpy formats over an encoded image
+        if (TILE_FORMAT_IMAGE not in format or TILE_FORMAT_PIL in format or
+                TILE_FORMAT_NUMPY in format):
+            return None
+        # JFIF is excluded, since it requests that the image always be
+        # reencoded to ensure a common color space.
+        encoding = kwargs.get('encoding', 'JPEG')
+        if (encoding != self.encoding or encoding not in ('JPEG', 'PNG') or
+                int(kwargs.get('jpegQuality', 95)) != self.jpegQuality or
+                int(kwargs.get('jpegSubsampling', 0)) != self.jpegSubsampling):
+            return None
+        region = iterInfo['region']
+        metadata = iterInfo['metadata']
+        tileWidth = metadata['tileWidth']
+        tileHeight = metadata['tileHeight']
+        if (region['width'] != tileWidth or region['height'] != tileHeight or
+                int(math.floor(iterInfo['output']['width'])) != tileWidth or
+                int(math.floor(iterInfo['output']['height'])) != tileHeight or
+                region['left'] % tileWidth or region['top'] % tileHeight or
+                iterInfo['tile_size']['width'] != tileWidth or
+                iterInfo['tile_size']['height'] != tileHeight or
+                iterInfo['tile_overlap']['x'] or iterInfo['tile_overlap']['y'] or
+                iterInfo['xmax'] - iterInfo['xmin'] != 1 or
+                iterInfo['ymax'] - iterInfo['ymin'] != 1):
+            return None
+        maxWidth = kwargs.get('output', {}).get('maxWidth')
+        maxHeight = kwargs.get('output', {}).get('maxHeight')
+        if (kwargs.get('fill') and maxWidth and maxHeight and
+                (maxWidth > tileWidth or maxHeight > tileHeight)):
+            return None
+        # Use the same parameters as the tile iterator so that the tile cache
+        # is shared.
+        tileData = self.getTile(
+            iterInfo['xmin'], iterInfo['ymin'], iterInfo['level'],
+            pilImageAllowed=True, sparseFallback=True, frame=iterInfo['frame'])
+        if isinstance(tileData, PIL.Image.Image):
+            image = tileData
+            if not hasattr(image, 'fp') or image.fp is None:
+                return None
+        else:
+            image = PIL.Image.open(BytesIO(tileData))
+        if (image.size != (tileWidth, tileHeight) or
+                image.mode not in ('L', 'LA', 'RGB', 'RGBA') or
+                (image.format == 'JPEG' and image.mode not in ('L', 'RGB')) or
+                not self._pilFormatMatches(image)):
+            return None
+        if image is tileData:
+            image.fp.seek(0)
+            return image.fp.read()
+        return tileData
 
     def getRegionAtAnotherScale(self, sourceRegion, sourceScale=None,
                                 targetScale=None, targetUnits=None, **kwargs):
@@ -1582,11 +2464,20 @@ class TileSource(object):
             JPEG.
         :param tiffCompression: the compression format when encoding a TIFF.
             This is usually 'raw', 'tiff_lzw', 'jpeg', or 'tiff_adobe_deflate'.
+        :param nativeDtype: if True and TILE_FORMAT_NUMPY is an allowed
+            format, tiles are numpy arrays in the source's native data type
+            (such as uint16 or float32) rather than 8-bit images.  Data is
+            only reduced to 8 bits if an image is encoded.
+        :param frames: if not None, a list of frame numbers.  Each tile is a
+            numpy array of shape (frames, height, width[, bands]) in the
+            source's native data type, and the format must include
+            TILE_FORMAT_NUMPY.  See getTileFrames.
         :param **kwargs: optional arguments.
         :yields: an iterator that returns a dictionary as listed above.
         """
         if not isinstance(format, tuple):
             format = (format, )
+        _checkFramesFormat(format, kwargs.get('frames'))
         if TILE_FORMAT_IMAGE in format:
             encoding = kwargs.get('encoding')
             if encoding not in TileOutputMimeTypes:
@@ -1597,6 +2488,8 @@ class TileSource(object):
                                           **kwargs)
         if not iterInfo:
             return
+        # The tiles are read in the requested format, not the iteration format
+        iterInfo['requestedFormat'] = format
         # check if the desired scale is different from the actual scale and
         # resampling is needed.  Ignore small scale differences.
         if (resample in (False, None) or
@@ -1719,6 +2612,268 @@ class TileSource(object):
                 pixel.update(dict(zip(img.mode.lower(), img.load()[0, 0])))
         return pixel
 
+    def _pixelsLevel(self, level=None, scale=None):
+        """
+        Determine the level used for sampling pixels.
+
+        :param level: a tile level or None.
+        :param scale: if level is None, a dictionary of magnification, mm_x,
+            and/or mm_y used to pick a level.  If both level and scale are None,
+            the maximum resolution level is used.
+        :returns: the tile level with actual data.
+        """
+        if level is None and scale:
+            level = self.getLevelForMagnification(**scale)
+        if level is None:
+            level = self.levels - 1
+        return self.getPreferredLevel(level)
+
+    def _pixelsToTiles(self, points, level):
+        """
+        Convert points in base pixels to pixel coordinates at a level and group
+        them by tile.
+
+        :param points: a list or array of (x, y) points in base pixels.
+        :param level: the tile level.
+        :returns: px, py, tiles: px and py are numpy arrays of the integer
+            pixel coordinates at the level.  tiles is a list of (tx, ty,
+            indices), where indices is an array of the indices of the points
+            in tile (tx, ty).  Points outside of the image are not included in
+            any tile.
+        """
+        points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+        factor = 2.0 ** (self.levels - 1 - level)
+        px = numpy.floor(points[:, 0] / factor).astype(int)
+        py = numpy.floor(points[:, 1] / factor).astype(int)
+        valid = numpy.nonzero(
+            (points[:, 0] >= 0) & (points[:, 0] < self.sizeX) &
+            (points[:, 1] >= 0) & (points[:, 1] < self.sizeY))[0]
+        if not len(valid):
+            return px, py, []
+        tx = px[valid] // self.tileWidth
+        ty = py[valid] // self.tileHeight
+        # Sort by tile so that each tile is fetched once and the points in it
+        # are a contiguous block
+        tileKey = ty * (int(math.ceil(float(self.sizeX) / factor / self.tileWidth)) + 1) + tx
+        order = numpy.argsort(tileKey, kind='mergesort')
+        tileKey = tileKey[order]
+        starts = numpy.concatenate((
+            [0], numpy.nonzero(numpy.diff(tileKey))[0] + 1, [len(tileKey)]))
+        tiles = []
+        for idx in range(len(starts) - 1):
+            indices = valid[order[starts[idx]:starts[idx + 1]]]
+            tiles.append((int(tx[order[starts[idx]]]), int(ty[order[starts[idx]]]), indices))
+        return px, py, tiles
+
+    def _tileAsArray(self, tile):
+        """
+        Convert a tile to a three-dimensional uint8 numpy array.
+
+        :param tile: a tile as returned from getTile with pilImageAllowed.
+        :returns: channels, array: channels is a string of the lowercase
+            channel names (one of 'l', 'la', 'rgb', or 'rgba').  array is a
+            numpy array of shape (height, width, len(channels)).
+        """
+        if not isinstance(tile, PIL.Image.Image):
+            tile = PIL.Image.open(BytesIO(tile))
+        if tile.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+            tile = tile.convert('RGBA' if 'A' in tile.mode else 'RGB')
+        channels = tile.mode.lower()
+        tile = numpy.asarray(tile)
+        if len(tile.shape) == 2:
+            tile = tile[:, :, numpy.newaxis]
+        return channels, tile
+
+    def getPixels(self, points, level=None, scale=None, frame=None):
+        """
+        Get the values of many pixels from the current tile source.  Points
+        are grouped by tile so that each tile is fetched and decoded once.
+
+        :param points: a list of (x, y) points in base pixels (maximum
+            resolution pixels).
+        :param level: the tile level to sample.  If None, scale is used.
+        :param scale: a dictionary of magnification, mm_x, and/or mm_y used to
+            pick the level to sample.  If neither level nor scale is
+            specified, the maximum resolution level is used.
+        :param frame: the frame to sample, if the source has frames.
+        :returns: a list with one dictionary per point.  Each contains the
+            value of the pixel for each channel on a scale of [0-255],
+            including alpha, if available, as with getPixel.  Points outside of
+            the image have empty dictionaries.
+        """
+        level = self._pixelsLevel(level, scale)
+        px, py, tiles = self._pixelsToTiles(points, level)
+        pixels = [{} for _ in range(len(px))]
+        for tx, ty, indices in tiles:
+            try:
+                tile = self.getTile(
+                    tx, ty, level, pilImageAllowed=True, sparseFallback=True,
+                    frame=frame)
+            except exceptions.TileSourceException:
+                continue
+            channels, tile = self._tileAsArray(tile)
+            ix = px[indices] - tx * self.tileWidth
+            iy = py[indices] - ty * self.tileHeight
+            # Tiles may be smaller than the nominal tile size at the edges
+            inTile = (ix < tile.shape[1]) & (iy < tile.shape[0])
+            values = tile[iy[inTile], ix[inTile]].tolist()
+            for idx, value in zip(indices[inTile], values):
+                pixels[idx] = dict(zip(channels, value))
+        return pixels
+
+    def _statisticsLevel(self, level=None, sample=None):
+        """
+        Determine the level used to compute statistics.
+
+        :param level: a tile level or None.
+        :param sample: if level is None and this is set, the maximum
+            resolution level is used.  Otherwise, the lowest resolution level
+            that is at least statisticsSize pixels on its largest side is used.
+        :returns: the tile level with actual data.
+        """
+        if level is None and sample:
+            level = self.levels - 1
+        if level is None:
+            level = 0
+            while (level < self.levels - 1 and max(self.sizeX, self.sizeY) /
+                    2.0 ** (self.levels - 1 - level) < self.statisticsSize):
+                level += 1
+        return self.getPreferredLevel(max(0, min(level, self.levels - 1)))
+
+    def _tileHistograms(self, tx, ty, level, frame):
+        """
+        Compute a 256-bin histogram of each channel of a tile.
+
+        :param tx: the tile x value.
+        :param ty: the tile y value.
+        :param level: the tile level.
+        :param frame: the frame, if the source has frames.
+        :returns: channels, counts: channels is a string of lowercase channel
+            names and counts is an integer numpy array of shape
+            (len(channels), 256).  None if the tile cannot be read.
+        """
+        try:
+            tile = self.getTile(
+                tx, ty, level, pilImageAllowed=True, sparseFallback=True,
+                frame=frame)
+        except exceptions.TileSourceException:
+            return None
+        channels, tile = self._tileAsArray(tile)
+        # Edge tiles may be padded past the edge of the image
+        scale = 2.0 ** (self.levels - 1 - level)
+        width = min(tile.shape[1], int(math.ceil(
+            self.sizeX / scale)) - tx * self.tileWidth)
+        height = min(tile.shape[0], int(math.ceil(
+            self.sizeY / scale)) - ty * self.tileHeight)
+        tile = tile[:max(0, height), :max(0, width)].reshape(-1, len(channels))
+        # Offsetting each channel into its own block of 256 lets a single
+        # bincount compute all of the histograms.
+        offsets = numpy.arange(len(channels)) * 256
+        counts = numpy.bincount(
+            (tile.astype(numpy.intp) + offsets).ravel(),
+            minlength=256 * len(channels)).reshape(len(channels), 256)
+        return channels, counts
+
+    @methodcache()
+    def getStatistics(self, level=None, sample=None, bins=256, frame=None,
+                      threads=None):
+        """
+        Compute per-channel statistics and histograms of the image.  Tiles are
+        read at a single level, either all of them or a random sample.
+
+        :param level: the tile level to use.  If None and sample is not set,
+            the lowest resolution level that is at least statisticsSize pixels
+            on its largest side is used.  If None and sample is set, the
+            maximum resolution level is used.
+        :param sample: if set, the number of tiles to sample at random from
+            the level.  The same tiles are picked on each call.
+        :param bins: the number of histogram bins spanning [0-256).
+        :param frame: the frame to use, if the source has frames.
+        :param threads: if more than 1, read and process tiles in parallel
+            using this many threads.
+        :returns: a dictionary with level, tiles (the number of tiles used),
+            pixels (the number of pixels used), and channels, a list with one
+            dictionary per channel with channel (the channel name), min, max,
+            mean, stdev, percentiles (a dictionary of values keyed by the
+            percentile as a string), histogram (a list of counts), and binEdges
+            (a list of bins + 1 values).  Channel values are on a scale of
+            [0-255].
+        """
+        bins = int(bins)
+        if bins < 1 or bins > 256:
+            raise ValueError('bins must be between 1 and 256.')
+        level = self._statisticsLevel(level, sample)
+        scale = 2.0 ** (self.levels - 1 - level)
+        tilesX = int(math.ceil(self.sizeX / scale / self.tileWidth))
+        tilesY = int(math.ceil(self.sizeY / scale / self.tileHeight))
+        tiles = [(tx, ty) for ty in range(tilesY) for tx in range(tilesX)]
+        if sample and int(sample) < len(tiles):
+            chosen = numpy.random.RandomState(0).choice(
+                len(tiles), int(sample), replace=False)
+            tiles = [tiles[idx] for idx in sorted(chosen)]
+
+        def histograms(entry):
+            return self._tileHistograms(entry[0], entry[1], level, frame)
+
+        if threads and int(threads) > 1 and len(tiles) > 1:
+            pool = ThreadPool(min(int(threads), len(tiles)))
+            try:
+                results = pool.map(histograms, tiles)
+            finally:
+                pool.close()
+        else:
+            results = [histograms(entry) for entry in tiles]
+        channels = None
+        counts = None
+        used = 0
+        for result in results:
+            if result is None:
+                continue
+            tileChannels, tileCounts = result
+            # Sources may return a mix of modes (for instance, a sparse
+            # fallback may lack an alpha channel).  Use the widest one.
+            if counts is None:
+                channels, counts = tileChannels, tileCounts.copy()
+            elif len(tileChannels) > len(channels):
+                tileCounts = tileCounts.copy()
+                tileCounts[:len(channels)] += counts
+                channels, counts = tileChannels, tileCounts
+            else:
+                counts[:len(tileChannels)] += tileCounts
+            used += 1
+        stats = {
+            'level': level,
+            'tiles': used,
+            'pixels': int(counts[0].sum()) if counts is not None else 0,
+            'channels': [],
+        }
+        if not stats['pixels']:
+            return stats
+        values = numpy.arange(256, dtype=float)
+        binIndex = numpy.arange(256) * bins // 256
+        binEdges = [idx * 256.0 / bins for idx in range(bins + 1)]
+        for channel, channelCounts in zip(channels, counts):
+            total = float(channelCounts.sum())
+            mean = float((channelCounts * values).sum() / total)
+            variance = float((channelCounts * (values - mean) ** 2).sum() / total)
+            nonzero = numpy.nonzero(channelCounts)[0]
+            cumulative = numpy.cumsum(channelCounts)
+            stats['channels'].append({
+                'channel': channel,
+                'min': int(nonzero[0]),
+                'max': int(nonzero[-1]),
+                'mean': mean,
+                'stdev': math.sqrt(variance),
+                'percentiles': {
+                    str(pct): int(numpy.searchsorted(cumulative, total * pct / 100.0))
+                    for pct in (1, 5, 25, 50, 75, 95, 99)},
+                'histogram': numpy.bincount(
+                    binIndex, weights=channelCounts,
+                    minlength=bins).astype(int).tolist(),
+                'binEdges': binEdges,
+            })
+        return stats
+
 
 class FileTileSource(TileSource):
 
@@ -1756,8 +2911,19 @@ class FileTileSource(TileSource):
         :returns: True if this class can read the input.  False if it
                   cannot.
         """
+        return cls.openIfReadable(path, *args, **kwargs) is not None
+
+    @classmethod
+    def openIfReadable(cls, path, *args, **kwargs):
+        """
+        Open the input if this class can read it.  Since checking if a file is
+        readable requires opening it, this keeps the opened instance rather
+        than opening the file again.
+
+        :returns: a tile source instance or None if this class cannot read the
+            input.
+        """
         try:
-            cls(path, *args, **kwargs)
-            return True
+            return cls(path, *args, **kwargs)
         except exceptions.TileSourceException:
-            return False
+            return None
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+"""
+The attributes of known tile sources that are needed to pick which sources
+might read a file.  Sources listed here are registered without importing them,
+and are only imported when they are tried for a file.  Importing some sources
+pulls in large libraries (GDAL, mapnik, OpenSlide, glymur, libtiff), so a
+process that only reads one format only pays for that format.
+
+Each entry is keyed by the entry point group and then the entry point name.
+The values are the module the entry point must refer to and the class
+attributes of the source: name, extensions, mimeTypes, and, optionally,
+magicBytes and notMagicBytes.  Sources with entry points that are not listed
+are imported when the sources are loaded.  These values must
+match the source classes.
+"""
+
+from ..constants import SourcePriority
+
+
+_tiffMagicBytes = [b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+']
+
+SourceManifest = {
+    'large_image.source': {
+        'mapnik': {
+            'module': 'large_image_source_mapnik',
+            'name': 'mapnikfile',
+            'extensions': {
+                None: SourcePriority.MEDIUM,
+                'nc': SourcePriority.PREFERRED,
+                'ntf': SourcePriority.PREFERRED,
+                'nitf': SourcePriority.PREFERRED,
+                'tif': SourcePriority.LOW,
+                'tiff': SourcePriority.LOW,
+                'vrt': SourcePriority.PREFERRED,
+            },
+            'mimeTypes': {
+                None: SourcePriority.FALLBACK,
+                'image/geotiff': SourcePriority.PREFERRED,
+                'image/tiff': SourcePriority.LOW,
+                'image/x-tiff': SourcePriority.LOW,
+            },
+        },
+        'ometiff': {
+            'module': 'large_image_source_ometiff',
+            'name': 'ometifffile',
+            'extensions': {
+                None: SourcePriority.LOW,
+                'tif': SourcePriority.MEDIUM,
+                'tiff': SourcePriority.MEDIUM,
+                'ome': SourcePriority.PREFERRED,
+            },
+            'mimeTypes': {
+                None: SourcePriority.FALLBACK,
+                'image/tiff': SourcePriority.HIGH,
+                'image/x-tiff': SourcePriority.HIGH,
+                'image/x-ptif': SourcePriority.PREFERRED,
+            },
+            'magicBytes': _tiffMagicBytes,
+        },
+        'openjpeg': {
+            'module': 'large_image_source_openjpeg',
+            'name': 'openjpegfile',
+            'extensions': {
+                None: SourcePriority.MEDIUM,
+                'jp2': SourcePriority.PREFERRED,
+                'jpf': SourcePriority.PREFERRED,
+                'j2k': SourcePriority.PREFERRED,
+                'jpx': SourcePriority.PREFERRED,
+            },
+            'mimeTypes': {
+                None: SourcePriority.FALLBACK,
+                'image/jp2': SourcePriority.PREFERRED,
+                'image/jpx': SourcePriority.PREFERRED,
+            },
+            'magicBytes': [b'\x00\x00\x00\x0cjP  \r\n\x87\n', b'\xff\x4f\xff\x51'],
+        },
+        'openslide': {
+            'module': 'large_image_source_openslide',
+            'name': 'svsfile',
+            'extensions': {
+                None: SourcePriority.MEDIUM,
+                'bif': SourcePriority.LOW,
+                'mrxs': SourcePriority.PREFERRED,
+                'ndpi': SourcePriority.PREFERRED,
+                'scn': SourcePriority.LOW,
+                'svs': SourcePriority.PREFERRED,
+                'svslide': SourcePriority.PREFERRED,
+                'tif': SourcePriority.MEDIUM,
+                'tiff': SourcePriority.MEDIUM,
+                'vms': SourcePriority.HIGH,
+                'vmu': SourcePriority.HIGH,
+            },
+            'mimeTypes': {
+                None: SourcePriority.FALLBACK,
+                'image/mirax': SourcePriority.PREFERRED,
+                'image/tiff': SourcePriority.MEDIUM,
+                'image/x-tiff': SourcePriority.MEDIUM,
+            },
+            'notMagicBytes': [
+                b'\xff\xd8\xff',
+                b'\x89PNG\r\n\x1a\n',
+                b'GIF8',
+                b'BM',
+                b'\x00\x00\x00\x0cjP  \r\n\x87\n',
+                b'\xff\x4f\xff\x51',
+            ],
+        },
+        'pil': {
+            'module': 'large_image_source_pil',
+            'name': 'pilfile',
+            'extensions': {
+                None: SourcePriority.FALLBACK,
+            },
+            'mimeTypes': {
+                None: SourcePriority.FALLBACK,
+            },
+        },
+        'tiff': {
+            'module': 'large_image_source_tiff',
+            'name': 'tifffile',
+            'extensions': {
+                None: SourcePriority.MEDIUM,
+                'tif': SourcePriority.HIGH,
+                'tiff': SourcePriority.HIGH,
+                'ptif': SourcePriority.PREFERRED,
+                'ptiff': SourcePriority.PREFERRED,
+            },
+            'mimeTypes': {
+                None: SourcePriority.FALLBACK,
+                'image/tiff': SourcePriority.HIGH,
+                'image/x-tiff': SourcePriority.HIGH,
+                'image/x-ptif': SourcePriority.PREFERRED,
+            },
+            'magicBytes': _tiffMagicBytes,
+        },
+    },
+}
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+"""
+Optional timing of the stages of the tile pipeline.
+
+Tile sources wrap each stage of producing a tile (reading from the file,
+assembling JPEG tables, decoding, cropping, resampling, edge filling, and
+encoding) in ``with timing.stage(<name>, ...)``.  When no sink has been added,
+``stage`` returns a shared object that does nothing, so the cost is a single
+function call.  When one or more sinks are added, each stage produces a record
+dictionary with:
+
+    stage: the name of the stage.
+    duration: the elapsed time of the stage in seconds.
+    bytes: the number of bytes handled by the stage, if known.
+
+plus any additional keyword arguments passed to ``stage`` (such as the source
+name and the tile x, y, and z values).  A sink is any callable that takes the
+record.
+"""
+
+import bisect
+import threading
+import timeit
+
+from .. import config
+
+
+_sinks = []
+
+
+class _NullStage(object):
+    """
+    A stage that does nothing.  This is used when there are no timing sinks.
+    """
+    bytes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_nullStage = _NullStage()
+
+
+class _Stage(object):
+    """
+    A stage that records its duration when it exits.  Set the bytes attribute
+    within the context to report a byte count.
+    """
+
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+        self.bytes = None
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = timeit.default_timer() - self.start
+        record = dict(self.info)
+        record['stage'] = self.name
+        record['duration'] = duration
+        record['bytes'] = self.bytes
+        for sink in list(_sinks):
+            try:
+                sink(record)
+            except Exception:
+                config.getConfig('logger').exception('Timing sink failed')
+        return False
+
+
+def stage(name, **info):
+    """
+    Get a context manager that times a stage of the tile pipeline.
+
+    :param name: the name of the stage.
+    :param **info: additional values to include in the timing record.
+    :returns: a context manager.  Set its bytes attribute to report a byte
+        count.
+    """
+    if not _sinks:
+        return _nullStage
+    return _Stage(name, info)
+
+
+def timingEnabled():
+    """
+    Check if any timing sinks are active.
+
+    :returns: True if stages are being timed.
+    """
+    return bool(_sinks)
+
+
+def addTimingSink(sink):
+    """
+    Add a timing sink.
+
+    :param sink: a callable that is passed a record dictionary for each timed
+        stage.
+    :returns: the sink.
+    """
+    if sink not in _sinks:
+        _sinks.append(sink)
+    return sink
+
+
+def removeTimingSink(sink=None):
+    """
+    Remove a timing sink.
+
+    :param sink: the sink to remove.  If None, remove all sinks.
+    """
+    if sink is None:
+        del _sinks[:]
+    elif sink in _sinks:
+        _sinks.remove(sink)
+
+
+class HistogramTimingSink(object):
+    """
+    Collect per-stage counts, durations, byte totals, and a histogram of
+    durations in memory.
+    """
+
+    # Upper bounds of the histogram bins in seconds.
+    defaultBins = (
+        0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1,
+        0.2, 0.5, 1, 2, 5)
+
+    def __init__(self, bins=None):
+        """
+        Create an in-memory histogram sink.
+
+        :param bins: a sorted list of the upper bounds of the duration bins in
+            seconds.  Durations larger than the last bound are counted in an
+            additional bin.
+        """
+        self.bins = list(bins or self.defaultBins)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __call__(self, record):
+        with self._lock:
+            entry = self._stages.get(record['stage'])
+            if entry is None:
+                entry = self._stages[record['stage']] = {
+                    'count': 0,
+                    'duration': 0.0,
+                    'min': None,
+                    'max': None,
+                    'bytes': 0,
+                    'histogram': [0] * (len(self.bins) + 1),
+                }
+            duration = record['duration']
+            entry['count'] += 1
+            entry['duration'] += duration
+            entry['min'] = duration if entry['min'] is None else min(entry['min'], duration)
+            entry['max'] = duration if entry['max'] is None else max(entry['max'], duration)
+            entry['bytes'] += record.get('bytes') or 0
+            entry['histogram'][bisect.bisect_left(self.bins, duration)] += 1
+
+    def reset(self):
+        """
+        Discard all collected values.
+        """
+        with self._lock:
+            self._stages = {}
+
+    def stats(self):
+        """
+        Get the collected statistics.
+
+        :returns: a dictionary keyed by stage name.  Each value contains
+            count, duration (total seconds), mean, min, max, bytes, bins (the
+            upper bound of each histogram bin, with None for the last bin), and
+            histogram (the count in each bin).
+        """
+        with self._lock:
+            result = {}
+            for name, entry in self._stages.items():
+                result[name] = dict(entry)
+                result[name]['histogram'] = list(entry['histogram'])
+                result[name]['mean'] = entry['duration'] / entry['count']
+                result[name]['bins'] = self.bins + [None]
+            return result
+
+
+class ThresholdLogTimingSink(object):
+    """
+    Log stages that take longer than a threshold.
+    """
+
+    def __init__(self, threshold=0.1, logger=None):
+        """
+        Create a sink that logs slow stages.
+
+        :param threshold: the minimum duration in seconds to log.
+        :param logger: the logger to use.  If None, the large_image logger from
+            the config settings is used when a stage is logged.
+        """
+        self.threshold = threshold
+        self.logger = logger
+
+    def __call__(self, record):
+        if record['duration'] < self.threshold:
+            return
+        logger = self.logger or config.getConfig('logger')
+        extra = ', '.join('%s=%r' % (key, record[key]) for key in sorted(record)
+                          if key not in ('stage', 'duration', 'bytes'))
+        logger.info('Slow tile stage %s: %5.3fs%s%s' % (
+            record['stage'], record['duration'],
+            ' (%d bytes)' % record['bytes'] if record.get('bytes') is not None else '',
+            ', ' + extra if extra else ''))
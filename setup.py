@@ -11,6 +11,7 @@ with open('README.rst') as readme_file:
 
 extraReqs = {
     'memcached': ['pylibmc>=1.5.1'] if platform.system() != 'Windows' else [],
+    'turbojpeg': ['PyTurboJPEG'],
 }
 sources = {
     'dummy': ['large-image-source-dummy'],
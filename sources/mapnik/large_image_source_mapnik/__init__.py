@@ -19,12 +19,14 @@
 import json
 import mapnik
 import math
+import numpy
 import PIL.Image
 import palettable
 import pyproj
 import six
 import struct
 import threading
+from multiprocessing import cpu_count
 from operator import attrgetter
 from osgeo import gdal
 from osgeo import gdalconst
@@ -32,10 +34,10 @@ from osgeo import osr
 from pkg_resources import DistributionNotFound, get_distribution
 
 from large_image import config
-from large_image.cache_util import LruCacheMetaclass, methodcache, CacheProperties
+from large_image.cache_util import LruCacheMetaclass, methodcache, CacheProperties, LRUCache
 from large_image.constants import SourcePriority, TileInputUnits
 from large_image.exceptions import TileSourceException
-from large_image.tilesource import FileTileSource, TILE_FORMAT_PIL
+from large_image.tilesource import FileTileSource, TILE_FORMAT_PIL, timing
 
 
 try:
@@ -89,6 +91,9 @@ class MapnikFileTileSource(FileTileSource):
         'image/tiff': SourcePriority.LOW,
         'image/x-tiff': SourcePriority.LOW,
     }
+    # The number of rendered blocks of tiles each source keeps when the
+    # mapnik_metatile config value is more than 1
+    _metatileCacheSize = 4
 
     def __init__(self, path, projection=None, style=None, unitsPerPixel=None, **kwargs):  # noqa
         """
@@ -196,7 +201,16 @@ class MapnikFileTileSource(FileTileSource):
         self._unitsPerPixel = unitsPerPixel
         if self.projection:
             self._initWithProjection(unitsPerPixel)
-        self._getTileLock = threading.Lock()
+        # Idle mapnik maps that are ready to render tiles.  Each map is only
+        # used by one thread at a time.
+        self._mapPool = []
+        self._mapPoolCount = 0
+        self._mapPoolCondition = threading.Condition()
+        # Recently rendered blocks of tiles and locks for the blocks that are
+        # being rendered.
+        self._metatiles = LRUCache(self._metatileCacheSize)
+        self._metatileLocks = {}
+        self._metatileLock = threading.Lock()
 
     def _getDriver(self):
         """
@@ -802,8 +816,13 @@ class MapnikFileTileSource(FileTileSource):
             self._addStyleToMap(
                 m, layerSrs, colorizer, styleBand['band'], extent, composite, nodata)
 
-    @methodcache()
-    def getTile(self, x, y, z, **kwargs):
+    def _getMapParameters(self):
+        """
+        Get the parameters used to build mapnik maps.
+
+        :returns: mapSrs, layerSrs, extent, overscan.  overscan is the number
+            of extra pixels that are rendered on each side of an image.
+        """
         if self.projection:
             mapSrs = self.projection
             layerSrs = self.getProj4String()
@@ -834,6 +853,112 @@ class MapnikFileTileSource(FileTileSource):
             # at (0, extentMaxY), so make a slightly larger image and crop it.
             extent = '0 0 %d %d' % (self.sourceSizeX, self.sourceSizeY)
             overscan = 1
+        return mapSrs, layerSrs, extent, overscan
+
+    def _acquireMap(self):
+        """
+        Get a mapnik map from the pool, creating one if there are fewer than
+        the pool size.  Otherwise, wait for one to be released.  Each map has
+        the layers and styles of this source; the size and bounds are set for
+        each render.
+
+        :returns: a mapnik map.  This must be released with _releaseMap.
+        """
+        poolSize = config.getConfig('mapnik_map_pool_size') or cpu_count()
+        with self._mapPoolCondition:
+            while not self._mapPool and self._mapPoolCount >= poolSize:
+                self._mapPoolCondition.wait()
+            if self._mapPool:
+                return self._mapPool.pop()
+            self._mapPoolCount += 1
+        try:
+            mapSrs, layerSrs, extent, overscan = self._getMapParameters()
+            mapnik.logger.set_severity(mapnik.severity_type.Debug)
+            m = mapnik.Map(self.tileWidth + overscan * 2, self.tileHeight + overscan * 2, mapSrs)
+            self.addStyle(m, layerSrs, extent)
+            if getattr(self, '_repeatLongitude', None):
+                self.addStyle(m, self._repeatLongitude, extent)
+        except Exception:
+            with self._mapPoolCondition:
+                self._mapPoolCount -= 1
+                self._mapPoolCondition.notify()
+            raise
+        return m
+
+    def _releaseMap(self, m):
+        """
+        Return a mapnik map to the pool.
+
+        :param m: a map from _acquireMap.
+        """
+        with self._mapPoolCondition:
+            self._mapPool.append(m)
+            self._mapPoolCondition.notify()
+
+    def _renderTiles(self, x, y, z, count=1):
+        """
+        Render a square block of tiles as one image.
+
+        :param x, y, z: the upper left tile of the block.
+        :param count: the number of tiles across and down the block.
+        :returns: an RGBA PIL image.
+        """
+        mapSrs, layerSrs, extent, overscan = self._getMapParameters()
+        xmin, _, _, ymax = self.getTileCorners(z, x, y)
+        _, ymin, xmax, _ = self.getTileCorners(z, x + count - 1, y + count - 1)
+        width = self.tileWidth * count + overscan * 2
+        height = self.tileHeight * count + overscan * 2
+        if overscan:
+            pw = (xmax - xmin) / (self.tileWidth * count)
+            py = (ymax - ymin) / (self.tileHeight * count)
+            xmin, xmax = xmin - pw * overscan, xmax + pw * overscan
+            ymin, ymax = ymin - py * overscan, ymax + py * overscan
+        m = self._acquireMap()
+        try:
+            with timing.stage('render', source=self.name, x=x, y=y, z=z):
+                m.resize(width, height)
+                m.zoom_to_box(mapnik.Box2d(xmin, ymin, xmax, ymax))
+                img = mapnik.Image(width, height)
+                mapnik.render(m, img)
+                pilimg = PIL.Image.frombytes('RGBA', (img.width(), img.height()), img.tostring())
+        finally:
+            self._releaseMap(m)
+        if overscan:
+            pilimg = pilimg.crop((overscan, overscan, width - overscan, height - overscan))
+        return pilimg
+
+    def _getMetatile(self, x, y, z, count):
+        """
+        Render a block of tiles.  The most recently rendered blocks are kept
+        by the source rather than in the tile cache, since they are much
+        larger than tiles.  When several tiles of a block that is being
+        rendered are requested at once, they wait for that render.
+
+        :param x, y, z: the upper left tile of the block.
+        :param count: the number of tiles across and down the block.
+        :returns: an RGBA PIL image.
+        """
+        key = (x, y, z, count)
+        with self._metatileLock:
+            block = self._metatiles.get(key)
+            if block is not None:
+                return block
+            renderLock = self._metatileLocks.setdefault(key, threading.Lock())
+        with renderLock:
+            with self._metatileLock:
+                block = self._metatiles.get(key)
+            if block is None:
+                try:
+                    block = self._renderTiles(x, y, z, count)
+                    with self._metatileLock:
+                        self._metatiles[key] = block
+                finally:
+                    with self._metatileLock:
+                        self._metatileLocks.pop(key, None)
+        return block
+
+    @methodcache()
+    def getTile(self, x, y, z, **kwargs):
         xmin, ymin, xmax, ymax = self.getTileCorners(z, x, y)
         if self.projection:
             # If we are using a projection, the tile could contain no data.
@@ -844,30 +969,16 @@ class MapnikFileTileSource(FileTileSource):
                     ymin >= bounds['ymax'] or ymax <= bounds['ymin']):
                 pilimg = PIL.Image.new('RGBA', (self.tileWidth, self.tileHeight))
                 return self._outputTile(pilimg, TILE_FORMAT_PIL, x, y, z, **kwargs)
-        if overscan:
-            pw = (xmax - xmin) / self.tileWidth
-            py = (ymax - ymin) / self.tileHeight
-            xmin, xmax = xmin - pw * overscan, xmax + pw * overscan
-            ymin, ymax = ymin - py * overscan, ymax + py * overscan
-        with self._getTileLock:
-            if not hasattr(self, '_mapnikMap'):
-                mapnik.logger.set_severity(mapnik.severity_type.Debug)
-                m = mapnik.Map(
-                    self.tileWidth + overscan * 2,
-                    self.tileHeight + overscan * 2,
-                    mapSrs)
-                self.addStyle(m, layerSrs, extent)
-                if getattr(self, '_repeatLongitude', None):
-                    self.addStyle(m, self._repeatLongitude, extent)
-                self._mapnikMap = m
-            else:
-                m = self._mapnikMap
-            m.zoom_to_box(mapnik.Box2d(xmin, ymin, xmax, ymax))
-            img = mapnik.Image(self.tileWidth + overscan * 2, self.tileHeight + overscan * 2)
-            mapnik.render(m, img)
-            pilimg = PIL.Image.frombytes('RGBA', (img.width(), img.height()), img.tostring())
-        if overscan:
-            pilimg = pilimg.crop((1, 1, pilimg.width - overscan, pilimg.height - overscan))
+        # Levels with few tiles use smaller blocks, so blocks don't extend past
+        # the edge of the level.
+        count = max(1, min(int(config.getConfig('mapnik_metatile') or 1), 2 ** z))
+        if count > 1:
+            block = self._getMetatile(x - x % count, y - y % count, z, count)
+            left = (x % count) * self.tileWidth
+            top = (y % count) * self.tileHeight
+            pilimg = block.crop((left, top, left + self.tileWidth, top + self.tileHeight))
+        else:
+            pilimg = self._renderTiles(x, y, z)
         return self._outputTile(pilimg, TILE_FORMAT_PIL, x, y, z, **kwargs)
 
     @staticmethod
@@ -1122,3 +1233,65 @@ class MapnikFileTileSource(FileTileSource):
                         except RuntimeError:
                             pass
         return pixel
+
+    def getPixels(self, points, level=None, scale=None, frame=None):
+        """
+        Get the values of many pixels from the current tile source.  In
+        addition to the rendered values, the band values are read from the
+        dataset.  Points are grouped into blocks of the dataset and each block
+        is read once with ReadAsArray.
+
+        :param points: a list of (x, y) points in base pixels (maximum
+            resolution pixels).
+        :param level: the tile level to sample.  If None, scale is used.
+        :param scale: a dictionary of magnification, mm_x, and/or mm_y used to
+            pick the level to sample.  If neither level nor scale is
+            specified, the maximum resolution level is used.
+        :param frame: the frame to sample, if the source has frames.
+        :returns: a list with one dictionary per point.  See getPixel.
+        """
+        pixels = super(MapnikFileTileSource, self).getPixels(
+            points, level=level, scale=scale, frame=frame)
+        points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+        x, y = points[:, 0], points[:, 1]
+        if self.projection:
+            # convert to a scale of [-0.5, 0.5]
+            x = 0.5 + x / 2 ** (self.levels - 1) / self.tileWidth
+            y = 0.5 - y / 2 ** (self.levels - 1) / self.tileHeight
+            # convert to projection coordinates
+            x = self.projectionOrigin[0] + x * self.unitsAcrossLevel0
+            y = self.projectionOrigin[1] + y * self.unitsAcrossLevel0
+            # convert to native pixel coordinates
+            x, y = self.toNativePixelCoordinates(x, y, roundResults=False)
+            x, y = numpy.asarray(x, dtype=float), numpy.asarray(y, dtype=float)
+        valid = numpy.nonzero(
+            numpy.isfinite(x) & numpy.isfinite(y) &
+            (x >= 0) & (x < self.sourceSizeX) & (y >= 0) & (y < self.sourceSizeY))[0]
+        if not len(valid):
+            return pixels
+        ix = numpy.floor(x[valid]).astype(int)
+        iy = numpy.floor(y[valid]).astype(int)
+        blockSize = 256
+        blockKey = (iy // blockSize) * (self.sourceSizeX // blockSize + 1) + ix // blockSize
+        order = numpy.argsort(blockKey, kind='mergesort')
+        starts = numpy.concatenate((
+            [0], numpy.nonzero(numpy.diff(blockKey[order]))[0] + 1, [len(order)]))
+        for idx in range(len(starts) - 1):
+            block = order[starts[idx]:starts[idx + 1]]
+            x0, x1 = int(ix[block].min()), int(ix[block].max()) + 1
+            y0, y1 = int(iy[block].min()), int(iy[block].max()) + 1
+            try:
+                with self._getDatasetLock:
+                    data = self.dataset.ReadAsArray(
+                        x0, y0, x1 - x0, y1 - y0, buf_type=gdal.GDT_Float32)
+            except RuntimeError:
+                continue
+            if data is None:
+                continue
+            if len(data.shape) == 2:
+                data = data[numpy.newaxis, :, :]
+            values = data[:, iy[block] - y0, ix[block] - x0].T.tolist()
+            for pidx, value in zip(valid[block], values):
+                pixels[pidx]['bands'] = {
+                    band + 1: bandValue for band, bandValue in enumerate(value)}
+        return pixels
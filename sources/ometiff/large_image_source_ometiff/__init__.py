@@ -17,19 +17,22 @@
 ##############################################################################
 
 import math
+import numpy
 import PIL.Image
 import six
+import threading
 from pkg_resources import DistributionNotFound, get_distribution
 from six.moves import range
 
-from large_image.cache_util import LruCacheMetaclass, methodcache
+from large_image.cache_util import LRUCache, LruCacheMetaclass, methodcache
+from large_image import config
 from large_image.constants import SourcePriority
 from large_image.exceptions import TileSourceException
-from large_image.tilesource import TILE_FORMAT_PIL
+from large_image.tilesource import TILE_FORMAT_NUMPY, TILE_FORMAT_PIL
 
 from large_image_source_tiff import TiffFileTileSource
-from large_image_source_tiff.tiff_reader import TiledTiffDirectory, \
-    InvalidOperationTiffException, TiffException, IOTiffException
+from large_image_source_tiff.tiff_reader import TiledTiffDirectory, TiffFileHandle, \
+    InvalidOperationTiffException, TiffException, IOTiffException, readDirectoryTiles
 
 
 try:
@@ -90,9 +93,11 @@ class OMETiffFileTileSource(TiffFileTileSource):
         super(TiffFileTileSource, self).__init__(path, **kwargs)
 
         largeImagePath = self._getLargeImagePath()
+        # All directories read the file through one file descriptor
+        self._fileHandle = TiffFileHandle(largeImagePath)
 
         try:
-            base = TiledTiffDirectory(largeImagePath, 0)
+            base = TiledTiffDirectory(largeImagePath, 0, fileHandle=self._fileHandle)
         except TiffException:
             raise TileSourceException('Not a tiled OME Tiff')
         info = getattr(base, '_description_xml', None)
@@ -127,11 +132,14 @@ class OMETiffFileTileSource(TiffFileTileSource):
         omebylevel = dict(zip(levels, omeimages))
         self._omeLevels = [omebylevel.get(key) for key in range(max(omebylevel.keys()) + 1)]
         self._tiffDirectories = [
-            TiledTiffDirectory(largeImagePath, int(entry['TiffData'][0]['IFD']))
+            TiledTiffDirectory(
+                largeImagePath, int(entry['TiffData'][0]['IFD']), fileHandle=self._fileHandle)
             if entry else None
             for entry in self._omeLevels]
-        self._directoryCache = {}
-        self._directoryCacheMaxSize = max(20, len(self._omebase['TiffData']) * 3)
+        # Readers for the directories of other frames.  These are cheap to
+        # create, since the tags of all directories are read once per file.
+        self._directoryCache = LRUCache(max(20, len(self._omebase['TiffData']) * 3))
+        self._directoryCacheLock = threading.Lock()
         self.tileWidth = base.tileWidth
         self.tileHeight = base.tileHeight
         self.levels = len(self._tiffDirectories)
@@ -141,6 +149,7 @@ class OMETiffFileTileSource(TiffFileTileSource):
         # We can get the embedded images, but we don't currently use non-tiled
         # images as associated images.  This would require enumerating tiff
         # directories not mentioned by the ome list.
+        self._associatedImageDirectories = {}
         self._associatedImages = {}
 
     def getMetadata(self):
@@ -175,6 +184,37 @@ class OMETiffFileTileSource(TiffFileTileSource):
             result['magnification'] = 0.01 / result['mm_x']
         return result
 
+    def _getFrameDirectory(self, z, frame):
+        """
+        Get the reader for the directory of a level of a frame other than the
+        first.
+
+        :param z: the level.
+        :param frame: the frame number.
+        :returns: a TiledTiffDirectory.
+        """
+        dirnum = int(self._omeLevels[z]['TiffData'][frame]['IFD'])
+        with self._directoryCacheLock:
+            dir = self._directoryCache.get(dirnum)
+        if dir is None:
+            dir = TiledTiffDirectory(
+                self._getLargeImagePath(), dirnum, fileHandle=self._fileHandle)
+            with self._directoryCacheLock:
+                self._directoryCache[dirnum] = dir
+        return dir
+
+    def _prefetchTiles(self, level, tiles, frame=None):
+        if frame in (None, 0, '0', ''):
+            return super(OMETiffFileTileSource, self)._prefetchTiles(level, tiles, frame)
+        try:
+            frame = int(frame)
+            if (0 <= level < len(self._omeLevels) and self._omeLevels[level] is not None and
+                    0 <= frame < len(self._omebase['TiffData'])):
+                self._getFrameDirectory(level, frame).prefetchTiles(tiles)
+        except (TiffException, IOError, OSError, ValueError) as exc:
+            # Tiles will be read individually and report any errors then
+            config.getConfig('logger').debug('Failed to prefetch tiles: %s', exc)
+
     @methodcache()
     def getTile(self, x, y, z, pilImageAllowed=False, sparseFallback=False,
                 **kwargs):
@@ -185,19 +225,14 @@ class OMETiffFileTileSource(TiffFileTileSource):
         frame = int(kwargs['frame'])
         if frame < 0 or frame >= len(self._omebase['TiffData']):
             raise TileSourceException('Frame does not exist')
-        dirnum = int(self._omeLevels[z]['TiffData'][frame]['IFD'])
-        if dirnum in self._directoryCache:
-            dir = self._directoryCache[dirnum]
-        else:
-            if len(self._directoryCache) >= self._directoryCacheMaxSize:
-                self._directoryCache = {}
-            dir = TiledTiffDirectory(self._getLargeImagePath(), dirnum)
-            self._directoryCache[dirnum] = dir
         try:
-            tile = dir.getTile(x, y)
+            dir = self._getFrameDirectory(z, frame)
+            tile = dir.getTile(x, y, asarray=kwargs.get('numpyAllowed') == 'always')
             format = 'JPEG'
             if PIL and isinstance(tile, PIL.Image.Image):
                 format = TILE_FORMAT_PIL
+            if isinstance(tile, numpy.ndarray):
+                format = TILE_FORMAT_NUMPY
             return self._outputTile(tile, format, x, y, z, pilImageAllowed,
                                     **kwargs)
         except InvalidOperationTiffException as e:
@@ -206,3 +241,41 @@ class OMETiffFileTileSource(TiffFileTileSource):
             return self.getTileIOTiffException(
                 x, y, z, pilImageAllowed=pilImageAllowed,
                 sparseFallback=sparseFallback, exception=e, **kwargs)
+
+    def getTileFrames(self, x, y, z, frames=None, sparseFallback=False, **kwargs):
+        """
+        Get the same tile from several frames as a single numpy array in the
+        source's native data type.  The tiles of all of the frames are read
+        in file order and decoded together when possible.  See the base class.
+
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param z: the level of the tile.
+        :param frames: a list of frame numbers.  If None, all frames are used.
+        :param sparseFallback: if True and the tile is missing in a level, get
+            it from a lower resolution level.
+        :returns: a numpy array of shape (frames, height, width[, bands]).
+        """
+        numFrames = len(self._omebase['TiffData'])
+        frames = list(range(numFrames)) if frames is None else [int(frame) for frame in frames]
+        if any(frame < 0 or frame >= numFrames for frame in frames):
+            raise TileSourceException('Frame does not exist')
+        tiles = [None] * len(frames)
+        if 0 <= z < len(self._omeLevels) and self._omeLevels[z] is not None:
+            try:
+                directories = [
+                    self._tiffDirectories[z] if not frame else self._getFrameDirectory(z, frame)
+                    for frame in frames]
+                tiles = readDirectoryTiles(directories, x, y)
+            except InvalidOperationTiffException as e:
+                raise TileSourceException(e.args[0])
+            except (IOTiffException, TiffException):
+                # Read the tiles individually, which handles missing data
+                pass
+        kwargs.pop('frame', None)
+        return numpy.stack([
+            self._outputTile(tile, TILE_FORMAT_NUMPY, x, y, z, numpyAllowed='always', **kwargs)
+            if tile is not None else
+            super(OMETiffFileTileSource, self).getTileFrames(
+                x, y, z, frames=[frame], sparseFallback=sparseFallback, **kwargs)[0]
+            for frame, tile in zip(frames, tiles)])
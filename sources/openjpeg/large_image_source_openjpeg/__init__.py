@@ -16,22 +16,27 @@
 #  limitations under the License.
 ##############################################################################
 
+import collections
 import glymur
 import math
+import numpy
 import PIL.Image
 import six
+import threading
+import time
 import warnings
 
 from six import BytesIO
-from six.moves import queue
 from xml.etree import cElementTree
 
 from pkg_resources import DistributionNotFound, get_distribution
 
-from large_image.cache_util import LruCacheMetaclass, methodcache
+from large_image import config
+from large_image.cache_util import LruCacheMetaclass, MaximumTileSources, methodcache
 from large_image.constants import SourcePriority, TILE_FORMAT_PIL
 from large_image.exceptions import TileSourceException
-from large_image.tilesource import FileTileSource, etreeToDict
+from large_image.tilesource import FileTileSource, PrefetchedTiles, etreeToDict, tileRuns, \
+    timing
 
 
 try:
@@ -44,6 +49,137 @@ except DistributionNotFound:
 warnings.filterwarnings('ignore', category=UserWarning, module='glymur')
 
 
+class _HandlePool(object):
+    """
+    Glymur handles shared by all OpenJPEG tile sources.  A handle can only be
+    used by one thread at a time, so each read takes a handle from the pool
+    and returns it when done.  The total number of handles is limited (see
+    the openjpeg_max_handles config value); when all are in use, threads wait
+    in the order they asked.  Idle handles of one file are closed to open
+    handles for another, and handles that have been idle for a while are
+    closed.
+    """
+
+    # The most handles that are opened if the config value isn't set
+    DefaultMaxHandles = 64
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        # Idle handles by path, each a list of [handle, last used time] with
+        # the most recently used last.
+        self._idle = {}
+        self._open = 0
+        self._waiters = collections.deque()
+        self.stats = {'opened': 0, 'closed': 0, 'waits': 0, 'waitTime': 0.0}
+
+    def maxHandles(self):
+        """
+        Get the maximum number of open handles.
+
+        :returns: the number of handles.
+        """
+        value = config.getConfig('openjpeg_max_handles')
+        if not value:
+            value = min(MaximumTileSources * 4, self.DefaultMaxHandles)
+        return max(1, int(value))
+
+    def _closeIdle(self, force=False):
+        """
+        Close handles that have been idle for longer than the idle time.  The
+        lock must be held.
+
+        :param force: if True, close the least recently used idle handle
+            regardless of how long it has been idle.
+        :returns: True if any handle was closed.
+        """
+        idleTime = config.getConfig('openjpeg_handle_idle_time')
+        now = time.time()
+        closed = 0
+        oldest = None
+        for path in list(self._idle):
+            handles = self._idle[path]
+            if idleTime is not None:
+                expired = [entry for entry in handles if now - entry[1] > idleTime]
+                closed += len(expired)
+                handles[:] = [entry for entry in handles if now - entry[1] <= idleTime]
+            if handles and (oldest is None or handles[0][1] < self._idle[oldest][0][1]):
+                oldest = path
+            if not handles:
+                del self._idle[path]
+        if force and not closed and oldest is not None:
+            self._idle[oldest].pop(0)
+            if not self._idle[oldest]:
+                del self._idle[oldest]
+            closed += 1
+        self._open -= closed
+        self.stats['closed'] += closed
+        return bool(closed)
+
+    def acquire(self, path):
+        """
+        Get a handle for a file, waiting for one if necessary.  The handle
+        must be returned with release.
+
+        :param path: the path of the file.
+        :returns: a glymur.Jp2k object.
+        """
+        ticket = object()
+        handle = None
+        with timing.stage('handlewait', source='openjpegfile'), self._lock:
+            self._waiters.append(ticket)
+            start = None
+            try:
+                while True:
+                    if self._waiters[0] is ticket:
+                        self._closeIdle()
+                        if self._idle.get(path):
+                            handle = self._idle[path].pop()[0]
+                            if not self._idle[path]:
+                                del self._idle[path]
+                            break
+                        if self._open < self.maxHandles() or self._closeIdle(True):
+                            self._open += 1
+                            break
+                    if start is None:
+                        start = time.time()
+                        self.stats['waits'] += 1
+                    # A timeout prevents uninterruptable waits on some
+                    # platforms
+                    self._lock.wait(1.0)
+            finally:
+                self._waiters.remove(ticket)
+                if start is not None:
+                    self.stats['waitTime'] += time.time() - start
+                self._lock.notify_all()
+        if handle is None:
+            try:
+                handle = glymur.Jp2k(path)
+            except Exception:
+                with self._lock:
+                    self._open -= 1
+                    self._lock.notify_all()
+                raise
+            with self._lock:
+                self.stats['opened'] += 1
+        return handle
+
+    def release(self, path, handle):
+        """
+        Return a handle to the pool.
+
+        :param path: the path of the file.
+        :param handle: the handle from acquire.
+        """
+        with self._lock:
+            self._idle.setdefault(path, []).append([handle, time.time()])
+            while self._open > self.maxHandles() and self._closeIdle(True):
+                pass
+            self._lock.notify_all()
+
+
+_handlePool = _HandlePool()
+
+
 @six.add_metaclass(LruCacheMetaclass)
 class OpenjpegFileTileSource(FileTileSource):
     """
@@ -65,6 +201,8 @@ class OpenjpegFileTileSource(FileTileSource):
         'image/jp2': SourcePriority.PREFERRED,
         'image/jpx': SourcePriority.PREFERRED,
     }
+    # The JP2 signature box and a raw J2K codestream
+    magicBytes = [b'\x00\x00\x00\x0cjP  \r\n\x87\n', b'\xff\x4f\xff\x51']
 
     _boxToTag = {
         # In the few samples I've seen, both of these appear to be macro images
@@ -74,10 +212,13 @@ class OpenjpegFileTileSource(FileTileSource):
         # b'psi ': 'other',
     }
     _xmlTag = b'mxl '
+    # Boxes larger than this are not read
+    _maxBoxSize = 16 * 1024 * 1024
 
     _minTileSize = 256
     _maxTileSize = 512
-    _maxOpenHandles = 6
+    # The tile iterator decodes up to this many tiles of a row with one read
+    _maxBatchTiles = 16
 
     def __init__(self, path, **kwargs):
         """
@@ -92,14 +233,18 @@ class OpenjpegFileTileSource(FileTileSource):
 
         self._largeImagePath = largeImagePath
         self._pixelInfo = {}
+        threads = config.getConfig('openjpeg_decode_threads')
+        if threads and int(threads) != glymur.get_option('lib.num_threads'):
+            try:
+                glymur.set_option('lib.num_threads', int(threads))
+            except (KeyError, RuntimeError) as exc:
+                config.getConfig('logger').info(
+                    'Cannot decode JPEG 2000 files with multiple threads: %s', exc)
         try:
             self._openjpeg = glymur.Jp2k(largeImagePath)
         except glymur.jp2box.InvalidJp2kError:
             raise TileSourceException('File cannot be opened via Glymur and OpenJPEG.')
-        self._openjpegHandles = queue.LifoQueue()
-        for _ in range(self._maxOpenHandles - 1):
-            self._openjpegHandles.put(None)
-        self._openjpegHandles.put(self._openjpeg)
+        self._prefetched = PrefetchedTiles()
         try:
             self.sizeY, self.sizeX = self._openjpeg.shape[:2]
         except IndexError:
@@ -121,22 +266,18 @@ class OpenjpegFileTileSource(FileTileSource):
 
     def _getAssociatedImages(self):
         """
-        Read associated images and metadata from boxes.
+        Read metadata from boxes and find the boxes of associated images.
+        Associated images are read when they are first requested.
         """
+        self._associatedImageBoxes = {}
         self._associatedImages = {}
         for box in self._openjpeg.box:
-            if box.box_id == self._xmlTag or box.box_id in self._boxToTag:
+            if box.box_id == self._xmlTag:
                 data = self._readbox(box)
-                if data is None:
-                    continue
-                if box.box_id == self._xmlTag:
+                if data is not None:
                     self._parseMetadataXml(data)
-                    continue
-                try:
-                    self._associatedImages[self._boxToTag[box.box_id]] = PIL.Image.open(
-                        BytesIO(data))
-                except Exception:
-                    pass
+            elif box.box_id in self._boxToTag and box.length <= self._maxBoxSize:
+                self._associatedImageBoxes[self._boxToTag[box.box_id]] = box
             if box.box_id == 'jp2c':
                 for segment in box.codestream.segment:
                     if segment.marker_id == 'CME' and hasattr(segment, 'ccme'):
@@ -188,7 +329,20 @@ class OpenjpegFileTileSource(FileTileSource):
         :param imageKey: the key of the associated image.
         :return: the image in PIL format or None.
         """
-        return self._associatedImages.get(imageKey)
+        if imageKey not in self._associatedImageBoxes:
+            return None
+        # Keep the image once it has been read
+        if imageKey not in self._associatedImages:
+            data = self._readbox(self._associatedImageBoxes[imageKey])
+            if data is None:
+                return None
+            try:
+                image = PIL.Image.open(BytesIO(data))
+                image.load()
+            except Exception:
+                return None
+            self._associatedImages[imageKey] = image
+        return self._associatedImages[imageKey]
 
     def getAssociatedImagesList(self):
         """
@@ -196,58 +350,127 @@ class OpenjpegFileTileSource(FileTileSource):
 
         :return: the list of image keys.
         """
-        return list(sorted(self._associatedImages.keys()))
+        return list(sorted(self._associatedImageBoxes.keys()))
 
     def _readbox(self, box):
-        if box.length > 16 * 1024 * 1024:
+        if box.length > self._maxBoxSize:
             return
         try:
-            fp = open(self._largeImagePath, 'rb')
-            headerLength = 16
-            fp.seek(box.offset + headerLength)
-            data = fp.read(box.length - headerLength)
+            with open(self._largeImagePath, 'rb') as fp:
+                headerLength = 16
+                fp.seek(box.offset + headerLength)
+                data = fp.read(box.length - headerLength)
             return data
         except Exception:
             pass
 
-    @methodcache()
-    def getTile(self, x, y, z, pilImageAllowed=False, **kwargs):
-        if z < 0 or z >= self.levels:
-            raise TileSourceException('z layer does not exist')
+    def _readWindow(self, y0, y1, x0, x1, step, **info):
+        """
+        Decode part of the image with one of the open handles to the file.
+
+        :param y0, y1, x0, x1: the bounds of the window in full resolution
+            pixels.
+        :param step: a power of two; the window is decoded at this reduction.
+        :param **info: values to include in the timing record.
+        :returns: a numpy array.
+        """
+        # The file may be open multiple times so multiple threads can access
+        # it concurrently.
+        openjpegHandle = _handlePool.acquire(self._largeImagePath)
+        try:
+            with timing.stage('decode', source=self.name, **info):
+                return openjpegHandle[y0:y1:step, x0:x1:step]
+        finally:
+            _handlePool.release(self._largeImagePath, openjpegHandle)
+
+    def _tileBounds(self, x, y, z):
+        """
+        Get the area of the image used for a tile.
+
+        :param x, y, z: the tile.
+        :returns: x0, x1, y0, y1, step, scale: the bounds of the tile in full
+            resolution pixels, the reduction the tile is decoded at, and the
+            factor it must then be reduced by, or None if the tile's level is
+            in the file.
+        """
         step = int(2 ** (self.levels - 1 - z))
         x0 = x * step * self.tileWidth
         x1 = min((x + 1) * step * self.tileWidth, self.sizeX)
         y0 = y * step * self.tileHeight
         y1 = min((y + 1) * step * self.tileHeight, self.sizeY)
-        if x < 0 or x0 >= self.sizeX:
-            raise TileSourceException('x is outside layer')
-        if y < 0 or y0 >= self.sizeY:
-            raise TileSourceException('y is outside layer')
         scale = None
         if z < self._minlevel:
             scale = int(2 ** (self._minlevel - z))
             step = int(2 ** (self.levels - 1 - self._minlevel))
-        # possible open the file multiple times so multiple threads can access
-        # it concurrently.
-        while True:
-            try:
-                # A timeout prevents uniterupptable waits on some platforms
-                openjpegHandle = self._openjpegHandles.get(timeout=1.0)
-                break
-            except queue.Empty:
-                continue
-        if openjpegHandle is None:
-            openjpegHandle = glymur.Jp2k(self._largeImagePath)
-        try:
-            tile = openjpegHandle[y0:y1:step, x0:x1:step]
-        finally:
-            self._openjpegHandles.put(openjpegHandle)
+        return x0, x1, y0, y1, step, scale
+
+    def _prefetchTiles(self, level, tiles, frame=None):
+        """
+        Decode the tiles of a row with one read of the codestream rather than
+        one read per tile.  The codestream is parsed once for the whole
+        window, and tiles of levels that aren't in the file are reduced with a
+        single resize.  The tiles are kept as views into the window until
+        getTile uses them.
+
+        :param level: the level of the tiles.
+        :param tiles: a list of (x, y) tile indices.
+        :param frame: the frame of the tiles.  Unused.
+        """
+        if level < 0 or level >= self.levels:
+            return
+        needed = []
+        for x, y in tiles:
+            x0, _, y0, _, _, _ = self._tileBounds(x, y, level)
+            if (x >= 0 and y >= 0 and x0 < self.sizeX and y0 < self.sizeY and
+                    (x, y, level) not in self._prefetched):
+                needed.append((x, y))
+        for batch in tileRuns(needed, self._maxBatchTiles):
+            if len(batch) > 1:
+                self._prefetchBatch(batch, level)
+
+    def _prefetchBatch(self, batch, z):
+        """
+        Decode a run of adjacent tiles of a row with one read.
+
+        :param batch: a list of (x, y) tile indices in order.
+        :param z: the level of the tiles.
+        """
+        x0, _, y0, y1, step, scale = self._tileBounds(batch[0][0], batch[0][1], z)
+        x1 = self._tileBounds(batch[-1][0], batch[-1][1], z)[1]
+        window = self._readWindow(
+            y0, y1, x0, x1, step, x=batch[0][0], y=batch[0][1], z=z, tiles=len(batch))
+        if scale:
+            with timing.stage('resample', source=self.name, tiles=len(batch)):
+                window = numpy.asarray(PIL.Image.fromarray(window).resize(
+                    (window.shape[1] // scale, window.shape[0] // scale), PIL.Image.LANCZOS))
+        self._prefetched.update(
+            ((x, y, z), window[:, idx * self.tileWidth:(idx + 1) * self.tileWidth])
+            for idx, (x, y) in enumerate(batch))
+
+    @methodcache()
+    def getTile(self, x, y, z, pilImageAllowed=False, **kwargs):
+        if z < 0 or z >= self.levels:
+            raise TileSourceException('z layer does not exist')
+        x0, x1, y0, y1, step, scale = self._tileBounds(x, y, z)
+        if x < 0 or x0 >= self.sizeX:
+            raise TileSourceException('x is outside layer')
+        if y < 0 or y0 >= self.sizeY:
+            raise TileSourceException('y is outside layer')
+        tile = self._prefetched.pop((x, y, z))
+        if tile is None:
+            tile = self._readWindow(y0, y1, x0, x1, step, x=x, y=y, z=z)
+        else:
+            # The tile was decoded and reduced with the rest of its row
+            scale = None
         mode = 'L'
         if len(tile.shape) == 3:
             mode = ['L', 'LA', 'RGB', 'RGBA'][tile.shape[2] - 1]
-        tile = PIL.Image.frombytes(mode, (tile.shape[1], tile.shape[0]), tile)
+        tile = PIL.Image.frombytes(
+            mode, (tile.shape[1], tile.shape[0]), numpy.ascontiguousarray(tile))
         if scale:
-            tile = tile.resize((tile.size[0] // scale, tile.size[1] // scale), PIL.Image.LANCZOS)
+            with timing.stage('resample', source=self.name, x=x, y=y, z=z):
+                tile = tile.resize(
+                    (tile.size[0] // scale, tile.size[1] // scale), PIL.Image.LANCZOS)
         if tile.size != (self.tileWidth, self.tileHeight):
             wrap = PIL.Image.new(mode, (self.tileWidth, self.tileHeight))
             wrap.paste(tile, (0, 0))
@@ -16,20 +16,23 @@
 #  limitations under the License.
 ##############################################################################
 
+import ctypes
 import math
+import numpy
 import six
+import sys
 
 from six.moves import range
 
 import openslide
-import PIL
 from pkg_resources import DistributionNotFound, get_distribution
 
 from large_image import config
-from large_image.cache_util import LruCacheMetaclass, methodcache
-from large_image.constants import SourcePriority
+from large_image.cache_util import LruCacheMetaclass, methodcache, methodcacheContains
+from large_image.constants import SourcePriority, TILE_FORMAT_NUMPY
 from large_image.exceptions import TileSourceException
-from large_image.tilesource import FileTileSource, nearPowerOfTwo
+from large_image.tilesource import FileTileSource, PrefetchedTiles, nearPowerOfTwo, \
+    tileRuns, timing
 
 
 try:
@@ -38,6 +41,44 @@ except DistributionNotFound:
     # package is not installed
     pass
 
+# Reading regions through the C interface avoids building an RGBA image.  This
+# is a private function of openslide-python (taking the slide handle, a uint32
+# buffer, x, y, level, width, and height), as is the slide handle (the
+# OpenSlide object's _osr attribute), so if either is missing or is called
+# differently, regions are read with the public read_region method instead.
+_lowlevelReadRegion = getattr(openslide.lowlevel, '_read_region', None)
+
+
+def _argbToArray(argb):
+    """
+    Convert premultiplied ARGB data from OpenSlide to an RGB or RGBA array.
+    Colors of partially transparent pixels are unpremultiplied.
+
+    :param argb: a uint32 numpy array of shape (height, width) in the native
+        byte order.
+    :returns: a uint8 numpy array of shape (height, width, 3) if every pixel
+        is opaque, or (height, width, 4) otherwise.
+    """
+    channels = argb.view(numpy.uint8).reshape(argb.shape + (4, ))
+    order = (2, 1, 0, 3) if sys.byteorder == 'little' else (1, 2, 3, 0)
+    # Most tiles are entirely opaque
+    opaque = bool((argb >= 0xFF000000).all())
+    bands = 3 if opaque else 4
+    data = numpy.empty(argb.shape + (bands, ), dtype=numpy.uint8)
+    # Copying one plane at a time is much faster than copying a strided view
+    # of all of them
+    for band, channel in enumerate(order[:bands]):
+        data[:, :, band] = channels[:, :, channel]
+    if opaque:
+        return data
+    alpha = data[:, :, 3]
+    partial = (alpha != 0) & (alpha != 255)
+    if partial.any():
+        alpha = alpha[partial].astype(numpy.uint16)[:, numpy.newaxis]
+        data[partial, :3] = numpy.minimum(
+            (data[partial, :3].astype(numpy.uint16) * 255 + alpha // 2) // alpha, 255)
+    return data
+
 
 @six.add_metaclass(LruCacheMetaclass)
 class OpenslideFileTileSource(FileTileSource):
@@ -67,6 +108,18 @@ class OpenslideFileTileSource(FileTileSource):
         'image/tiff': SourcePriority.MEDIUM,
         'image/x-tiff': SourcePriority.MEDIUM,
     }
+    # OpenSlide reads a variety of TIFF, text index, and database files, but
+    # none of these common single image formats.
+    notMagicBytes = [
+        b'\xff\xd8\xff',  # JPEG
+        b'\x89PNG\r\n\x1a\n',  # PNG
+        b'GIF8',  # GIF
+        b'BM',  # BMP
+        b'\x00\x00\x00\x0cjP  \r\n\x87\n',  # JP2
+        b'\xff\x4f\xff\x51',  # J2K
+    ]
+    # The tile iterator reads up to this many tiles of a row at once
+    _maxBatchTiles = 16
 
     def __init__(self, path, **kwargs):
         """
@@ -115,8 +168,7 @@ class OpenslideFileTileSource(FileTileSource):
         # our levels (where 0 is the minimum resolution), find the lowest
         # resolution SVS level that contains at least as many pixels.  If this
         # is not the same scale as we expect, note the scale factor so we can
-        # load an appropriate area and scale it to the tile size later.
-        maxSize = 16384   # This should probably be based on available memory
+        # build the tile from tiles of the next higher resolution level.
         for level in range(self.levels):
             levelW = max(1, self.sizeX / 2 ** (self.levels - 1 - level))
             levelH = max(1, self.sizeY / 2 ** (self.levels - 1 - level))
@@ -131,20 +183,11 @@ class OpenslideFileTileSource(FileTileSource):
                     break
                 bestlevel = svsAvailableLevels[svslevel]['level']
                 scale = int(round(svsAvailableLevels[svslevel]['width'] / levelW))
-            # If there are no tiles at a particular level, we have to read a
-            # larger area of a higher resolution level.  If such an area would
-            # be excessively large, we could have memroy issues, so raise an
-            # error.
-            if (self.tileWidth * scale > maxSize or
-                    self.tileHeight * scale > maxSize):
-                msg = ('OpenSlide has no small-scale tiles (level %d is at %d '
-                       'scale)' % (level, scale))
-                config.getConfig('logger').info(msg)
-                raise TileSourceException(msg)
             self._svslevels.append({
                 'svslevel': bestlevel,
                 'scale': scale
             })
+        self._prefetched = PrefetchedTiles()
 
     def _getTileSize(self):
         """
@@ -244,6 +287,184 @@ class OpenslideFileTileSource(FileTileSource):
             'mm_y': mm_y,
         }
 
+    def _tileOffset(self, x, y, z):
+        """
+        Get the position of a tile in the coordinates of the full resolution
+        image.
+
+        :param x, y, z: the tile.
+        :returns: the left and top of the tile, or None if the tile is
+            outside of the image.
+        """
+        scale = 2 ** (self.levels - 1 - z)
+        offsetx = x * self.tileWidth * scale
+        offsety = y * self.tileHeight * scale
+        if not (0 <= offsetx < self.sizeX) or not (0 <= offsety < self.sizeY):
+            return None
+        return offsetx, offsety
+
+    def _readRegion(self, offsetx, offsety, svslevel, width, height, **info):
+        """
+        Read a region from OpenSlide as a numpy array.
+
+        :param offsetx, offsety: the position of the region in the full
+            resolution image.
+        :param svslevel: the OpenSlide level to read.
+        :param width, height: the size of the region in the level's pixels.
+        :param **info: values to include in the timing record.
+        :returns: an RGB numpy array, or RGBA if any pixel isn't opaque.
+        """
+        argb = None
+        try:
+            with timing.stage('read', source=self.name, **info):
+                osr = getattr(self._openslide, '_osr', None)
+                if _lowlevelReadRegion is not None and osr is not None:
+                    argb = numpy.empty((height, width), dtype=numpy.uint32)
+                    try:
+                        _lowlevelReadRegion(
+                            osr, argb.ctypes.data_as(ctypes.POINTER(ctypes.c_uint32)),
+                            offsetx, offsety, svslevel, width, height)
+                    except (TypeError, AttributeError, ctypes.ArgumentError) as exc:
+                        # The private interface isn't what we expect
+                        config.getConfig('logger').debug(
+                            'Cannot read OpenSlide regions directly: %r', exc)
+                        argb = None
+                if argb is None:
+                    region = self._openslide.read_region(
+                        (offsetx, offsety), svslevel, (width, height))
+        except openslide.lowlevel.OpenSlideError as exc:
+            raise TileSourceException(
+                'Failed to get OpenSlide region (%r).' % exc)
+        if argb is not None:
+            return _argbToArray(argb)
+        # The image is already unpremultiplied
+        if region.getextrema()[3][0] == 255:
+            region = region.convert('RGB')
+        return numpy.asarray(region)
+
+    def _readTileArray(self, x, y, z):
+        """
+        Read a tile of a level that OpenSlide has at full resolution.  If the
+        tile was read as part of a row, that data is used.
+
+        :param x, y, z: the tile.
+        :returns: an RGB or RGBA numpy array.
+        """
+        tile = self._prefetched.pop((x, y, z))
+        if tile is None:
+            offsetx, offsety = self._tileOffset(x, y, z)
+            tile = self._readRegion(
+                offsetx, offsety, self._svslevels[z]['svslevel'],
+                self.tileWidth, self.tileHeight, x=x, y=y, z=z)
+        return tile
+
+    def _getTileArray(self, x, y, z):
+        """
+        Get a tile as a numpy array.  Tiles of levels that OpenSlide doesn't
+        have at full resolution are built from the four tiles of the next
+        higher resolution level with a 2x2 box filter.  These tiles are
+        cached, so neighboring tiles and lower resolution levels share them.
+
+        :param x, y, z: the tile.
+        :returns: an RGB or RGBA numpy array.  This must not be modified.
+        """
+        return self._cachedTileArray('tilearray', x, y, z)
+
+    @methodcache()
+    def _cachedTileArray(self, kind, x, y, z):
+        """
+        Get a tile as a numpy array.  See _getTileArray.
+
+        :param kind: a constant that keeps the cache keys of these arrays
+            distinct from the keys of tiles from getTile.
+        :param x, y, z: the tile.
+        :returns: an RGB or RGBA numpy array.
+        """
+        if self._svslevels[z]['scale'] == 1:
+            return self._readTileArray(x, y, z)
+        tw, th = self.tileWidth, self.tileHeight
+        # Read the rows the tile is built from together
+        self._prefetchRows(z + 1, [(x * 2 + dx, y * 2 + dy) for dy in range(2) for dx in range(2)])
+        parts = {}
+        for dy in range(2):
+            for dx in range(2):
+                if self._tileOffset(x * 2 + dx, y * 2 + dy, z + 1) is not None:
+                    parts[(dx, dy)] = self._getTileArray(x * 2 + dx, y * 2 + dy, z + 1)
+        # If any part has transparency or is past the edge of the image, so
+        # does the tile.  Missing parts stay transparent.
+        bands = max([3 if len(parts) == 4 else 4] + [part.shape[2] for part in parts.values()])
+        merged = numpy.zeros((th * 2, tw * 2, bands), dtype=numpy.uint8)
+        for (dx, dy), part in parts.items():
+            merged[dy * th:(dy + 1) * th, dx * tw:(dx + 1) * tw, :part.shape[2]] = part
+            if part.shape[2] < bands:
+                merged[dy * th:(dy + 1) * th, dx * tw:(dx + 1) * tw, 3] = 255
+        with timing.stage('resample', source=self.name, x=x, y=y, z=z):
+            blocks = merged.reshape(th, 2, tw, 2, bands)
+            if bands == 3:
+                tile = blocks.sum(axis=(1, 3), dtype=numpy.uint16)
+                tile = ((tile + 2) >> 2).astype(numpy.uint8)
+            else:
+                # Weight the color by the alpha so that transparent pixels
+                # don't darken the pixels they are averaged with
+                alpha = blocks[:, :, :, :, 3].sum(axis=(1, 3), dtype=numpy.uint32)
+                color = (blocks[:, :, :, :, :3] * blocks[:, :, :, :, 3:].astype(
+                    numpy.uint32)).sum(axis=(1, 3))
+                tile = numpy.empty((th, tw, 4), dtype=numpy.uint8)
+                tile[:, :, :3] = (color + alpha[:, :, None] // 2) // numpy.maximum(
+                    alpha, 1)[:, :, None]
+                tile[:, :, 3] = (alpha + 2) >> 2
+        return tile
+
+    def _prefetchTiles(self, level, tiles, frame=None):
+        """
+        Read a row of tiles with one OpenSlide read rather than one read per
+        tile.  For levels that OpenSlide doesn't have at full resolution, the
+        rows of the higher resolution levels that the tiles are built from are
+        read this way, as long as their data fits in the prefetched tile
+        store.  Tiles whose arrays are already cached are not read.
+
+        :param level: the level of the tiles.
+        :param tiles: a list of (x, y) tile indices.
+        :param frame: the frame of the tiles.
+        """
+        if level < 0 or level >= self.levels:
+            return
+        self._prefetchRows(level, tiles)
+
+    def _prefetchRows(self, level, tiles):
+        """
+        Read rows of tiles for _getTileArray.  See _prefetchTiles.
+
+        :param level: the level of the tiles.
+        :param tiles: a list of (x, y) tile indices.
+        """
+        tiles = sorted(
+            ((x, y) for x, y in tiles if self._tileOffset(x, y, level) is not None and
+             not methodcacheContains(self, 'tilearray', x, y, level)),
+            key=lambda tile: (tile[1], tile[0]))
+        scale = self._svslevels[level]['scale']
+        if scale != 1:
+            tileBytes = self.tileWidth * self.tileHeight * 3
+            if len(tiles) * scale * scale * tileBytes <= self._prefetched.maxBytes:
+                for y in sorted({y for _, y in tiles}):
+                    for dy in range(2):
+                        self._prefetchRows(level + 1, [
+                            (x * 2 + dx, y * 2 + dy) for x, ty in tiles if ty == y
+                            for dx in range(2)])
+            return
+        tiles = [tile for tile in tiles if tile + (level, ) not in self._prefetched]
+        for batch in tileRuns(tiles, self._maxBatchTiles):
+            if len(batch) < 2:
+                continue
+            offsetx, offsety = self._tileOffset(batch[0][0], batch[0][1], level)
+            strip = self._readRegion(
+                offsetx, offsety, self._svslevels[level]['svslevel'],
+                self.tileWidth * len(batch), self.tileHeight,
+                x=batch[0][0], y=batch[0][1], z=level, tiles=len(batch))
+            self._prefetched.update(
+                ((x, y, level), strip[:, idx * self.tileWidth:(idx + 1) * self.tileWidth])
+                for idx, (x, y) in enumerate(batch))
+
     @methodcache()
     def getTile(self, x, y, z, pilImageAllowed=False, **kwargs):
         if z < 0:
@@ -263,22 +484,13 @@ class OpenslideFileTileSource(FileTileSource):
         offsety = y * self.tileHeight * scale
         if not (0 <= offsety < self.sizeY):
             raise TileSourceException('y is outside layer')
-        # We ask to read an area that will cover the tile at the z level.  The
-        # scale we computed in the __init__ process for this svs level tells
-        # how much larger a region we need to read.
-        try:
-            tile = self._openslide.read_region(
-                (offsetx, offsety), svslevel['svslevel'],
-                (self.tileWidth * svslevel['scale'],
-                 self.tileHeight * svslevel['scale']))
-        except openslide.lowlevel.OpenSlideError as exc:
-            raise TileSourceException(
-                'Failed to get OpenSlide region (%r).' % exc)
-        # Always scale to the svs level 0 tile size.
-        if svslevel['scale'] != 1:
-            tile = tile.resize((self.tileWidth, self.tileHeight),
-                               PIL.Image.LANCZOS)
-        return self._outputTile(tile, 'PIL', x, y, z, pilImageAllowed, **kwargs)
+        # Tiles of full resolution levels aren't kept as arrays, since the
+        # tile is cached.
+        if svslevel['scale'] == 1:
+            tile = self._readTileArray(x, y, z)
+        else:
+            tile = self._getTileArray(x, y, z)
+        return self._outputTile(tile, TILE_FORMAT_NUMPY, x, y, z, pilImageAllowed, **kwargs)
 
     def getPreferredLevel(self, level):
         """
@@ -19,8 +19,10 @@
 import json
 import math
 import numpy
+import mmap
 import os
 import six
+import threading
 from pkg_resources import DistributionNotFound, get_distribution
 
 import PIL.Image
@@ -28,7 +30,7 @@ import PIL.Image
 from large_image import config
 from large_image.cache_util import LruCacheMetaclass, methodcache, strhash
 from large_image.exceptions import TileSourceException
-from large_image.tilesource import FileTileSource
+from large_image.tilesource import FileTileSource, TILE_FORMAT_NUMPY
 
 
 try:
@@ -60,6 +62,119 @@ def getMaxSize(size=None, maxDefault=4096):
     return maxWidth, maxHeight
 
 
+def _effectiveTileSize(tileSize=None):
+    """
+    Get the size of the tiles that an image is served with.
+
+    :param tileSize: the requested tile size.  If None, the pil_tile_size
+        config setting is used.
+    :returns: the tile size in pixels.  0 means the whole image is a single
+        tile.
+    :raises: ValueError or TypeError if the size isn't an integer.
+    """
+    if tileSize is None:
+        tileSize = config.getConfig('pil_tile_size')
+    return int(tileSize or 0)
+
+
+# Uncompressed PIL raw modes that can be used directly as numpy arrays.  The
+# values are the numpy data type, the number of bands, and whether the order
+# of the bands is reversed.
+_MappableRawModes = {
+    'L': ('u1', 1, False),
+    'LA': ('u1', 2, False),
+    'RGB': ('u1', 3, False),
+    'RGBA': ('u1', 4, False),
+    'BGR': ('u1', 3, True),
+    'I;16': ('<u2', 1, False),
+    'I;16B': ('>u2', 1, False),
+    'I;16S': ('<i2', 1, False),
+    'I;16BS': ('>i2', 1, False),
+    'I;32S': ('<i4', 1, False),
+    'I;32BS': ('>i4', 1, False),
+    'F;32F': ('<f4', 1, False),
+    'F;32BF': ('>f4', 1, False),
+}
+
+
+def _memoryMapImage(path, image):
+    """
+    Memory-map the pixels of an uncompressed image, such as a BMP, PPM, or
+    TIFF file without compression.
+
+    :param path: the path of the image file.
+    :param image: the image opened with PIL.  This is not decoded.
+    :returns: a read-only numpy array of shape (height, width[, bands]) that
+        references the file, or None if the image is compressed or its pixels
+        aren't stored in a single block.
+    """
+    tiles = image.tile
+    if not tiles or any(tile[0] != 'raw' for tile in tiles):
+        return None
+    args = [tile[3] if isinstance(tile[3], tuple) else (tile[3], 0, 1) for tile in tiles]
+    rawmode = args[0][0]
+    if rawmode not in _MappableRawModes or any(arg != args[0] for arg in args):
+        return None
+    dtype, bands, reverse = _MappableRawModes[rawmode]
+    dtype = numpy.dtype(dtype)
+    width, height = image.size
+    stride = args[0][1] or width * bands * dtype.itemsize
+    orientation = args[0][2] if len(args[0]) > 2 else 1
+    # Strips must span the width of the image and follow each other in the file
+    offset = tiles[0][2]
+    for tile in tiles:
+        x0, y0, x1, y1 = tile[1]
+        if x0 or x1 != width or tile[2] != offset + y0 * stride:
+            return None
+    if tiles[0][1][1] or tiles[-1][1][3] != height or orientation not in (1, -1):
+        return None
+    with open(path, 'rb') as fptr:
+        if offset + stride * height > os.fstat(fptr.fileno()).st_size:
+            return None
+        buffer = mmap.mmap(fptr.fileno(), 0, access=mmap.ACCESS_READ)
+    data = numpy.ndarray(
+        (height, width, bands), dtype=dtype, buffer=buffer, offset=offset,
+        strides=(stride, bands * dtype.itemsize, dtype.itemsize))
+    if orientation == -1:
+        data = data[::-1]
+    if reverse:
+        data = data[:, :, ::-1]
+    return data[:, :, 0] if bands == 1 else data
+
+
+def _nativeByteOrder(data):
+    """
+    Get data in the native byte order, since memory-mapped data may not be.
+
+    :param data: a numpy array.
+    :returns: a numpy array in the native byte order.
+    """
+    if data.dtype.isnative:
+        return data
+    return data.astype(data.dtype.newbyteorder('='))
+
+
+def _boxDownsample(data):
+    """
+    Halve the resolution of an image by averaging each 2x2 block of pixels.
+    The last row and column are repeated if the image has an odd size.
+
+    :param data: a numpy array of shape (height, width[, bands]).
+    :returns: a numpy array of the same data type with half the height and
+        width, rounded up.
+    """
+    if data.shape[0] % 2 or data.shape[1] % 2:
+        padding = [(0, data.shape[0] % 2), (0, data.shape[1] % 2)] + [(0, 0)] * (data.ndim - 2)
+        data = numpy.pad(data, padding, mode='edge')
+    blocks = data.reshape((data.shape[0] // 2, 2, data.shape[1] // 2, 2) + data.shape[2:])
+    if data.dtype == numpy.uint8:
+        return ((blocks.sum(axis=(1, 3), dtype=numpy.uint16) + 2) >> 2).astype(numpy.uint8)
+    result = blocks.mean(axis=(1, 3))
+    if data.dtype.kind in 'iu':
+        result = numpy.round(result)
+    return result.astype(data.dtype)
+
+
 @six.add_metaclass(LruCacheMetaclass)
 class PILFileTileSource(FileTileSource):
     """
@@ -71,7 +186,7 @@ class PILFileTileSource(FileTileSource):
     # No extensions or mime types are explicitly added for the PIL tile source,
     # as it should always be a fallback source
 
-    def __init__(self, path, maxSize=None, **kwargs):
+    def __init__(self, path, maxSize=None, tileSize=None, **kwargs):
         """
         Initialize the tile class.  See the base class for other available
         parameters.
@@ -80,6 +195,10 @@ class PILFileTileSource(FileTileSource):
         :param maxSize: either a number or an object with {'width': (width),
             'height': height} in pixels.  If None, the default max size is
             used.
+        :param tileSize: if set, serve the image as a multi-resolution pyramid
+            of tiles of this size.  If None, the pil_tile_size config setting
+            is used.  If that is also None or 0, the whole image is a single
+            tile.
         """
         super(PILFileTileSource, self).__init__(path, **kwargs)
 
@@ -92,6 +211,11 @@ class PILFileTileSource(FileTileSource):
                     'maxSize must be None, an integer, a dictionary, or a '
                     'JSON string that converts to one of those.')
         self.maxSize = maxSize
+        try:
+            tileSize = _effectiveTileSize(tileSize)
+        except (TypeError, ValueError):
+            raise TileSourceException('tileSize must be None or an integer.')
+        self._tileSize = tileSize
 
         largeImagePath = self._getLargeImagePath()
 
@@ -104,28 +228,39 @@ class PILFileTileSource(FileTileSource):
             self._pilImage = PIL.Image.open(largeImagePath)
         except IOError:
             raise TileSourceException('File cannot be opened via PIL.')
-        # If this is encoded as a 32-bit integer or a 32-bit float, convert it
-        # to an 8-bit integer.  This expects the source value to either have a
-        # maximum of 1, 2^8-1, 2^16-1, 2^24-1, or 2^32-1, and scales it to
-        # [0, 255]
-        pilImageMode = self._pilImage.mode.split(';')[0]
-        if pilImageMode in ('I', 'F'):
-            imgdata = numpy.asarray(self._pilImage)
-            maxval = 256 ** math.ceil(math.log(numpy.max(imgdata) + 1, 256)) - 1
-            self._pilImage = PIL.Image.fromarray(numpy.uint8(numpy.multiply(
-                imgdata, 255.0 / maxval)))
+        # Images that are encoded as 32-bit integers or 32-bit floats are
+        # converted to 8-bit integers when tiles are requested.  Nothing is
+        # decoded until then.
+        self._nativeMode = self._pilImage.mode.split(';')[0] in ('I', 'F')
+        self._nativeImage = None
+        self._mappedImage = None
+        self._maxval = None
+        self._image8Bit = None
+        self._loaded = False
+        self._loadLock = threading.Lock()
         self.sizeX = self._pilImage.width
         self.sizeY = self._pilImage.height
-        # We have just one tile which is the entire image.
-        self.tileWidth = self.sizeX
-        self.tileHeight = self.sizeY
-        self.levels = 1
         # Throw an exception if too big
-        if self.tileWidth <= 0 or self.tileHeight <= 0:
+        if self.sizeX <= 0 or self.sizeY <= 0:
             raise TileSourceException('PIL tile size is invalid.')
         maxWidth, maxHeight = getMaxSize(maxSize, self.defaultMaxSize())
-        if self.tileWidth > maxWidth or self.tileHeight > maxHeight:
+        if self.sizeX > maxWidth or self.sizeY > maxHeight:
             raise TileSourceException('PIL tile size is too large.')
+        # Arrays of each level of the pyramid, keyed by (native, level).
+        # These are only computed when used.
+        self._levelArrays = {}
+        self._levelArraysLock = threading.Lock()
+        self._pyramid = tileSize > 0
+        if not self._pyramid:
+            # We have just one tile which is the entire image.
+            self.tileWidth = self.sizeX
+            self.tileHeight = self.sizeY
+            self.levels = 1
+            return
+        self.tileWidth = self.tileHeight = tileSize
+        self.levels = max(1, int(math.ceil(max(
+            math.log(float(self.sizeX) / self.tileWidth),
+            math.log(float(self.sizeY) / self.tileHeight)) / math.log(2))) + 1)
 
     def defaultMaxSize(self):
         """
@@ -137,22 +272,143 @@ class PILFileTileSource(FileTileSource):
 
     @staticmethod
     def getLRUHash(*args, **kwargs):
+        # The tile size from the config is part of the hash, so sources opened
+        # with different config settings aren't shared.
+        tileSize = kwargs.get('tileSize')
+        try:
+            tileSize = _effectiveTileSize(tileSize)
+        except (TypeError, ValueError):
+            pass
         return strhash(
             super(PILFileTileSource, PILFileTileSource).getLRUHash(
                 *args, **kwargs),
-            kwargs.get('maxSize'))
+            kwargs.get('maxSize'), tileSize)
 
     def getState(self):
         return super(PILFileTileSource, self).getState() + ',' + str(
-            self._maxSize)
+            self._maxSize) + ',' + str(self._tileSize)
+
+    def _loadImage(self):
+        """
+        Get the pixels of the image the first time a tile is requested.
+        Uncompressed images are memory-mapped rather than decoded.
+        """
+        if self._loaded:
+            return
+        with self._loadLock:
+            if self._loaded:
+                return
+            try:
+                mapped = _memoryMapImage(self._getLargeImagePath(), self._pilImage)
+            except (IOError, OSError, ValueError) as exc:
+                config.getConfig('logger').debug('Failed to memory-map image: %s', exc)
+                mapped = None
+            if self._nativeMode:
+                self._nativeImage = mapped if mapped is not None else numpy.asarray(
+                    self._pilImage)
+            self._mappedImage = mapped
+            self._loaded = True
+
+    def _scaleTo8Bit(self, data):
+        """
+        Convert data from an image encoded as 32-bit integers or 32-bit floats
+        to 8-bit integers.  This expects the source value to either have a
+        maximum of 1, 2^8-1, 2^16-1, 2^24-1, or 2^32-1, and scales it to
+        [0, 255].
+
+        :param data: a numpy array of part or all of the native image.
+        :returns: a uint8 numpy array.
+        """
+        if self._maxval is None:
+            maxval = float(numpy.max(self._nativeImage))
+            self._maxval = 256 ** math.ceil(math.log(maxval + 1, 256)) - 1
+        return numpy.uint8(numpy.multiply(data, 255.0 / self._maxval))
+
+    def _getLevelArray(self, z):
+        """
+        Get the pixels of a level of the pyramid.  The full resolution level
+        is the image itself; each lower resolution level is computed from the
+        next higher resolution level with a 2x2 box filter the first time it
+        is used.
+
+        :param z: the level.
+        :returns: a numpy array of shape (height, width[, bands]).  This is in
+            the native data type for images encoded as 32-bit integers or
+            32-bit floats and 8-bit otherwise.  This must not be modified.
+        """
+        with self._levelArraysLock:
+            data = self._levelArrays.get(z)
+        if data is not None:
+            return data
+        if z == self.levels - 1:
+            self._loadImage()
+            if self._nativeImage is not None:
+                data = self._nativeImage
+            elif (self._mappedImage is not None and
+                    self._pilImage.mode in ('L', 'LA', 'RGB', 'RGBA')):
+                data = self._mappedImage
+            else:
+                # Decode a separate copy of the image so that the decoded
+                # pixels aren't also kept by the image we opened.
+                image = PIL.Image.open(self._getLargeImagePath())
+                if image.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+                    image = image.convert(
+                        'RGBA' if 'A' in image.mode or 'transparency' in image.info
+                        else 'RGB')
+                data = numpy.asarray(image)
+        else:
+            data = _boxDownsample(self._getLevelArray(z + 1))
+        with self._levelArraysLock:
+            self._levelArrays[z] = data
+        return data
 
     @methodcache()
     def getTile(self, x, y, z, pilImageAllowed=False, mayRedirect=False, **kwargs):
+        if self._pyramid:
+            return self._getPyramidTile(x, y, z, pilImageAllowed, **kwargs)
         if z != 0:
             raise TileSourceException('z layer does not exist')
         if x != 0:
             raise TileSourceException('x is outside layer')
         if y != 0:
             raise TileSourceException('y is outside layer')
-        return self._outputTile(self._pilImage, 'PIL', x, y, z,
+        self._loadImage()
+        image = self._pilImage
+        if self._nativeImage is not None:
+            if kwargs.get('numpyAllowed') == 'always':
+                return self._outputTile(_nativeByteOrder(self._nativeImage), TILE_FORMAT_NUMPY,
+                                        x, y, z, pilImageAllowed, **kwargs)
+            if self._image8Bit is None:
+                self._image8Bit = PIL.Image.fromarray(self._scaleTo8Bit(self._nativeImage))
+            image = self._image8Bit
+        return self._outputTile(image, 'PIL', x, y, z,
                                 pilImageAllowed, **kwargs)
+
+    def _getPyramidTile(self, x, y, z, pilImageAllowed=False, **kwargs):
+        """
+        Get a tile of the pyramid.  Tiles on the right and bottom edges of a
+        level are padded with zeros to the full tile size; the edge option of
+        the source can crop or fill them.
+
+        :param x, y, z: the tile.
+        :param pilImageAllowed: True if a PIL image may be returned.
+        :returns: the tile in the same form as getTile.
+        """
+        if z < 0 or z >= self.levels:
+            raise TileSourceException('z layer does not exist')
+        data = self._getLevelArray(z)
+        if x < 0 or x * self.tileWidth >= data.shape[1]:
+            raise TileSourceException('x is outside layer')
+        if y < 0 or y * self.tileHeight >= data.shape[0]:
+            raise TileSourceException('y is outside layer')
+        tile = data[y * self.tileHeight:(y + 1) * self.tileHeight,
+                    x * self.tileWidth:(x + 1) * self.tileWidth]
+        if tile.shape[:2] != (self.tileHeight, self.tileWidth):
+            padded = numpy.zeros(
+                (self.tileHeight, self.tileWidth) + tile.shape[2:], dtype=tile.dtype)
+            padded[:tile.shape[0], :tile.shape[1]] = tile
+            tile = padded
+        if self._nativeImage is not None and kwargs.get('numpyAllowed') != 'always':
+            tile = self._scaleTo8Bit(tile)
+        return self._outputTile(
+            _nativeByteOrder(tile), TILE_FORMAT_NUMPY, x, y, z, pilImageAllowed, **kwargs)
@@ -19,6 +19,7 @@
 import base64
 import itertools
 import math
+import numpy
 import PIL.Image
 import six
 from pkg_resources import DistributionNotFound, get_distribution
@@ -26,12 +27,13 @@ from six import BytesIO
 from six.moves import range
 
 from large_image import config
-from large_image.cache_util import LruCacheMetaclass, methodcache
+from large_image.cache_util import DiskTileStore, LruCacheMetaclass, fileIdentity, methodcache
 from large_image.constants import SourcePriority
 from large_image.exceptions import TileSourceException
-from large_image.tilesource import FileTileSource, TILE_FORMAT_PIL, nearPowerOfTwo
+from large_image.tilesource import FileTileSource, TILE_FORMAT_NUMPY, TILE_FORMAT_PIL, \
+    nearPowerOfTwo, timing
 
-from .tiff_reader import TiledTiffDirectory, TiffException, \
+from .tiff_reader import TiledTiffDirectory, TiffException, TiffFileHandle, \
     InvalidOperationTiffException, IOTiffException, ValidationTiffException
 
 
@@ -63,6 +65,8 @@ class TiffFileTileSource(FileTileSource):
         'image/x-tiff': SourcePriority.HIGH,
         'image/x-ptif': SourcePriority.PREFERRED,
     }
+    # Little and big endian classic TIFF and BigTIFF
+    magicBytes = [b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+']
 
     def __init__(self, path, **kwargs):
         """
@@ -80,15 +84,20 @@ class TiffFileTileSource(FileTileSource):
         # Individual TIFF images can also have images embedded into their
         # directory as tags (this is a vendor-specific method of adding more
         # images into a file) -- those are stored in the individual
-        # directories' _embeddedImages field.
+        # directories' _embeddedImages field.  Associated images are only read
+        # when they are requested; this maps their names to their directories.
+        self._associatedImageDirectories = {}
         self._associatedImages = {}
+        # All directories read the file through one file descriptor
+        self._fileHandle = TiffFileHandle(largeImagePath)
 
         # Query all know directories in the tif file.  Only keep track of
         # directories that contain tiled images.
         alldir = []
         for directoryNum in itertools.count():  # pragma: no branch
             try:
-                td = TiledTiffDirectory(largeImagePath, directoryNum)
+                td = TiledTiffDirectory(
+                    largeImagePath, directoryNum, fileHandle=self._fileHandle)
             except ValidationTiffException as exc:
                 lastException = exc
                 self._addAssociatedImage(largeImagePath, directoryNum)
@@ -128,7 +137,7 @@ class TiffFileTileSource(FileTileSource):
             level = tdir[2]
             if (td.tileWidth != highest.tileWidth or
                     td.tileHeight != highest.tileHeight):
-                if not len(self._associatedImages):
+                if not len(self._associatedImageDirectories):
                     self._addAssociatedImage(largeImagePath, tdir[-2], True, highest)
                 continue
             # If a layer's image is not a multiple of the tile size, it should
@@ -157,7 +166,8 @@ class TiffFileTileSource(FileTileSource):
         """
         Check if the specified TIFF directory contains an image with a sensible
         image description that can be used as an ID.  If so, and if the image
-        isn't too large, add this image as an associated image.
+        isn't too large, add this image as an associated image.  The image is
+        read when it is first requested.
 
         :param largeImagePath: path to the TIFF file.
         :param directoryNum: libtiff directory number of the image.
@@ -167,14 +177,15 @@ class TiffFileTileSource(FileTileSource):
            image.
         """
         try:
-            associated = TiledTiffDirectory(largeImagePath, directoryNum, mustBeTiled)
+            associated = TiledTiffDirectory(
+                largeImagePath, directoryNum, mustBeTiled, fileHandle=self._fileHandle)
             id = ''
             if associated._tiffInfo.get('imagedescription'):
                 id = associated._tiffInfo.get(
                     'imagedescription').strip().split(None, 1)[0].lower()
             elif mustBeTiled:
                 id = 'dir%d' % directoryNum
-                if not len(self._associatedImages):
+                if not len(self._associatedImageDirectories):
                     id = 'macro'
             if not isinstance(id, six.text_type):
                 id = id.decode('utf8')
@@ -184,14 +195,17 @@ class TiffFileTileSource(FileTileSource):
             if (id.isalnum() and len(id) > 3 and len(id) <= 20 and
                     associated._pixelInfo['width'] <= 8192 and
                     associated._pixelInfo['height'] <= 8192):
-                image = associated._tiffFile.read_image()
                 # Optrascan scanners store xml image descriptions in a "tiled
                 # image".  Check if this is the case, and, if so, parse such
-                # data
-                if image.tobytes()[:6] == b'<?xml ':
-                    self._parseImageXml(image.tobytes().rsplit(b'>', 1)[0] + b'>', topImage)
-                    return
-                self._associatedImages[id] = image
+                # data.  Only the start of the data is read to check this; if
+                # that can't be done, the image is read, but not kept.
+                prefix = associated._peekImageData(6)
+                if prefix is None or prefix == b'<?xml ':
+                    data = associated._tiffFile.read_image().tobytes()
+                    if data[:6] == b'<?xml ':
+                        self._parseImageXml(data.rsplit(b'>', 1)[0] + b'>', topImage)
+                        return
+                self._associatedImageDirectories[id] = (directoryNum, mustBeTiled)
         except (TiffException, AttributeError):
             # If we can't validate or read an associated image or it has no
             # useful imagedescription, fail quietly without adding an
@@ -203,6 +217,26 @@ class TiffFileTileSource(FileTileSource):
             config.getConfig('logger').exception(
                 'Could not use non-tiled TIFF image as an associated image.')
 
+    def _readAssociatedImage(self, imageKey):
+        """
+        Read an associated image that was found when the file was opened.
+
+        :param imageKey: the key of the associated image.
+        :return: the image as a numpy array or None.
+        """
+        directoryNum, mustBeTiled = self._associatedImageDirectories[imageKey]
+        try:
+            associated = TiledTiffDirectory(
+                self._getLargeImagePath(), directoryNum, mustBeTiled,
+                fileHandle=self._fileHandle)
+            return associated._tiffFile.read_image()
+        except (TiffException, AttributeError):
+            return None
+        except Exception:
+            config.getConfig('logger').exception(
+                'Could not read TIFF associated image %s.', imageKey)
+            return None
+
     def _parseImageXml(self, xml, topImage):
         """
         Parse metadata stored in arbitrary xml and associate it with a specific
@@ -248,6 +282,22 @@ class TiffFileTileSource(FileTileSource):
             'mm_y': mm_y,
         }
 
+    def _nativeBits(self):
+        """
+        Get the number of bits used by 16-bit samples, such as 12 for images
+        from 12-bit sensors.  This is based on the MaxSampleValue tag of the
+        highest resolution image rather than its data, so dim images aren't
+        brightened.  See the base class.
+
+        :returns: the number of bits or None to use all of the bits of the
+            data type.
+        """
+        info = self._tiffDirectories[-1]._tiffInfo
+        if info.get('bitspersample') != 16 or not info.get('maxsamplevalue'):
+            return None
+        bits = max(8, int(info['maxsamplevalue']).bit_length())
+        return bits if bits < 16 else None
+
     @methodcache()
     def getTile(self, x, y, z, pilImageAllowed=False, sparseFallback=False,
                 **kwargs):
@@ -260,10 +310,13 @@ class TiffFileTileSource(FileTileSource):
                 tile = self.getTileFromEmptyDirectory(x, y, z, **kwargs)
                 format = TILE_FORMAT_PIL
             else:
-                tile = self._tiffDirectories[z].getTile(x, y)
+                tile = self._tiffDirectories[z].getTile(
+                    x, y, asarray=kwargs.get('numpyAllowed') == 'always')
                 format = 'JPEG'
             if isinstance(tile, PIL.Image.Image):
                 format = TILE_FORMAT_PIL
+            if isinstance(tile, numpy.ndarray):
+                format = TILE_FORMAT_NUMPY
             return self._outputTile(tile, format, x, y, z, pilImageAllowed,
                                     **kwargs)
         except IndexError:
@@ -275,59 +328,157 @@ class TiffFileTileSource(FileTileSource):
                 x, y, z, pilImageAllowed=pilImageAllowed,
                 sparseFallback=sparseFallback, exception=e, **kwargs)
 
+    def _prefetchTiles(self, level, tiles, frame=None):
+        """
+        Read the data of a group of tiles in bulk.  See the base class.
+
+        :param level: the level of the tiles.
+        :param tiles: a list of (x, y) tile indices.
+        :param frame: the frame of the tiles, if any.
+        """
+        if 0 <= level < len(self._tiffDirectories) and self._tiffDirectories[level]:
+            try:
+                self._tiffDirectories[level].prefetchTiles(tiles)
+            except (TiffException, IOError, OSError) as exc:
+                # Tiles will be read individually and report any errors then
+                config.getConfig('logger').debug('Failed to prefetch tiles: %s', exc)
+
+    def _getOverviewStore(self):
+        """
+        Get the store used for tiles that are synthesized from other tiles.
+
+        :returns: a DiskTileStore or None if tiles aren't stored on disk.
+        """
+        root = config.getConfig('cache_overview_path')
+        if not root:
+            return None
+        store = getattr(self, '_overviewStore', None)
+        if store is None or store.root != root:
+            # Stores are based on the file's contents, so copies of a file
+            # share them regardless of where they are.
+            store = DiskTileStore(
+                root, fileIdentity(self._getLargeImagePath()),
+                self.tileWidth, self.tileHeight, self.levels)
+            self._overviewStore = store
+        return store
+
     def getTileIOTiffException(self, x, y, z, pilImageAllowed=False,
                                sparseFallback=False, exception=None, **kwargs):
         if sparseFallback and z and PIL:
-            noedge = kwargs.copy()
-            noedge.pop('edge', None)
-            image = self.getTile(
-                x / 2, y / 2, z - 1, pilImageAllowed=True,
-                sparseFallback=sparseFallback, edge=False, **noedge)
-            if not isinstance(image, PIL.Image.Image):
-                image = PIL.Image.open(BytesIO(image))
-            image = image.crop((
-                self.tileWidth / 2 if x % 2 else 0,
-                self.tileHeight / 2 if y % 2 else 0,
-                self.tileWidth if x % 2 else self.tileWidth / 2,
-                self.tileHeight if y % 2 else self.tileHeight / 2))
-            image = image.resize((self.tileWidth, self.tileHeight))
+            store = self._getOverviewStore()
+            image = None
+            # Tiles synthesized for missing levels use the same store, so only
+            # store tiles of levels that exist.
+            if store is not None and self._tiffDirectories[z] is not None:
+                image = store.get(z, x, y, kwargs.get('frame'))
+            if image is None:
+                image = self._getSparseTileFromParent(x, y, z, **kwargs)
+                if store is not None and self._tiffDirectories[z] is not None:
+                    store.put(image, z, x, y, kwargs.get('frame'))
             return self._outputTile(image, 'PIL', x, y, z, pilImageAllowed,
                                     **kwargs)
         raise TileSourceException('Internal I/O failure: %s' % exception.args[0])
 
+    def _getSparseTileFromParent(self, x, y, z, **kwargs):
+        """
+        Make a tile that is missing from a level by enlarging part of a tile
+        from the next lower resolution level.
+
+        :param x: location of tile within original level.
+        :param y: location of tile within original level.
+        :param z: original level.
+        :returns: tile in PIL format.
+        """
+        noedge = kwargs.copy()
+        noedge.pop('edge', None)
+        noedge.pop('numpyAllowed', None)
+        image = self.getTile(
+            x / 2, y / 2, z - 1, pilImageAllowed=True,
+            sparseFallback=True, edge=False, **noedge)
+        if not isinstance(image, PIL.Image.Image):
+            image = PIL.Image.open(BytesIO(image))
+        image = image.crop((
+            self.tileWidth / 2 if x % 2 else 0,
+            self.tileHeight / 2 if y % 2 else 0,
+            self.tileWidth if x % 2 else self.tileWidth / 2,
+            self.tileHeight if y % 2 else self.tileHeight / 2))
+        return image.resize((self.tileWidth, self.tileHeight))
+
     def getTileFromEmptyDirectory(self, x, y, z, **kwargs):
         """
         Given the x, y, z tile location in an unpopulated level, get tiles from
-        higher resolution levels to make the lower-res tile.
+        the next higher resolution level to make the lower-res tile.  If that
+        level is also unpopulated, its tiles are made the same way.  When
+        cache_overview_path is configured, made tiles are stored there and
+        reused.
 
         :param x: location of tile within original level.
         :param y: location of tile within original level.
         :param z: original level.
         :returns: tile in PIL format.
         """
-        scale = 1
-        while self._tiffDirectories[z] is None:
-            scale *= 2
-            z += 1
+        frame = kwargs.get('frame')
+        store = self._getOverviewStore()
+        if store is not None:
+            tile = store.get(z, x, y, frame)
+            if tile is not None:
+                return tile
         tile = PIL.Image.new(
-            'RGBA', (self.tileWidth * scale, self.tileHeight * scale))
-        maxX = 2.0 ** (z + 1 - self.levels) * self.sizeX / self.tileWidth
-        maxY = 2.0 ** (z + 1 - self.levels) * self.sizeY / self.tileHeight
-        for newX in range(scale):
-            for newY in range(scale):
-                if ((newX or newY) and ((x * scale + newX) >= maxX or
-                                        (y * scale + newY) >= maxY)):
+            'RGBA', (self.tileWidth * 2, self.tileHeight * 2))
+        maxX = 2.0 ** (z + 2 - self.levels) * self.sizeX / self.tileWidth
+        maxY = 2.0 ** (z + 2 - self.levels) * self.sizeY / self.tileHeight
+        for newX in range(2):
+            for newY in range(2):
+                if ((newX or newY) and ((x * 2 + newX) >= maxX or
+                                        (y * 2 + newY) >= maxY)):
                     continue
+                # Missing tiles of populated levels are made from lower
+                # resolution levels; tiles of unpopulated levels are made from
+                # higher resolution levels.
                 subtile = self.getTile(
-                    x * scale + newX, y * scale + newY, z,
-                    pilImageAllowed=True, sparseFallback=True, edge=False,
-                    frame=kwargs.get('frame'))
+                    x * 2 + newX, y * 2 + newY, z + 1,
+                    pilImageAllowed=True,
+                    sparseFallback=self._tiffDirectories[z + 1] is not None,
+                    edge=False, frame=frame)
                 if not isinstance(subtile, PIL.Image.Image):
                     subtile = PIL.Image.open(BytesIO(subtile))
                 tile.paste(subtile, (newX * self.tileWidth,
                                      newY * self.tileHeight))
-        return tile.resize((self.tileWidth, self.tileHeight),
-                           PIL.Image.LANCZOS)
+        with timing.stage('resample', source=self.name, x=x, y=y, z=z):
+            tile = tile.resize((self.tileWidth, self.tileHeight),
+                               PIL.Image.LANCZOS)
+        if store is not None:
+            store.put(tile, z, x, y, frame)
+        return tile
+
+    def generateOverviews(self, frame=None):
+        """
+        Make and store all of the tiles of unpopulated levels, starting with
+        the highest resolution level that is missing so that each tile is made
+        from four stored tiles.  This can be run in the background, such as
+        with the large_image_tasks generate_overviews task; tiles that are
+        already stored are skipped.  The tiles are stored in the
+        cache_overview_path directory, so they are only used by processes that
+        have the same cache_overview_path configured.
+
+        :param frame: the frame to generate, if any.
+        :returns: the number of tiles in unpopulated levels.
+        """
+        if self._getOverviewStore() is None:
+            raise TileSourceException(
+                'cache_overview_path must be configured to generate overviews.')
+        count = 0
+        for z in range(self.levels - 1, -1, -1):
+            if self._tiffDirectories[z] is not None:
+                continue
+            scale = 2 ** (self.levels - 1 - z)
+            tilesX = int(math.ceil(float(self.sizeX) / scale / self.tileWidth))
+            tilesY = int(math.ceil(float(self.sizeY) / scale / self.tileHeight))
+            for y in range(tilesY):
+                for x in range(tilesX):
+                    self.getTileFromEmptyDirectory(x, y, z, frame=frame)
+                    count += 1
+        return count
 
     def getPreferredLevel(self, level):
         """
@@ -349,7 +500,7 @@ class TiffFileTileSource(FileTileSource):
 
         :return: the list of image keys.
         """
-        imageList = set(self._associatedImages)
+        imageList = set(self._associatedImageDirectories)
         for td in self._tiffDirectories:
             if td is not None:
                 imageList |= set(td._embeddedImages)
@@ -373,6 +524,12 @@ class TiffFileTileSource(FileTileSource):
             if td is not None and imageKey in td._embeddedImages:
                 image = PIL.Image.open(BytesIO(base64.b64decode(td._embeddedImages[imageKey])))
                 return image
-        if imageKey in self._associatedImages:
-            return PIL.Image.fromarray(self._associatedImages[imageKey])
-        return None
+        if imageKey not in self._associatedImageDirectories:
+            return None
+        # Keep the image once it has been read
+        if imageKey not in self._associatedImages:
+            image = self._readAssociatedImage(imageKey)
+            if image is None:
+                return None
+            self._associatedImages[imageKey] = image
+        return PIL.Image.fromarray(self._associatedImages[imageKey])
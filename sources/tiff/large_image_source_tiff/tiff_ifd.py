@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Read the image file directories (IFDs) of a TIFF file without libtiff.
+
+Opening a file with libtiff and selecting each directory in turn is slow,
+especially for files with many directories.  This reads the header and the tag
+tables of every directory in the main chain with a few buffered reads, for both
+classic TIFF and BigTIFF files.
+"""
+
+import numpy
+import os
+import struct
+import threading
+
+from large_image.cache_util import LRUCache
+
+
+# TIFF data types: (numpy type, size of each value in bytes).  Rationals are
+# pairs of integers.
+DataTypes = {
+    1: ('u1', 1),   # BYTE
+    2: ('S1', 1),   # ASCII
+    3: ('u2', 2),   # SHORT
+    4: ('u4', 4),   # LONG
+    5: ('u4', 8),   # RATIONAL
+    6: ('i1', 1),   # SBYTE
+    7: ('S1', 1),   # UNDEFINED
+    8: ('i2', 2),   # SSHORT
+    9: ('i4', 4),   # SLONG
+    10: ('i4', 8),  # SRATIONAL
+    11: ('f4', 4),  # FLOAT
+    12: ('f8', 8),  # DOUBLE
+    13: ('u4', 4),  # IFD
+    16: ('u8', 8),  # LONG8
+    17: ('i8', 8),  # SLONG8
+    18: ('u8', 8),  # IFD8
+}
+
+# Limits that guard against looping or huge allocations on corrupt files.
+MaxDirectories = 65536
+MaxTagsPerDirectory = 4096
+
+_infoCache = LRUCache(maxsize=64)
+_infoCacheLock = threading.Lock()
+
+
+def _readAt(fptr, offset, length):
+    """
+    Read bytes from a file at an offset.
+
+    :param fptr: an open file object.
+    :param offset: the offset within the file.
+    :param length: the number of bytes to read.
+    :returns: the bytes read.
+    :raises: ValueError if the file is too short.
+    """
+    fptr.seek(offset)
+    data = fptr.read(length)
+    if len(data) != length:
+        raise ValueError('TIFF file is truncated')
+    return data
+
+
+def _decodeValue(data, datatype, count, endian):
+    """
+    Decode the value of a tag.
+
+    :param data: the bytes of the value.
+    :param datatype: the TIFF data type.
+    :param count: the number of values.
+    :param endian: '<' or '>'.
+    :returns: bytes for ASCII, BYTE, and UNDEFINED tags, a numpy float64 array
+        for rationals, and a numpy array of the appropriate type for other
+        numeric tags.
+    """
+    if datatype == 2:
+        return data.rstrip(b'\0')
+    if datatype in (1, 7):
+        return data
+    dtype = endian + DataTypes[datatype][0]
+    if datatype in (5, 10):
+        values = numpy.frombuffer(data, dtype=dtype, count=count * 2)
+        return values[0::2].astype(float) / numpy.where(values[1::2], values[1::2], 1)
+    return numpy.frombuffer(data, dtype=dtype, count=count)
+
+
+def _readDirectory(fptr, offset, endian, bigtiff, fileSize):
+    """
+    Read a single image file directory.
+
+    :param fptr: an open file object.
+    :param offset: the offset of the directory.
+    :param endian: '<' or '>'.
+    :param bigtiff: True if this is a BigTIFF file.
+    :param fileSize: the size of the file in bytes.
+    :returns: ifd, nextOffset: ifd is a dictionary with offset and tags, where
+        tags is a dictionary keyed by tag number with values of dictionaries
+        with datatype, count, offset (None if the value is stored in the tag
+        entry), and data (the decoded value).  nextOffset is the offset of the
+        next directory or 0.
+    """
+    # The number of tags, the count within each tag entry, and offsets are
+    # all larger in BigTIFF files.
+    if bigtiff:
+        numTagsFormat, entryFormat, pointerFormat = 'Q', 'HHQ', 'Q'
+    else:
+        numTagsFormat, entryFormat, pointerFormat = 'H', 'HHI', 'I'
+    numTagsSize = struct.calcsize('<' + numTagsFormat)
+    pointerSize = struct.calcsize('<' + pointerFormat)
+    entrySize = struct.calcsize('<' + entryFormat) + pointerSize
+    numTags = struct.unpack(endian + numTagsFormat, _readAt(fptr, offset, numTagsSize))[0]
+    if numTags > MaxTagsPerDirectory:
+        raise ValueError('TIFF directory has too many tags')
+    data = _readAt(fptr, offset + numTagsSize, numTags * entrySize + pointerSize)
+    tags = {}
+    for idx in range(numTags):
+        entry = data[idx * entrySize:(idx + 1) * entrySize]
+        tag, datatype, count = struct.unpack(endian + entryFormat, entry[:-pointerSize])
+        if datatype not in DataTypes:
+            # Skip tags of unknown types, as libtiff does
+            continue
+        length = DataTypes[datatype][1] * count
+        if length <= pointerSize:
+            valueOffset = None
+            value = entry[-pointerSize:][:length]
+        else:
+            valueOffset = struct.unpack(endian + pointerFormat, entry[-pointerSize:])[0]
+            if valueOffset + length > fileSize:
+                continue
+            value = _readAt(fptr, valueOffset, length)
+        tags[tag] = {
+            'datatype': datatype,
+            'count': count,
+            'offset': valueOffset,
+            'data': _decodeValue(value, datatype, count, endian),
+        }
+    nextOffset = struct.unpack(endian + pointerFormat, data[-pointerSize:])[0]
+    return {'offset': offset, 'tags': tags}, nextOffset
+
+
+def _readTiffInfo(path):
+    """
+    Read the header and all of the directories in the main chain of a TIFF
+    file.
+
+    :param path: the path of the file.
+    :returns: see readTiffInfo.
+    """
+    with open(path, 'rb') as fptr:
+        fptr.seek(0, os.SEEK_END)
+        fileSize = fptr.tell()
+        header = _readAt(fptr, 0, 16) if fileSize >= 16 else _readAt(fptr, 0, 8)
+        if header[:2] == b'II':
+            endian = '<'
+        elif header[:2] == b'MM':
+            endian = '>'
+        else:
+            raise ValueError('Not a TIFF file')
+        version = struct.unpack(endian + 'H', header[2:4])[0]
+        if version == 42:
+            bigtiff = False
+            offset = struct.unpack(endian + 'I', header[4:8])[0]
+        elif version == 43 and len(header) == 16:
+            bigtiff = True
+            offset = struct.unpack(endian + 'Q', header[8:16])[0]
+        else:
+            raise ValueError('Not a TIFF file')
+        ifds = []
+        seen = set()
+        while offset and offset < fileSize and offset not in seen:
+            if len(ifds) >= MaxDirectories:
+                raise ValueError('TIFF file has too many directories')
+            seen.add(offset)
+            try:
+                ifd, offset = _readDirectory(fptr, offset, endian, bigtiff, fileSize)
+            except ValueError:
+                # libtiff stops at a damaged directory after the first
+                if not ifds:
+                    raise
+                break
+            ifds.append(ifd)
+    return {
+        'path': path,
+        'size': fileSize,
+        'bigEndian': endian == '>',
+        'bigtiff': bigtiff,
+        'ifds': ifds,
+    }
+
+
+def readTiffInfo(path):
+    """
+    Read the header and the tags of all of the directories in the main chain
+    of a TIFF file.  Results are cached based on the path, size, and
+    modification time of the file.
+
+    :param path: the path of the file.
+    :returns: a dictionary with path, size (of the file in bytes), bigEndian,
+        bigtiff, and ifds.  ifds is a list with one entry per directory in the
+        same order as libtiff numbers directories.  Each entry is a dictionary
+        with offset (of the directory in the file) and tags, a dictionary keyed
+        by tag number.  Each tag is a dictionary of datatype, count, offset
+        (None if the value is stored in the directory entry), and data.  data
+        is bytes for ASCII (without trailing nulls), BYTE, and UNDEFINED tags,
+        and a numpy array for all other tags.  This must not be modified.
+    :raises: ValueError if the file is not a TIFF file or cannot be parsed.
+        IOError or OSError if the file cannot be read.
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    with _infoCacheLock:
+        info = _infoCache.get(key)
+    if info is None:
+        try:
+            info = _readTiffInfo(path)
+        except struct.error as exc:
+            raise ValueError('TIFF file could not be parsed: %s' % exc)
+        with _infoCacheLock:
+            _infoCache[key] = info
+    return info
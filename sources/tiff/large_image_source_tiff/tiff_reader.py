@@ -18,16 +18,28 @@
 
 import ctypes
 import PIL.Image
+import numpy
 import os
 import six
+import sys
 import threading
+import zlib
 
 from functools import partial
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from xml.etree import cElementTree
 
 from large_image import config
 from large_image.cache_util import LRUCache, strhash, methodcache
-from large_image.tilesource import etreeToDict
+from large_image.tilesource import PrefetchedTiles, etreeToDict, timing
+
+from .tiff_ifd import readTiffInfo
+
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
 
 try:
     from libtiff import libtiff_ctypes
@@ -64,10 +76,105 @@ def patchLibtiff():
 patchLibtiff()
 
 
+def _tiffTagNames():
+    """
+    Get the lowercase libtiff names of the tags that are stored in a file.
+
+    :returns: a dictionary keyed by tag number.  Each value is a list of names.
+    """
+    names = {}
+    for key in dir(libtiff_ctypes.tiff_h):
+        if key.startswith('TIFFTAG_'):
+            tag = getattr(libtiff_ctypes.tiff_h, key)
+            # Larger values are libtiff pseudo-tags that aren't in files
+            if isinstance(tag, six.integer_types) and tag < 65536:
+                names.setdefault(tag, []).append(key.split('_', 1)[1].lower())
+    return names
+
+
+TiffTagNames = _tiffTagNames()
+# Tags whose values are not included in the metadata, either because they are
+# large arrays or because they are binary data.
+TiffTagsNotInMetadata = {
+    libtiff_ctypes.TIFFTAG_STRIPOFFSETS,
+    libtiff_ctypes.TIFFTAG_STRIPBYTECOUNTS,
+    libtiff_ctypes.TIFFTAG_TILEOFFSETS,
+    libtiff_ctypes.TIFFTAG_TILEBYTECOUNTS,
+    libtiff_ctypes.TIFFTAG_JPEGTABLES,
+}
+# Tags that libtiff reports as a single value even if there is a value per
+# sample.
+TiffTagsPerSample = {
+    libtiff_ctypes.TIFFTAG_BITSPERSAMPLE,
+    libtiff_ctypes.TIFFTAG_MAXSAMPLEVALUE,
+    libtiff_ctypes.TIFFTAG_SAMPLEFORMAT,
+}
+# Values libtiff sets when reading a directory if they are not in the file.
+TiffTagDefaults = {
+    'bitspersample': 1,
+    'compression': libtiff_ctypes.COMPRESSION_NONE,
+    'planarconfig': libtiff_ctypes.PLANARCONFIG_CONTIG,
+    'samplesperpixel': 1,
+}
+
+
+_decodePool = None
+_decodePoolLock = threading.Lock()
+
+
+def _getDecodePool():
+    """
+    Get a thread pool shared by all directories for decoding tiles.
+
+    :returns: a ThreadPool or None if tiles should be decoded as they are
+        read.
+    """
+    global _decodePool
+
+    if _decodePool is None:
+        threads = config.getConfig('tiff_decode_threads') or cpu_count()
+        if int(threads) <= 1:
+            return None
+        with _decodePoolLock:
+            if _decodePool is None:
+                _decodePool = ThreadPool(int(threads))
+    return _decodePool
+
+
 class TiffException(Exception):
     pass
 
 
+def planCoalescedReads(ranges, maxGap, maxReadSize):
+    """
+    Group byte ranges into a small number of larger reads.  Ranges are sorted
+    by offset, and adjacent ranges are read together if the bytes between them
+    are no more than a maximum gap and the combined read is no larger than a
+    maximum size.  A range larger than the maximum size is read by itself.
+
+    :param ranges: a list of (key, offset, length) tuples.  Ranges with a
+        length of zero are ignored.
+    :param maxGap: the largest number of unneeded bytes to read between two
+        ranges.
+    :param maxReadSize: the largest number of bytes to read at once.
+    :returns: a list of (offset, length, parts) tuples, where parts is a list
+        of (key, offset within the read, length).
+    """
+    reads = []
+    for key, offset, length in sorted(ranges, key=lambda entry: entry[1]):
+        if length <= 0:
+            continue
+        if reads:
+            start, end, parts = reads[-1]
+            if (offset >= start and offset - end <= maxGap and
+                    max(end, offset + length) - start <= maxReadSize):
+                parts.append((key, offset - start, length))
+                reads[-1][1] = max(end, offset + length)
+                continue
+        reads.append([offset, offset + length, [(key, 0, length)]])
+    return [(start, end - start, parts) for start, end, parts in reads]
+
+
 class InvalidOperationTiffException(TiffException):
     """
     An exception caused by the user making an invalid request of a TIFF file.
@@ -94,14 +201,86 @@ class ValidationTiffException(TiffException):
     pass
 
 
+class TiffFileHandle(object):
+    """
+    A read-only file descriptor for a TIFF file that can be shared by the
+    readers of all of the file's directories.  Where available, reads use
+    pread, so they don't need to hold a lock.
+    """
+
+    def __init__(self, filePath):
+        """
+        Create a handle.  The file is opened when it is first read.
+
+        :param filePath: A path to a TIFF file on disk.
+        """
+        self.filePath = filePath
+        self._fileDescriptor = None
+        self._lock = threading.Lock()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if getattr(self, '_fileDescriptor', None) is not None:
+            os.close(self._fileDescriptor)
+            self._fileDescriptor = None
+
+    def read(self, offset, length):
+        """
+        Read bytes from the file.
+
+        :param offset: the offset within the file.
+        :param length: the number of bytes to read.
+        :return: the bytes read.
+        :raises: IOTiffException
+        """
+        if self._fileDescriptor is None:
+            with self._lock:
+                if self._fileDescriptor is None:
+                    self._fileDescriptor = os.open(
+                        self.filePath, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        if hasattr(os, 'pread'):
+            chunks = []
+            while length > 0:
+                chunk = os.pread(self._fileDescriptor, length, offset)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                offset += len(chunk)
+                length -= len(chunk)
+            data = b''.join(chunks)
+        else:
+            with self._lock:
+                os.lseek(self._fileDescriptor, offset, os.SEEK_SET)
+                data = os.read(self._fileDescriptor, length)
+                length -= len(data)
+        if length:
+            raise IOTiffException('Buffer underflow when reading tile')
+        return data
+
+
 class TiledTiffDirectory(object):
 
     CoreFunctions = [
         'SetDirectory', 'GetField', 'LastDirectory', 'GetMode', 'IsTiled',
         'IsByteSwapped', 'IsUpSampled', 'IsMSB2LSB', 'NumberOfStrips'
     ]
-
-    def __init__(self, filePath, directoryNum, mustBeTiled=True):
+    # Compressions whose tiles are read as raw data rather than decoded by
+    # libtiff
+    RawReadCompressions = {libtiff_ctypes.COMPRESSION_JPEG, 33003, 33005}
+    # Compressions that can be decoded without libtiff
+    DecodeCompressions = {
+        libtiff_ctypes.COMPRESSION_NONE,
+        libtiff_ctypes.COMPRESSION_LZW,
+        libtiff_ctypes.COMPRESSION_ADOBE_DEFLATE,
+        libtiff_ctypes.COMPRESSION_DEFLATE,
+    }
+    # The number of decoded stored tiles kept for compositing the tiles of
+    # rotated images when tiles are requested individually
+    DecodedTileCacheSize = 16
+
+    def __init__(self, filePath, directoryNum, mustBeTiled=True, fileHandle=None):
         """
         Create a new reader for a tiled image file directory in a TIFF file.
 
@@ -112,6 +291,8 @@ class TiledTiffDirectory(object):
         :type directoryNum: int
         :param mustBeTiled: if True, only tiled images validate.  If False,
             only non-tiled images validate.  None validates both.
+        :param fileHandle: a TiffFileHandle for the file shared with readers
+            of other directories.  If None, this reader opens its own.
         :raises: InvalidOperationTiffException or IOTiffException or
         ValidationTiffException
         """
@@ -122,10 +303,38 @@ class TiledTiffDirectory(object):
         self.cache = LRUCache(10)
         self._mustBeTiled = mustBeTiled
 
-        self._tiffFile = None
+        self._tiffHandle = None
+        self._fileHandle = fileHandle or TiffFileHandle(filePath)
         self._tileLock = threading.RLock()
+        # Raw tile data that has been read in bulk but not yet used
+        self._prefetched = PrefetchedTiles()
+        # Decoded stored tiles that are shared by tiles of rotated images
+        self._decodedTiles = LRUCache(self.DecodedTileCacheSize)
+        self._decodedLock = threading.Lock()
+        # Tiles of the current band of a rotated image that haven't been read
+        # and the decoded tiles of the band that the next band also uses
+        self._bandTiles = set()
+        self._bandShared = set()
+        self._filePath = filePath
+        self._directoryNum = directoryNum
 
-        self._open(filePath, directoryNum)
+        # Read the directory's tags directly from the file.  libtiff is only
+        # used if this fails or when the directory is actually read.
+        self._ifd = None
+        if not os.path.isfile(filePath):
+            raise InvalidOperationTiffException(
+                'TIFF file does not exist: %s' % filePath)
+        try:
+            self._tiffFileInfo = readTiffInfo(filePath)
+        except (ValueError, IOError, OSError) as exc:
+            config.getConfig('logger').debug(
+                'Failed to parse TIFF directories of %s (%s); using libtiff', filePath, exc)
+            self._open(filePath, directoryNum)
+        else:
+            if directoryNum < 0 or directoryNum >= len(self._tiffFileInfo['ifds']):
+                raise IOTiffException(
+                    'Could not set TIFF directory to %d' % directoryNum)
+            self._ifd = self._tiffFileInfo['ifds'][directoryNum]
         self._loadMetadata()
         config.getConfig('logger').debug(
             'TiffDirectory %d Information %r', directoryNum, self._tiffInfo)
@@ -138,6 +347,19 @@ class TiledTiffDirectory(object):
     def __del__(self):
         self._close()
 
+    @property
+    def _tiffFile(self):
+        """
+        Get the libtiff handle for this directory, opening it if needed.
+
+        :returns: a libtiff_ctypes.TIFF object.
+        """
+        if self._tiffHandle is None:
+            with self._tileLock:
+                if self._tiffHandle is None:
+                    self._open(self._filePath, self._directoryNum)
+        return self._tiffHandle
+
     def _open(self, filePath, directoryNum):
         """
         Open a TIFF file to a given file and IFD number.
@@ -156,7 +378,7 @@ class TiledTiffDirectory(object):
             bytePath = filePath
             if not isinstance(bytePath, six.binary_type):
                 bytePath = filePath.encode('utf8')
-            self._tiffFile = libtiff_ctypes.TIFF.open(bytePath)
+            tiffHandle = libtiff_ctypes.TIFF.open(bytePath)
         except TypeError:
             raise IOTiffException(
                 'Could not open TIFF file: %s' % filePath)
@@ -164,21 +386,22 @@ class TiledTiffDirectory(object):
         # the version that supports libtiff 4.0.6.  To support both, ensure
         # that the cased functions exist.
         for func in self.CoreFunctions:
-            if (not hasattr(self._tiffFile, func) and
-                    hasattr(self._tiffFile, func.lower())):
-                setattr(self._tiffFile, func, getattr(
-                    self._tiffFile, func.lower()))
+            if (not hasattr(tiffHandle, func) and
+                    hasattr(tiffHandle, func.lower())):
+                setattr(tiffHandle, func, getattr(
+                    tiffHandle, func.lower()))
 
         self._directoryNum = directoryNum
-        if self._tiffFile.SetDirectory(self._directoryNum) != 1:
-            self._tiffFile.close()
+        if tiffHandle.SetDirectory(self._directoryNum) != 1:
+            tiffHandle.close()
             raise IOTiffException(
                 'Could not set TIFF directory to %d' % directoryNum)
+        self._tiffHandle = tiffHandle
 
     def _close(self):
-        if self._tiffFile:
-            self._tiffFile.close()
-            self._tiffFile = None
+        if getattr(self, '_tiffHandle', None):
+            self._tiffHandle.close()
+            self._tiffHandle = None
 
     def _validate(self):  # noqa
         """
@@ -201,7 +424,7 @@ class TiledTiffDirectory(object):
                 'Only RGB and greyscale TIFF files are supported')
 
         if (self._tiffInfo.get('bitspersample') != 8 and (
-                self._tiffInfo.get('compression') != libtiff_ctypes.COMPRESSION_NONE or
+                self._tiffInfo.get('compression') not in self.DecodeCompressions or
                 self._tiffInfo.get('bitspersample') != 16)):
             raise ValidationTiffException(
                 'Only single-byte sampled TIFF files are supported')
@@ -239,12 +462,16 @@ class TiledTiffDirectory(object):
             raise ValidationTiffException(
                 'Unsupported TIFF orientation')
 
-        if self._tiffInfo.get('compression') not in {
-                libtiff_ctypes.COMPRESSION_NONE,
-                libtiff_ctypes.COMPRESSION_JPEG,
-                33003, 33005}:
+        if self._tiffInfo.get('compression') not in (
+                self.RawReadCompressions | self.DecodeCompressions):
             raise ValidationTiffException(
-                'Only uncompressed and JPEG compressed TIFF files are supported')
+                'Only uncompressed, LZW, deflate, and JPEG compressed TIFF '
+                'files are supported')
+        if self._tiffInfo.get('predictor') not in {
+                None, libtiff_ctypes.PREDICTOR_NONE,
+                libtiff_ctypes.PREDICTOR_HORIZONTAL}:
+            raise ValidationTiffException(
+                'Only TIFF files without a floating point predictor are supported')
         if (not self._tiffInfo.get('istiled') or
                 not self._tiffInfo.get('tilewidth') or
                 not self._tiffInfo.get('tilelength')):
@@ -264,7 +491,13 @@ class TiledTiffDirectory(object):
             except IOTiffException:
                 self._completeJpeg = True
 
-    def _loadMetadata(self):
+    def _loadLibtiffMetadata(self):
+        """
+        Get the metadata of the directory by asking libtiff for every known
+        field.
+
+        :returns: a dictionary of metadata keyed by lowercase field names.
+        """
         fields = [key.split('_', 1)[1].lower() for key in
                   dir(libtiff_ctypes.tiff_h) if key.startswith('TIFFTAG_')]
         info = {}
@@ -283,6 +516,55 @@ class TiledTiffDirectory(object):
                 value = getattr(self._tiffFile, func)()
                 if value:
                     info[func.lower()] = value
+        return info
+
+    def _loadIfdMetadata(self):
+        """
+        Get the metadata of the directory from the parsed tags in the same
+        form that libtiff reports it.
+
+        :returns: a dictionary of metadata keyed by lowercase field names.
+        """
+        info = {}
+        tags = self._ifd['tags']
+        for tag, entry in six.iteritems(tags):
+            if tag not in TiffTagNames or tag in TiffTagsNotInMetadata:
+                continue
+            value = entry['data']
+            if isinstance(value, bytes):
+                if entry['datatype'] != 2:
+                    continue
+            elif len(value) == 1 or (tag in TiffTagsPerSample and len(value)):
+                value = value[0].item()
+            else:
+                value = value.tolist()
+            for name in TiffTagNames[tag]:
+                info[name] = value
+        for key, value in six.iteritems(TiffTagDefaults):
+            info.setdefault(key, value)
+        # libtiff ignores invalid orientations
+        if info.get('orientation') not in range(
+                libtiff_ctypes.ORIENTATION_TOPLEFT, libtiff_ctypes.ORIENTATION_LEFTBOT + 1):
+            info.pop('orientation', None)
+        if info['compression'] == libtiff_ctypes.COMPRESSION_JPEG:
+            info['jpegtablesmode'] = (
+                libtiff_ctypes.JPEGTABLESMODE_QUANT | libtiff_ctypes.JPEGTABLESMODE_HUFF)
+        # Values libtiff reports from functions rather than fields
+        if libtiff_ctypes.TIFFTAG_TILEWIDTH in tags:
+            info['istiled'] = 1
+        if libtiff_ctypes.TIFFTAG_STRIPOFFSETS in tags:
+            info['numberofstrips'] = tags[libtiff_ctypes.TIFFTAG_STRIPOFFSETS]['count']
+        if self._directoryNum == len(self._tiffFileInfo['ifds']) - 1:
+            info['lastdirectory'] = 1
+        if self._tiffFileInfo['bigEndian'] != (sys.byteorder == 'big'):
+            info['isbyteswapped'] = 1
+        return info
+
+    def _loadMetadata(self):
+        if self._ifd is not None:
+            info = self._loadIfdMetadata()
+        else:
+            info = self._loadLibtiffMetadata()
         self._tiffInfo = info
         self._tileWidth = info.get('tilewidth')
         self._tileHeight = info.get('tilelength')
@@ -327,6 +609,14 @@ class TiledTiffDirectory(object):
         :rtype: bytes
         :raises: Exception
         """
+        if self._ifd is not None:
+            entry = self._ifd['tags'].get(libtiff_ctypes.TIFFTAG_JPEGTABLES)
+            if entry is None:
+                raise IOTiffException('Could not get JPEG Huffman / quantization tables')
+            tableBuffer = entry['data']
+            tableSize = len(tableBuffer)
+            return self._checkJpegTables(tableBuffer, tableSize)
+
         # TIFFTAG_JPEGTABLES uses (uint32*, void**) output arguments
         # http://www.remotesensing.org/libtiff/man/TIFFGetField.3tiff.html
 
@@ -351,7 +641,34 @@ class TiledTiffDirectory(object):
 
         tableSize = tableSize.value
         tableBuffer = ctypes.cast(tableBuffer, ctypes.POINTER(ctypes.c_char))
+        return self._checkJpegTables(tableBuffer, tableSize)
+
+    def _getJpegPrefix(self):
+        """
+        Get the bytes that start every JPEG tile: the Start Of Image marker
+        followed by the JPEG tables.  This is computed once per directory.
 
+        :return: the JPEG prefix.
+        :rtype: bytes
+        """
+        prefix = getattr(self, '_jpegPrefix', None)
+        if prefix is None:
+            prefix = self._jpegPrefix = b'\xff\xd8' + self._getJpegTables()
+        return prefix
+
+    def _checkJpegTables(self, tableBuffer, tableSize):
+        """
+        Check that JPEG tables are well formed and strip their Start / End Of
+        Image markers.
+
+        :param tableBuffer: the tables, either as bytes or as a ctypes char
+            pointer.
+        :param tableSize: the length of the tables in bytes.
+        :return: All Huffman and quantization tables, with JPEG table start
+        markers.
+        :rtype: bytes
+        :raises: IOTiffException
+        """
         if tableBuffer[:2] != b'\xff\xd8':
             raise IOTiffException(
                 'Missing JPEG Start Of Image marker in tables')
@@ -392,6 +709,16 @@ class TiledTiffDirectory(object):
             if pixelX >= self._imageHeight or pixelY >= self._imageWidth:
                 raise InvalidOperationTiffException(
                     'Tile x=%d, y=%d does not exist' % (x, y))
+        if self._getTileTables() is not None:
+            # The tile layout always uses the dimensions as stored in the file
+            tileWidth = self._tiffInfo['tilewidth']
+            tileHeight = self._tiffInfo['tilelength']
+            if (pixelX >= self._tiffInfo['imagewidth'] or
+                    pixelY >= self._tiffInfo['imagelength']):
+                raise InvalidOperationTiffException(
+                    'Tile x=%d, y=%d does not exist' % (x, y))
+            tilesAcross = (self._tiffInfo['imagewidth'] + tileWidth - 1) // tileWidth
+            return (pixelY // tileHeight) * tilesAcross + pixelX // tileWidth
         if libtiff_ctypes.libtiff.TIFFCheckTile(
                 self._tiffFile, pixelX, pixelY, 0, 0) == 0:
             raise InvalidOperationTiffException(
@@ -401,6 +728,240 @@ class TiledTiffDirectory(object):
             self._tiffFile, pixelX, pixelY, 0, 0).value
         return tileNum
 
+    def _getTileTables(self):
+        """
+        Get the offsets and sizes of the tiles in the file.  These are read
+        from the directory once and kept.
+
+        :return: a tuple of numpy arrays of the tile offsets and the tile byte
+            counts, or None if the directory was not parsed directly or isn't
+            tiled.
+        """
+        tables = getattr(self, '_tileTables', None)
+        if tables is None and self._ifd is not None:
+            tags = self._ifd['tags']
+            offsets = tags.get(libtiff_ctypes.TIFFTAG_TILEOFFSETS)
+            byteCounts = tags.get(libtiff_ctypes.TIFFTAG_TILEBYTECOUNTS)
+            tables = False
+            if (offsets is not None and byteCounts is not None and
+                    len(offsets['data']) == len(byteCounts['data'])):
+                tables = (offsets['data'].astype(numpy.uint64),
+                          byteCounts['data'].astype(numpy.uint64))
+            self._tileTables = tables
+        return tables or None
+
+    def _readRawBytes(self, offset, length):
+        """
+        Read bytes from the file without using libtiff.  This uses the file
+        handle shared by all threads, so reads don't need to hold a lock.
+
+        :param offset: the offset within the file.
+        :param length: the number of bytes to read.
+        :return: the bytes read.
+        :raises: IOTiffException
+        """
+        return self._fileHandle.read(offset, length)
+
+    def _peekImageData(self, length):
+        """
+        Read the start of the image data of a directory without libtiff or
+        decoding the whole image.  Only the first strip or tile is read, and
+        deflate compressed data is only decompressed as far as needed.
+
+        :param length: the number of bytes to read.
+        :return: the bytes read, b'' if the directory is JPEG compressed, or
+            None if the data can't be read this way.
+        :raises: IOTiffException
+        """
+        info = self._tiffInfo
+        compression = info.get('compression')
+        if compression in self.RawReadCompressions | {libtiff_ctypes.COMPRESSION_OJPEG}:
+            # JPEG data can't start with arbitrary bytes
+            return b''
+        if self._ifd is None or compression not in self.DecodeCompressions:
+            return None
+        if (compression == libtiff_ctypes.COMPRESSION_LZW and
+                (imagecodecs is None or not hasattr(imagecodecs, 'lzw_decode'))):
+            return None
+        tags = self._ifd['tags']
+        offsets = tags.get(libtiff_ctypes.TIFFTAG_TILEOFFSETS,
+                           tags.get(libtiff_ctypes.TIFFTAG_STRIPOFFSETS))
+        byteCounts = tags.get(libtiff_ctypes.TIFFTAG_TILEBYTECOUNTS,
+                              tags.get(libtiff_ctypes.TIFFTAG_STRIPBYTECOUNTS))
+        if offsets is None or not len(offsets['data']):
+            return None
+        if compression in {None, libtiff_ctypes.COMPRESSION_NONE}:
+            return self._readRawBytes(int(offsets['data'][0]), length)
+        if byteCounts is None or not len(byteCounts['data']):
+            return None
+        data = self._readRawBytes(int(offsets['data'][0]), int(byteCounts['data'][0]))
+        samples = info.get('samplesperpixel') or 1
+        # Enough whole pixels to undo the horizontal predictor
+        size = (length + samples - 1) // samples * samples
+        try:
+            if compression == libtiff_ctypes.COMPRESSION_LZW:
+                data = imagecodecs.lzw_decode(data)[:size]
+            else:
+                data = zlib.decompressobj().decompress(data, size)
+        except (zlib.error, ValueError, RuntimeError) as exc:
+            raise IOTiffException('Failed to decode image data: %s' % exc)
+        if (info.get('predictor') == libtiff_ctypes.PREDICTOR_HORIZONTAL and
+                info.get('bitspersample') == 8 and len(data) == size):
+            data = numpy.cumsum(
+                numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, samples),
+                axis=0, dtype=numpy.uint8).tobytes()
+        return data[:length]
+
+    def _readRawTile(self, tileNum):
+        """
+        Read the raw data of a tile using the tile offset tables.  If the tile
+        was read as part of a bulk read, that data is used.
+
+        :param tileNum: The internal tile number of the desired tile.
+        :return: the raw tile data, or a numpy array if the tile was decoded
+            when it was read in bulk.
+        :rtype: bytes or numpy.ndarray
+        :raises: IOTiffException
+        """
+        data = self._prefetched.pop(tileNum)
+        if data is not None:
+            return data
+        offsets, byteCounts = self._getTileTables()
+        return self._readRawBytes(int(offsets[tileNum]), int(byteCounts[tileNum]))
+
+    def prefetchTiles(self, tiles):
+        """
+        Read the raw data of a group of tiles with as few reads as practical.
+        The tiles are sorted by their location in the file and nearby tiles
+        are read together; see planCoalescedReads.  The data is kept until
+        the tiles are read with getTile, up to a limited total size.  For
+        rotated images, the stored tiles needed for the band of requested
+        tiles are read and decoded.  This does nothing if the tiles of this
+        directory are not read from the file directly or if coalesced reads
+        are disabled (the tiff_coalesce_max_read config value is 0).
+
+        :param tiles: a list of (x, y) tile indices.
+        """
+        maxReadSize = config.getConfig('tiff_coalesce_max_read')
+        if not maxReadSize:
+            return
+        tables = self._getTileTables()
+        decode = self._canDecode()
+        rotated = self._tiffInfo.get('orientation') not in {
+            libtiff_ctypes.ORIENTATION_TOPLEFT, None}
+        if (tables is None or (
+                self._tiffInfo.get('compression') not in self.RawReadCompressions and
+                not decode) or (rotated and not decode)):
+            return
+        pool = _getDecodePool() if decode else None
+        offsets, byteCounts = tables
+        tileNums = self._rotatedBand(tiles) if rotated else self._tileNums(tiles)
+        ranges = [(tileNum, int(offsets[tileNum]), int(byteCounts[tileNum]))
+                  for tileNum in tileNums if tileNum not in self._prefetched]
+        reads = planCoalescedReads(
+            ranges, config.getConfig('tiff_coalesce_gap', 0), maxReadSize)
+        if len(reads) == len(ranges) and pool is None:
+            # Nothing would be combined, so just read tiles as they are needed
+            return
+        tileData = []
+        for offset, length, parts in reads:
+            with timing.stage('read', source='tiff', tiles=len(parts)) as stage:
+                data = self._readRawBytes(offset, length)
+                stage.bytes = length
+            tileData.extend(
+                (tileNum, data[start:start + tileLength])
+                for tileNum, start, tileLength in parts)
+        if pool is not None and len(tileData) > 1:
+            tileData = pool.map(self._prefetchDecode, tileData)
+        self._prefetched.update(tileData)
+
+    def _tileNums(self, tiles):
+        """
+        Get the internal tile numbers of a list of tiles, skipping tiles that
+        don't exist.
+
+        :param tiles: a list of (x, y) tile indices.
+        :returns: a list of internal tile numbers.
+        """
+        tileNums = []
+        for x, y in tiles:
+            try:
+                tileNums.append(self._toTileNum(x, y))
+            except InvalidOperationTiffException:
+                pass
+        return tileNums
+
+    def _rotatedBand(self, tiles):
+        """
+        Get the stored tiles needed for a band of tiles of a rotated image.
+        Stored tiles that are already decoded are omitted.  The cache of
+        decoded stored tiles is limited to the band and enlarged, if needed
+        and as far as the prefetch_max_bytes config value allows, so that the
+        band's tiles are decoded once and shared by all of the tiles that use
+        them.  Once all of the band's tiles are read, only the stored tiles
+        that the next band also uses are kept beyond the usual size.
+
+        :param tiles: a list of (x, y) tile indices.
+        :returns: a list of internal tile numbers of stored tiles.
+        """
+        band = set()
+        bandTiles = set()
+        nextBand = set()
+        for x, y in tiles:
+            try:
+                band.update(tileNum for _, _, tileNum in self._getRotatedSubtiles(x, y)[2])
+                bandTiles.add((x, y))
+                nextBand.update(
+                    tileNum for _, _, tileNum in self._getRotatedSubtiles(x, y + 1)[2])
+            except InvalidOperationTiffException:
+                pass
+        storedTileBytes = (
+            self._tiffInfo['tilewidth'] * self._tiffInfo['tilelength'] *
+            (self._tiffInfo.get('samplesperpixel') or 1) *
+            max(1, (self._tiffInfo.get('bitspersample') or 8) // 8))
+        maxSize = max(self.DecodedTileCacheSize, min(
+            len(band), config.getConfig('prefetch_max_bytes') // storedTileBytes))
+        with self._decodedLock:
+            # Drop decoded tiles from other bands first, since tiles of a new
+            # band may otherwise evict tiles it shares with the previous band.
+            for tileNum in [tileNum for tileNum in self._decodedTiles if tileNum not in band]:
+                del self._decodedTiles[tileNum]
+            if maxSize != self._decodedTiles.maxsize:
+                self._resizeDecodedTiles(maxSize)
+            self._bandTiles = bandTiles
+            self._bandShared = band & nextBand
+            return [tileNum for tileNum in sorted(band) if tileNum not in self._decodedTiles]
+
+    def _resizeDecodedTiles(self, maxSize, keep=None):
+        """
+        Change the number of decoded stored tiles that are kept, keeping as
+        many of the current ones as fit.  The decoded lock must be held.
+
+        :param maxSize: the number of decoded tiles to keep.
+        :param keep: if not None, only keep decoded tiles in this set.
+        """
+        tileNums = [tileNum for tileNum in self._decodedTiles
+                    if keep is None or tileNum in keep]
+        decodedTiles = LRUCache(maxSize)
+        for tileNum in tileNums[-maxSize:]:
+            decodedTiles[tileNum] = self._decodedTiles[tileNum]
+        self._decodedTiles = decodedTiles
+
+    def _prefetchDecode(self, entry):
+        """
+        Decode a prefetched tile.  If it cannot be decoded, the raw data is
+        kept so that the error is reported when the tile is read.
+
+        :param entry: a tuple of the tile number and the raw tile data.
+        :returns: a tuple of the tile number and either a numpy array of the
+            decoded tile or the raw tile data.
+        """
+        tileNum, data = entry
+        try:
+            return tileNum, self._decodeTile(data)
+        except (TiffException, zlib.error, ValueError, RuntimeError):
+            return entry
+
     @methodcache(key=partial(strhash, '_getTileByteCountsType'))
     def _getTileByteCountsType(self):
         """
@@ -433,9 +994,12 @@ class TiledTiffDirectory(object):
         :rtype: int
         :raises: InvalidOperationTiffException or IOTiffException
         """
-        # TODO: is it worth it to memoize this?
+        tables = self._getTileTables()
+        if tables is not None:
+            if tileNum >= len(tables[1]):
+                raise InvalidOperationTiffException('Tile number out of range')
+            return int(tables[1][tileNum])
 
-        # TODO: remove this check, for additional speed
         totalTileCount = libtiff_ctypes.libtiff.TIFFNumberOfTiles(
             self._tiffFile).value
         if tileNum >= totalTileCount:
@@ -482,84 +1046,185 @@ class TiledTiffDirectory(object):
         :rtype: bytes
         :raises: InvalidOperationTiffException or IOTiffException
         """
-        # This raises an InvalidOperationTiffException if the tile doesn't exist
-        rawTileSize = self._getJpegFrameSize(tileNum)
-
-        frameBuffer = ctypes.create_string_buffer(rawTileSize)
-
-        bytesRead = libtiff_ctypes.libtiff.TIFFReadRawTile(
-            self._tiffFile, tileNum,
-            frameBuffer, rawTileSize).value
-        if bytesRead == -1:
-            raise IOTiffException('Failed to read raw tile')
-        elif bytesRead < rawTileSize:
-            raise IOTiffException('Buffer underflow when reading tile')
-        elif bytesRead > rawTileSize:
-            # It's unlikely that this will ever occur, but incomplete reads will
-            # be checked for by looking for the JPEG end marker
-            raise IOTiffException('Buffer overflow when reading tile')
+        with timing.stage('read', source='tiff', tileNum=tileNum) as stage:
+            # This raises an InvalidOperationTiffException if the tile doesn't
+            # exist
+            rawTileSize = self._getJpegFrameSize(tileNum)
+            if self._getTileTables() is not None:
+                frame = self._readRawTile(tileNum)
+                stage.bytes = len(frame)
+            else:
+                frameBuffer = ctypes.create_string_buffer(rawTileSize)
+
+                bytesRead = libtiff_ctypes.libtiff.TIFFReadRawTile(
+                    self._tiffFile, tileNum,
+                    frameBuffer, rawTileSize).value
+                stage.bytes = bytesRead
+                if bytesRead == -1:
+                    raise IOTiffException('Failed to read raw tile')
+                elif bytesRead < rawTileSize:
+                    raise IOTiffException('Buffer underflow when reading tile')
+                elif bytesRead > rawTileSize:
+                    # It's unlikely that this will ever occur, but incomplete
+                    # reads will be checked for by looking for the JPEG end
+                    # marker
+                    raise IOTiffException('Buffer overflow when reading tile')
+                frame = frameBuffer.raw
         if entire:
-            return frameBuffer.raw[:]
+            return frame
+        return self._stripJpegFrame(frame)
 
-        if frameBuffer.raw[:2] != b'\xff\xd8':
+    def _stripJpegFrame(self, frame):
+        """
+        Remove the container information from a raw JPEG frame.
+
+        :param frame: the raw bytes of a JPEG tile.
+        :return: The JPEG image frame, starting with a JPEG Start Of Frame
+            marker and without the End Of Image marker.
+        :rtype: bytes
+        :raises: IOTiffException
+        """
+        if frame[:2] != b'\xff\xd8':
             raise IOTiffException('Missing JPEG Start Of Image marker in frame')
-        if frameBuffer.raw[-2:] != b'\xff\xd9':
+        if frame[-2:] != b'\xff\xd9':
             raise IOTiffException('Missing JPEG End Of Image marker in frame')
-        if frameBuffer.raw[2:4] in (b'\xff\xc0', b'\xff\xc2'):
+        if frame[2:4] in (b'\xff\xc0', b'\xff\xc2'):
             frameStartPos = 2
         else:
             # VIPS may encode TIFFs with the quantization (but not Huffman)
             # tables also at the start of every frame, so locate them for
             # removal
             # VIPS seems to prefer Baseline DCT, so search for that first
-            frameStartPos = frameBuffer.raw.find(b'\xff\xc0', 2, -2)
+            frameStartPos = frame.find(b'\xff\xc0', 2, -2)
             if frameStartPos == -1:
-                frameStartPos = frameBuffer.raw.find(b'\xff\xc2', 2, -2)
+                frameStartPos = frame.find(b'\xff\xc2', 2, -2)
                 if frameStartPos == -1:
                     raise IOTiffException('Missing JPEG Start Of Frame marker')
 
         # Strip the Start / End Of Image markers
-        tileData = frameBuffer.raw[frameStartPos:-2]
+        tileData = frame[frameStartPos:-2]
         return tileData
 
-    def _getUncompressedTile(self, tileNum):
+    def _canDecode(self):
+        """
+        Check if tiles of this directory can be decoded without libtiff.  This
+        is possible for contiguous greyscale and RGB data that is uncompressed
+        or is compressed with deflate or, if imagecodecs is available, LZW.
+
+        :return: True if the tiles can be decoded without libtiff.
+        """
+        info = self._tiffInfo
+        return bool(
+            self._getTileTables() is not None and
+            info.get('compression') in self.DecodeCompressions and
+            (info.get('compression') != libtiff_ctypes.COMPRESSION_LZW or
+             (imagecodecs is not None and hasattr(imagecodecs, 'lzw_decode'))) and
+            info.get('planarconfig') == libtiff_ctypes.PLANARCONFIG_CONTIG and
+            info.get('photometric') in {
+                libtiff_ctypes.PHOTOMETRIC_MINISBLACK,
+                libtiff_ctypes.PHOTOMETRIC_RGB} and
+            info.get('samplesperpixel') in {1, 3} and
+            info.get('bitspersample') in {8, 16} and
+            info.get('fillorder', libtiff_ctypes.FILLORDER_MSB2LSB) ==
+            libtiff_ctypes.FILLORDER_MSB2LSB)
+
+    def _decodeTile(self, data):
+        """
+        Decode the raw data of a tile without libtiff.  This doesn't hold any
+        locks, and both zlib and imagecodecs release the GIL while they
+        decompress, so tiles can be decoded in parallel.
+
+        :param data: the raw tile data.
+        :return: the tile as a numpy array in its native data type.  This has
+            a shape of (height, width) for greyscale images and (height,
+            width, samples) otherwise.
+        :rtype: numpy.ndarray
+        :raises: IOTiffException
+        """
+        info = self._tiffInfo
+        samples = info['samplesperpixel']
+        dtype = numpy.dtype(numpy.uint8 if info['bitspersample'] == 8 else numpy.uint16)
+        if info['bitspersample'] != 8:
+            dtype = dtype.newbyteorder('>' if self._tiffFileInfo['bigEndian'] else '<')
+        # Tiles are stored at their size in the file, regardless of orientation
+        count = info['tilewidth'] * info['tilelength'] * samples
+        compression = info['compression']
+        # Decompressing is much faster when the size of the output is known,
+        # and libdeflate is faster than zlib.
+        if compression in {libtiff_ctypes.COMPRESSION_ADOBE_DEFLATE,
+                           libtiff_ctypes.COMPRESSION_DEFLATE}:
+            if imagecodecs is not None and hasattr(imagecodecs, 'deflate_decode'):
+                data = imagecodecs.deflate_decode(data, out=count * dtype.itemsize)
+            else:
+                data = zlib.decompress(data, zlib.MAX_WBITS, count * dtype.itemsize)
+        elif compression == libtiff_ctypes.COMPRESSION_LZW:
+            data = imagecodecs.lzw_decode(data, out=count * dtype.itemsize)
+        if len(data) < count * dtype.itemsize:
+            raise IOTiffException('Read an unexpected number of bytes from an encoded tile')
+        tile = numpy.frombuffer(data, dtype=dtype, count=count).reshape(
+            info['tilelength'], info['tilewidth'], samples)
+        if info.get('predictor') == libtiff_ctypes.PREDICTOR_HORIZONTAL:
+            tile = numpy.cumsum(tile, axis=1, dtype=tile.dtype)
+        return tile if samples > 1 else tile[:, :, 0]
+
+    def _getUncompressedTile(self, tileNum, asarray=False):
         """
         Get an uncompressed tile.
 
         :param tileNum: The internal tile number of the desired tile.
         :type tileNum: int
-        :return: the tile as a PIL 8-bit-per-channel images.
-        :rtype: PIL.Image
+        :param asarray: if True, return a numpy array rather than an 8-bit
+            image.  Data with more than 8 bits per sample is always returned
+            as a numpy array in the native data type of the file.
+        :return: the tile as a PIL 8-bit-per-channel images or a numpy array.
+        :rtype: PIL.Image or numpy.ndarray
         :raises: IOTiffException
         """
+        if self._canDecode():
+            with timing.stage('decode', source='tiff', tileNum=tileNum) as stage:
+                tile = self._readRawTile(tileNum)
+                if not isinstance(tile, numpy.ndarray):
+                    stage.bytes = len(tile)
+                    try:
+                        tile = self._decodeTile(tile)
+                    except (zlib.error, ValueError, RuntimeError) as exc:
+                        raise IOTiffException('Failed to decode tile: %s' % exc)
+            return tile if asarray or tile.dtype != numpy.uint8 else PIL.Image.fromarray(tile)
         with self._tileLock:
             tileSize = libtiff_ctypes.libtiff.TIFFTileSize(self._tiffFile).value
         imageBuffer = ctypes.create_string_buffer(tileSize)
 
-        with self._tileLock:
-            readSize = libtiff_ctypes.libtiff.TIFFReadEncodedTile(
-                self._tiffFile, tileNum, imageBuffer, tileSize)
+        with timing.stage('decode', source='tiff', tileNum=tileNum) as stage:
+            with self._tileLock:
+                readSize = libtiff_ctypes.libtiff.TIFFReadEncodedTile(
+                    self._tiffFile, tileNum, imageBuffer, tileSize)
+            stage.bytes = readSize
         if readSize < tileSize:
             raise IOTiffException('Read an unexpected number of bytes from an encoded tile')
+        if self._tiffInfo.get('bitspersample') == 16:
+            # libtiff returns samples in the machine's byte order
+            tile = numpy.frombuffer(imageBuffer, dtype=numpy.uint16).reshape(
+                self._tiffInfo['tilelength'], self._tiffInfo['tilewidth'], -1)
+            return tile if tile.shape[2] > 1 else tile[:, :, 0]
         if self._tiffInfo.get('samplesperpixel') == 1:
             mode = 'L'
         elif self._tiffInfo.get('samplesperpixel') == 3:
             mode = ('YCbCr' if self._tiffInfo.get('photometric') ==
                     libtiff_ctypes.PHOTOMETRIC_YCBCR else 'RGB')
-        if self._tiffInfo.get('bitspersample') == 16:
-            # Just take the high byte
-            imageBuffer = imageBuffer[1::2]
         image = PIL.Image.frombytes(mode, (self._tileWidth, self._tileHeight), imageBuffer)
+        if asarray:
+            return numpy.asarray(image.convert('RGB') if mode == 'YCbCr' else image)
         return image
 
-    def _getTileRotated(self, x, y):
+    def _getRotatedSubtiles(self, x, y):
         """
-        Get a tile from a rotated TIF.  This composites uncompressed tiles as
-        necessary and then rotates the result.
+        Get the stored tiles that are needed for a tile of a rotated TIFF.
 
         :param x: The column index of the desired tile.
         :param y: The row index of the desired tile.
-        :return: either a buffer with a JPEG or a PIL image.
+        :return: the bounds of the tile in the coordinates of the image as
+            stored, a boolean that is True if the stored image is transposed,
+            and a list of (tx, ty, tileNum) for each stored tile.
         """
         x0 = x * self._tileWidth
         x1 = x0 + self._tileWidth
@@ -568,7 +1233,8 @@ class TiledTiffDirectory(object):
         iw, ih = self._imageWidth, self._imageHeight
         tw, th = self._tileWidth, self._tileHeight
         transpose = False
-        if self._tiffInfo.get('orientation') in {
+        orientation = self._tiffInfo.get('orientation')
+        if orientation in {
                 libtiff_ctypes.ORIENTATION_LEFTTOP,
                 libtiff_ctypes.ORIENTATION_RIGHTTOP,
                 libtiff_ctypes.ORIENTATION_RIGHTBOT,
@@ -577,49 +1243,104 @@ class TiledTiffDirectory(object):
             iw, ih = ih, iw
             tw, th = th, tw
             transpose = True
-        if self._tiffInfo.get('orientation') in {
+        if orientation in {
                 libtiff_ctypes.ORIENTATION_TOPRIGHT,
                 libtiff_ctypes.ORIENTATION_BOTRIGHT,
                 libtiff_ctypes.ORIENTATION_RIGHTTOP,
                 libtiff_ctypes.ORIENTATION_RIGHTBOT}:
             x0, x1 = iw - x1, iw - x0
-        if self._tiffInfo.get('orientation') in {
+        if orientation in {
                 libtiff_ctypes.ORIENTATION_BOTRIGHT,
                 libtiff_ctypes.ORIENTATION_BOTLEFT,
                 libtiff_ctypes.ORIENTATION_RIGHTBOT,
                 libtiff_ctypes.ORIENTATION_LEFTBOT}:
             y0, y1 = ih - y1, ih - y0
-        tx0 = x0 // tw
-        tx1 = (x1 - 1) // tw
-        ty0 = y0 // th
-        ty1 = (y1 - 1) // th
+        subtiles = [
+            (tx, ty, self._toTileNum(tx, ty, transpose))
+            for ty in range(max(0, y0 // th), max(0, (y1 - 1) // th + 1))
+            for tx in range(max(0, x0 // tw), max(0, (x1 - 1) // tw + 1))]
+        return (x0, x1, y0, y1), transpose, subtiles
+
+    def _getDecodedSubtile(self, tileNum):
+        """
+        Get a stored tile as a numpy array for compositing a tile of a rotated
+        TIFF.  Neighboring tiles share stored tiles, so recently used tiles are
+        kept.  The returned array must not be modified.
+
+        :param tileNum: The internal tile number of the stored tile.
+        :return: a numpy array in the native data type of the file.
+        """
+        with self._decodedLock:
+            subtile = self._decodedTiles.get(tileNum)
+        if subtile is None:
+            subtile = self._getUncompressedTile(tileNum, asarray=True)
+            with self._decodedLock:
+                self._decodedTiles[tileNum] = subtile
+        return subtile
+
+    def _getTileRotated(self, x, y, asarray=False):
+        """
+        Get a tile from a rotated TIF.  This composites decoded stored tiles
+        as necessary and then flips or transposes the result.
+
+        :param x: The column index of the desired tile.
+        :param y: The row index of the desired tile.
+        :param asarray: if True, return a numpy array rather than an 8-bit
+            image.  Data with more than 8 bits per sample is always returned
+            as a numpy array in the native data type of the file.
+        :return: either a PIL image or a numpy array.
+        """
+        (x0, x1, y0, y1), transpose, subtiles = self._getRotatedSubtiles(x, y)
         tile = None
-        for ty in range(max(0, ty0), max(0, ty1 + 1)):
-            for tx in range(max(0, tx0), max(0, tx1 + 1)):
-                subtile = self._getUncompressedTile(self._toTileNum(tx, ty, transpose))
-                if not tile:
-                    tile = PIL.Image.new(subtile.mode, (tw, th))
-                tile.paste(subtile, (tx * tw - x0, ty * th - y0))
+        for tx, ty, tileNum in subtiles:
+            subtile = self._getDecodedSubtile(tileNum)
+            th, tw = subtile.shape[:2]
+            if len(subtiles) == 1 and (x0, y0) == (tx * tw, ty * th):
+                # The tile is aligned with a stored tile
+                tile = subtile
+                break
+            if tile is None:
+                tile = numpy.zeros((y1 - y0, x1 - x0) + subtile.shape[2:], dtype=subtile.dtype)
+            # Paste the part of the stored tile that overlaps this tile
+            sx0, sy0 = max(0, x0 - tx * tw), max(0, y0 - ty * th)
+            sx1, sy1 = min(tw, x1 - tx * tw), min(th, y1 - ty * th)
+            tile[sy0 + ty * th - y0:sy1 + ty * th - y0,
+                 sx0 + tx * tw - x0:sx1 + tx * tw - x0] = subtile[sy0:sy1, sx0:sx1]
         if tile is None:
             raise InvalidOperationTiffException(
                 'Tile x=%d, y=%d does not exist' % (x, y))
-        if self._tiffInfo.get('orientation') in {
-                libtiff_ctypes.ORIENTATION_BOTRIGHT,
-                libtiff_ctypes.ORIENTATION_BOTLEFT,
-                libtiff_ctypes.ORIENTATION_RIGHTBOT,
-                libtiff_ctypes.ORIENTATION_LEFTBOT}:
+        with self._decodedLock:
+            if (x, y) in self._bandTiles:
+                self._bandTiles.discard((x, y))
+                if not self._bandTiles:
+                    self._resizeDecodedTiles(
+                        max(self.DecodedTileCacheSize, len(self._bandShared)),
+                        self._bandShared)
+        orientation = self._tiffInfo.get('orientation')
+        flipY = orientation in {
+            libtiff_ctypes.ORIENTATION_BOTRIGHT,
+            libtiff_ctypes.ORIENTATION_BOTLEFT,
+            libtiff_ctypes.ORIENTATION_RIGHTBOT,
+            libtiff_ctypes.ORIENTATION_LEFTBOT}
+        flipX = orientation in {
+            libtiff_ctypes.ORIENTATION_TOPRIGHT,
+            libtiff_ctypes.ORIENTATION_BOTRIGHT,
+            libtiff_ctypes.ORIENTATION_RIGHTTOP,
+            libtiff_ctypes.ORIENTATION_RIGHTBOT}
+        if asarray or tile.dtype != numpy.uint8:
+            # Flips and transposes are views of the composited tile
+            if flipY:
+                tile = tile[::-1]
+            if flipX:
+                tile = tile[:, ::-1]
+            return tile.swapaxes(0, 1) if transpose else tile
+        # PIL reorders pixels faster than numpy copies strided views
+        tile = PIL.Image.fromarray(tile)
+        if flipY:
             tile = tile.transpose(PIL.Image.FLIP_TOP_BOTTOM)
-        if self._tiffInfo.get('orientation') in {
-                libtiff_ctypes.ORIENTATION_TOPRIGHT,
-                libtiff_ctypes.ORIENTATION_BOTRIGHT,
-                libtiff_ctypes.ORIENTATION_RIGHTTOP,
-                libtiff_ctypes.ORIENTATION_RIGHTBOT}:
+        if flipX:
             tile = tile.transpose(PIL.Image.FLIP_LEFT_RIGHT)
-        if self._tiffInfo.get('orientation') in {
-                libtiff_ctypes.ORIENTATION_LEFTTOP,
-                libtiff_ctypes.ORIENTATION_RIGHTTOP,
-                libtiff_ctypes.ORIENTATION_RIGHTBOT,
-                libtiff_ctypes.ORIENTATION_LEFTBOT}:
+        if transpose:
             tile = tile.transpose(PIL.Image.TRANSPOSE)
         return tile
 
@@ -655,7 +1376,7 @@ class TiledTiffDirectory(object):
     def pixelInfo(self):
         return self._pixelInfo
 
-    def getTile(self, x, y):
+    def getTile(self, x, y, asarray=False):
         """
         Get the complete JPEG image from a tile.
 
@@ -663,30 +1384,31 @@ class TiledTiffDirectory(object):
         :type x: int
         :param y: The row index of the desired tile.
         :type y: int
-        :return: either a buffer with a JPEG or a PIL image.
+        :param asarray: if True, tiles that are not stored as JPEG or JPEG 2000
+            are returned as numpy arrays in the native data type of the file.
+            Tiles with more than 8 bits per sample are always returned this
+            way.
+        :return: either a buffer with a JPEG, a PIL image, or a numpy array.
         :rtype: bytes
         :raises: InvalidOperationTiffException or IOTiffException
         """
         if self._tiffInfo.get('orientation') not in {
                 libtiff_ctypes.ORIENTATION_TOPLEFT,
                 None}:
-            return self._getTileRotated(x, y)
+            return self._getTileRotated(x, y, asarray)
         # This raises an InvalidOperationTiffException if the tile doesn't exist
         tileNum = self._toTileNum(x, y)
 
-        imageBuffer = six.BytesIO()
-
         if self._tiffInfo.get('compression') == libtiff_ctypes.COMPRESSION_JPEG:
             if not getattr(self, '_completeJpeg', False):
-                # Write JPEG Start Of Image marker
-                imageBuffer.write(b'\xff\xd8')
-                imageBuffer.write(self._getJpegTables())
-                imageBuffer.write(self._getJpegFrame(tileNum))
-                # Write JPEG End Of Image marker
-                imageBuffer.write(b'\xff\xd9')
-            else:
-                imageBuffer.write(self._getJpegFrame(tileNum, True))
-            return imageBuffer.getvalue()
+                with timing.stage('jpegtables', source='tiff', tileNum=tileNum):
+                    prefix = self._getJpegPrefix()
+                # Add the JPEG Start Of Image marker and tables before the
+                # frame and the End Of Image marker after it
+                return b''.join((prefix, self._getJpegFrame(tileNum), b'\xff\xd9'))
+            return self._getJpegFrame(tileNum, True)
+
+        imageBuffer = six.BytesIO()
 
         if self._tiffInfo.get('compression') in (33003, 33005):
             # Get the whole frame, which is JPEG 2000 format, and convert it to
@@ -700,7 +1422,7 @@ class TiledTiffDirectory(object):
             image = image.convert('RGB')
             return image
 
-        return self._getUncompressedTile(tileNum)
+        return self._getUncompressedTile(tileNum, asarray)
 
     def parse_image_description(self, meta=None):  # noqa
         self._pixelInfo = {}
@@ -756,3 +1478,67 @@ class TiledTiffDirectory(object):
         except Exception:
             pass
         return True
+
+
+def _decodeDirectoryTile(entry):
+    """
+    Decode a tile read by readDirectoryTiles.
+
+    :param entry: a tuple of the directory and the raw tile data.
+    :returns: a numpy array or None if the tile could not be decoded.
+    """
+    directory, data = entry
+    try:
+        return directory._decodeTile(data)
+    except (IOTiffException, zlib.error, ValueError, RuntimeError):
+        return None
+
+
+def readDirectoryTiles(directories, x, y):
+    """
+    Read the same tile from several directories of one file, such as the
+    frames of a multi-frame image, without libtiff.  The tiles are read in the
+    order they are stored in the file, nearby tiles are read together (see
+    planCoalescedReads), and the tiles are decoded in parallel when a decode
+    pool is available.  All of the directories must share a file handle.
+
+    :param directories: a list of TiledTiffDirectory objects.
+    :param x: The column index of the desired tile.
+    :param y: The row index of the desired tile.
+    :returns: a list with one entry per directory.  Each entry is a numpy
+        array in the native data type of the file, or None if the tile must be
+        read with the directory's getTile method.
+    :raises: InvalidOperationTiffException or IOTiffException
+    """
+    results = [None] * len(directories)
+    ranges = []
+    for idx, directory in enumerate(directories):
+        if (directory._tiffInfo.get('orientation') not in {
+                libtiff_ctypes.ORIENTATION_TOPLEFT, None} or
+                not directory._canDecode()):
+            continue
+        tileNum = directory._toTileNum(x, y)
+        offsets, byteCounts = directory._getTileTables()
+        ranges.append((idx, int(offsets[tileNum]), int(byteCounts[tileNum])))
+    if not ranges:
+        return results
+    maxReadSize = config.getConfig('tiff_coalesce_max_read') or max(
+        length for _, _, length in ranges)
+    tileData = []
+    for offset, length, parts in planCoalescedReads(
+            ranges, config.getConfig('tiff_coalesce_gap', 0), maxReadSize):
+        with timing.stage('read', source='tiff', tiles=len(parts)) as stage:
+            data = directories[parts[0][0]]._readRawBytes(offset, length)
+            stage.bytes = length
+        tileData.extend(
+            (idx, (directories[idx], data[start:start + tileLength]))
+            for idx, start, tileLength in parts)
+    pool = _getDecodePool()
+    with timing.stage('decode', source='tiff', tiles=len(tileData)):
+        if pool is not None and len(tileData) > 1:
+            tiles = pool.map(_decodeDirectoryTile, [entry for _, entry in tileData])
+        else:
+            tiles = [_decodeDirectoryTile(entry) for _, entry in tileData]
+    for (idx, _), tile in zip(tileData, tiles):
+        results[idx] = tile
+    return results
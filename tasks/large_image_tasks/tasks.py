@@ -49,3 +49,44 @@ def create_tiff(self, inputFile, outputName=None, outputDir=None, quality=90, ti
         outputPath = renamePath
     print('Created a file of size %d' % os.path.getsize(outputPath))
     return outputPath
+
+
+@girder_job(title='Generate missing levels of a tiff', type='large_image_overviews')
+@app.task(bind=True)
+def generate_overviews(self, inputFile, overviewPath=None):
+    """
+    Make and store the tiles of the unpopulated levels of a tiff file.  Tile
+    sources only use these tiles if they read them from the same place, so
+    overviewPath must be the cache_overview_path of the server that shows the
+    image.
+
+    :param inputFile: the path of the tiff file.
+    :param overviewPath: the directory to store tiles in.  If None, the
+        cache_overview_path configured for the worker is used.  If the worker
+        has that configured, it must be the same.
+    :returns: the number of tiles in unpopulated levels.
+    """
+    import large_image
+    from large_image_source_tiff import TiffFileTileSource
+
+    configuredPath = large_image.config.getConfig('cache_overview_path')
+    if not overviewPath:
+        overviewPath = configuredPath
+    if not overviewPath:
+        raise Exception('An overview path or cache_overview_path must be specified.')
+    if configuredPath and (os.path.realpath(os.path.expanduser(configuredPath)) !=
+                           os.path.realpath(os.path.expanduser(overviewPath))):
+        raise Exception(
+            'The overview path %s is not the configured cache_overview_path %s.' % (
+                overviewPath, configuredPath))
+    inputPath = os.path.abspath(os.path.expanduser(inputFile))
+    # Only use the path for this task; later tasks in this worker use the
+    # configured value.
+    large_image.config.setConfig('cache_overview_path', overviewPath)
+    try:
+        source = TiffFileTileSource(inputPath)
+        count = source.generateOverviews()
+    finally:
+        large_image.config.setConfig('cache_overview_path', configuredPath)
+    print('Generated %d tiles in %s' % (count, overviewPath))
+    return count
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import cachetools
+import os
+import PIL.Image
 import pytest
 import six
 import threading
@@ -8,7 +10,8 @@ import threading
 import large_image.cache_util.cache
 from large_image import config
 from large_image.cache_util import cached, strhash, Cache, MemCache, \
-    methodcache, LruCacheMetaclass, cachesInfo, cachesClear, getTileCache
+    methodcache, LruCacheMetaclass, cachesInfo, cachesClear, getTileCache, \
+    DiskTileStore, fileIdentity
 
 
 class Fib(object):
@@ -74,6 +77,40 @@ def testGetTileCacheMemcached():
     assert isinstance(tileCache, MemCache)
 
 
+def testDiskTileStore(tmpdir, monkeypatch):
+    root = str(tmpdir)
+    imagePath = os.path.join(root, 'image.bin')
+    with open(imagePath, 'wb') as fptr:
+        fptr.write(b'\0' * 200000)
+    identity = fileIdentity(imagePath)
+    with open(imagePath, 'r+b') as fptr:
+        fptr.seek(100000)
+        fptr.write(b'\1')
+    # Only the ends of the file are used
+    assert fileIdentity(imagePath) == identity
+    with open(imagePath, 'ab') as fptr:
+        fptr.write(b'\1')
+    assert fileIdentity(imagePath) != identity
+
+    store = DiskTileStore(os.path.join(root, 'store'), identity, 256)
+    assert store.get(0, 0, 0) is None
+    image = PIL.Image.effect_noise((64, 64), 64).convert('RGB')
+    store.put(image, 0, 0, 0)
+    assert store.get(0, 0, 0).tobytes() == image.tobytes()
+    # The least recently used tiles are removed when the stores are too large
+    tileSize = os.path.getsize(store._tilePath(0, 0, 0))
+    monkeypatch.setitem(config.getConfig(), 'cache_overview_max_size', tileSize * 4)
+    for x in range(1, 8):
+        store.put(image, 0, x, 0)
+        # Use the first tile, so it is kept
+        os.utime(store._tilePath(0, 0, 0), (1e10, 1e10))
+    tiles = [x for x in range(8) if store.get(0, x, 0) is not None]
+    assert 0 in tiles
+    assert len(tiles) <= 4
+    assert not [name for name in os.listdir(os.path.dirname(store._tilePath(0, 0, 0)))
+                if not name.endswith('.png')]
+
+
 class TestClass(object):
     def testLRUThreadSafety(self):
         # The cachetools LRU cache is not thread safe, and if two threads ask
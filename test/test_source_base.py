@@ -1,6 +1,14 @@
 # -*- coding: utf-8 -*-
 
-from large_image.tilesource import nearPowerOfTwo
+import numpy
+import PIL.Image
+import pytest
+import six
+
+from large_image import config
+from large_image.tilesource import nearPowerOfTwo, registerTileEncoder, \
+    TileEncoders, TileOutputMimeTypes, TILE_FORMAT_NUMPY, timing, PrefetchedTiles, tileRuns
+import large_image_source_test
 
 
 def testNearPowerOfTwo():
@@ -11,3 +19,160 @@ def testNearPowerOfTwo():
     assert not nearPowerOfTwo(45808, 11400, 0.005)
     assert nearPowerOfTwo(45808, 11500)
     assert not nearPowerOfTwo(45808, 11500, 0.005)
+
+
+def testPrefetchedTiles():
+    prefetched = PrefetchedTiles(maxBytes=250)
+    prefetched.update([(0, b'0' * 100), (1, numpy.zeros((10, 10), dtype=numpy.uint8))])
+    assert len(prefetched) == 2
+    # The oldest data is discarded to stay under the size limit
+    prefetched.update([(2, b'2' * 100)])
+    assert 0 not in prefetched
+    assert prefetched.pop(1).shape == (10, 10)
+    assert prefetched.pop(1) is None
+    prefetched.update([(3, b'3' * 150)])
+    assert len(prefetched) == 2
+    prefetched.clear()
+    assert not prefetched
+    assert prefetched.pop(2) is None
+
+
+def testTileRuns():
+    assert tileRuns([(3, 0), (0, 0), (1, 0), (1, 1), (2, 1), (2, 0)], 3) == [
+        [(0, 0), (1, 0), (2, 0)], [(3, 0)], [(1, 1), (2, 1)]]
+    assert tileRuns([(0, 0), (2, 0)], 16) == [[(0, 0)], [(2, 0)]]
+    assert tileRuns([], 16) == []
+
+
+def testTileEncoders():
+    source = large_image_source_test.TestTileSource(encoding='WEBP')
+    tile = source.getTile(0, 0, 0)
+    assert tile[:4] == b'RIFF' and tile[8:12] == b'WEBP'
+    assert source.getTileMimeType() == 'image/webp'
+    image, mimeType = source.getRegion(encoding='WEBP', output={'maxWidth': 100})
+    assert image[8:12] == b'WEBP'
+    assert mimeType == 'image/webp'
+
+    source = large_image_source_test.TestTileSource(encoding='PNG')
+    image = source.getTile(0, 0, 0, pilImageAllowed=True)
+    defaultSize = len(source.getTile(0, 0, 0))
+    try:
+        config.setConfig('png_compress_level', 0)
+        uncompressed, mimeType = source.getRegion(
+            encoding='PNG', output={'maxWidth': 256})
+    finally:
+        config.setConfig('png_compress_level', None)
+    assert len(uncompressed) > defaultSize
+    assert numpy.array_equal(
+        numpy.asarray(PIL.Image.open(six.BytesIO(uncompressed)).convert('RGB')),
+        numpy.asarray(image.convert('RGB')))
+
+
+def testRegisterTileEncoder():
+    calls = []
+
+    def rawEncoder(image, encoding, **kwargs):
+        calls.append(encoding)
+        return image.tobytes()
+
+    registerTileEncoder('RAW', rawEncoder, 'application/octet-stream')
+    try:
+        source = large_image_source_test.TestTileSource(encoding='RAW')
+        tile = source.getTile(0, 0, 0)
+        assert len(tile) == 256 * 256 * 3
+        assert calls == ['RAW']
+        assert source.getTileMimeType() == 'application/octet-stream'
+    finally:
+        TileEncoders.pop('RAW', None)
+        TileOutputMimeTypes.pop('RAW', None)
+    with pytest.raises(ValueError):
+        registerTileEncoder('UNKNOWN', rawEncoder)
+
+
+def testTimingSinks():
+    assert not timing.timingEnabled()
+    assert timing.stage('encode') is timing.stage('decode')
+
+    records = []
+    histogram = timing.HistogramTimingSink()
+
+    class Logger(object):
+        def __init__(self):
+            self.messages = []
+
+        def info(self, msg):
+            self.messages.append(msg)
+
+    logger = Logger()
+    timing.addTimingSink(records.append)
+    timing.addTimingSink(histogram)
+    timing.addTimingSink(timing.ThresholdLogTimingSink(0, logger))
+    try:
+        assert timing.timingEnabled()
+        source = large_image_source_test.TestTileSource(encoding='JPEG', jpegQuality=91)
+        source.getRegion(
+            region={'right': 600, 'bottom': 300}, output={'maxWidth': 400},
+            encoding='PNG')
+    finally:
+        timing.removeTimingSink()
+    assert not timing.timingEnabled()
+    stages = {record['stage'] for record in records}
+    assert {'tile', 'crop', 'paste', 'resample', 'encode'} <= stages
+    stats = histogram.stats()
+    assert stats['tile']['count'] == 6
+    assert stats['paste']['count'] == 6
+    assert stats['encode']['bytes'] > 0
+    assert sum(stats['tile']['histogram']) == 6
+    assert len(stats['tile']['bins']) == len(stats['tile']['histogram'])
+    assert len(logger.messages) == len(records)
+    assert 'Slow tile stage' in logger.messages[0]
+
+
+def testGetPixels():
+    source = large_image_source_test.TestTileSource(
+        encoding='PNG', sizeX=5000, sizeY=3000, maxLevel=5)
+    points = [(10, 10), (300, 20), (4999, 2999), (5000, 10), (-1, 3), (2600, 1500), (301, 21)]
+    pixels = source.getPixels(points)
+    assert len(pixels) == len(points)
+    for idx in (0, 1, 2, 5, 6):
+        assert pixels[idx] == source.getPixel(
+            region={'left': points[idx][0], 'top': points[idx][1]})
+    assert pixels[3] == {}
+    assert pixels[4] == {}
+    assert set(pixels[0].keys()) == {'r', 'g', 'b'}
+    # Sample a lower resolution level
+    pixels = source.getPixels(points, level=3)
+    level3 = source.getTile(0, 0, 3, pilImageAllowed=True)
+    assert pixels[0] == dict(zip('rgb', level3.getpixel((2, 2))))
+    assert source.getPixels([]) == []
+
+
+def testGetStatistics():
+    source = large_image_source_test.TestTileSource(
+        encoding='PNG', sizeX=3000, sizeY=1000, maxLevel=4)
+    stats = source.getStatistics()
+    # The lowest resolution level that is at least 2048 pixels wide
+    assert stats['level'] == 4
+    assert stats['pixels'] == 3000 * 1000
+    assert [entry['channel'] for entry in stats['channels']] == ['r', 'g', 'b']
+    # Compare against a direct computation on the whole image
+    region, _ = source.getRegion(format=TILE_FORMAT_NUMPY)
+    for idx, entry in enumerate(stats['channels']):
+        values = region[:, :, idx]
+        assert entry['min'] == values.min()
+        assert entry['max'] == values.max()
+        assert entry['mean'] == pytest.approx(values.mean())
+        assert entry['stdev'] == pytest.approx(values.std())
+        assert entry['percentiles']['50'] == numpy.sort(values.ravel())[values.size // 2 - 1]
+        assert entry['histogram'] == numpy.bincount(values.ravel(), minlength=256).tolist()
+        assert len(entry['binEdges']) == 257
+    # Threaded computation matches, and binning aggregates the counts
+    threaded = source.getStatistics(bins=16, threads=4)
+    assert threaded['channels'][0]['histogram'] == [
+        sum(stats['channels'][0]['histogram'][idx * 16:idx * 16 + 16]) for idx in range(16)]
+    # Sampling is repeatable and uses the requested number of tiles
+    sampled = source.getStatistics(sample=3)
+    assert sampled['tiles'] == 3
+    assert sampled == source.getStatistics(sample=3)
+    with pytest.raises(ValueError):
+        source.getStatistics(bins=0)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import importlib
+import json
+import os
+import PIL.Image
+import pytest
+import subprocess
+import sys
+
+from large_image.tilesource.manifest import SourceManifest
+
+
+@pytest.mark.parametrize('entryPointName', sorted(SourceManifest['large_image.source']))
+def testManifestMatchesSources(entryPointName):
+    manifest = SourceManifest['large_image.source'][entryPointName]
+    module = pytest.importorskip(manifest['module'])
+    sourceClasses = [
+        cls for cls in vars(module).values()
+        if isinstance(cls, type) and getattr(cls, 'name', None) == manifest['name']]
+    assert len(sourceClasses) == 1
+    sourceClass = sourceClasses[0]
+    for key in ('extensions', 'mimeTypes', 'magicBytes', 'notMagicBytes'):
+        assert getattr(sourceClass, key) == manifest.get(key)
+
+
+# This is run in a separate process so that the modules imported are not
+# affected by other tests.
+_loadingScript = """
+import json
+import sys
+
+import large_image
+large_image.tilesource.loadTileSources()
+source = large_image.getTileSource(sys.argv[1])
+print(json.dumps({
+    'source': source.name,
+    'modules': sorted(sys.modules),
+}))
+"""
+
+
+def testLazyLoading(tmpdir):
+    imagePath = os.path.join(str(tmpdir), 'sample.png')
+    PIL.Image.new('RGB', (200, 100)).save(imagePath)
+    process = subprocess.Popen(
+        [sys.executable, '-c', _loadingScript, imagePath],
+        shell=False, stdout=subprocess.PIPE)
+    results = json.loads(process.stdout.read().decode('utf8').strip().split('\n')[-1])
+    process.wait()
+    assert results['source'] == 'pilfile'
+    # Only the PIL source is imported; none of the heavy libraries used by
+    # other sources are.
+    for entryPointName, manifest in SourceManifest['large_image.source'].items():
+        assert (manifest['module'] in results['modules']) == (entryPointName == 'pil')
+    for heavyModule in ('glymur', 'libtiff', 'mapnik', 'openslide', 'osgeo'):
+        assert heavyModule not in results['modules']
+
+
+def testLazyTileSource():
+    from large_image import tilesource
+
+    sources = {}
+    tilesource.loadTileSources(sourceDict=sources)
+    if not isinstance(sources.get('pil'), tilesource.LazyTileSource):
+        pytest.skip('PIL source is not installed')
+    lazy = sources['pil']
+    assert lazy.name == 'pilfile'
+    assert lazy.sniff(b'\x89PNG\r\n\x1a\n')
+    module = importlib.import_module('large_image_source_pil')
+    # Attributes that aren't in the manifest come from the source class
+    assert lazy.getLRUHash == module.PILFileTileSource.getLRUHash
+    assert lazy.load() is module.PILFileTileSource
@@ -2,12 +2,17 @@
 
 import glob
 import json
+import numpy
 import os
 import PIL.Image
 import PIL.ImageChops
 import pytest
 import six
+from six.moves import range
+from multiprocessing.pool import ThreadPool
 
+from large_image import config
+from large_image.cache_util import cachesClear
 from large_image.exceptions import TileSourceException
 
 import large_image_source_mapnik
@@ -91,6 +96,52 @@ def testTileFromGeotiffs():
     _assertImageMatches(image, 'geotiff_9_89_207')
 
 
+def testTilesFromMapPoolAndMetatiles():
+    testDir = os.path.dirname(os.path.realpath(__file__))
+    imagePath = os.path.join(testDir, 'test_files', 'rgb_geotiff.tiff')
+    tiles = [(x, y) for y in range(206, 210) for x in range(88, 92)]
+    source = large_image_source_mapnik.MapnikFileTileSource(imagePath, projection='EPSG:3857')
+    expected = [numpy.asarray(source.getTile(x, y, 9, pilImageAllowed=True)) for x, y in tiles]
+    cachesClear()
+    config.setConfig('mapnik_map_pool_size', 2)
+    config.setConfig('mapnik_metatile', 4)
+    try:
+        source = large_image_source_mapnik.MapnikFileTileSource(imagePath, projection='EPSG:3857')
+        renders = []
+        renderTiles = source._renderTiles
+
+        def countRenders(*args, **kwargs):
+            renders.append(args)
+            return renderTiles(*args, **kwargs)
+
+        source._renderTiles = countRenders
+        pool = ThreadPool(4)
+        results = pool.map(lambda tile: numpy.asarray(
+            source.getTile(tile[0], tile[1], 9, pilImageAllowed=True)), tiles)
+        pool.close()
+        # Tiles never use more maps than the pool size
+        assert source._mapPoolCount <= 2
+        for tile, result, expect in zip(tiles, results, expected):
+            assert result.shape == (256, 256, 4)
+            assert numpy.abs(result.astype(int) - expect).mean() < 1
+        # The tiles of a block are split from one render, even when they are
+        # requested at the same time
+        assert sorted(renders) == [(88, 204, 9, 4), (88, 208, 9, 4)]
+        # Blocks are kept by the source, not in the tile cache
+        cachesClear()
+        for x, y in tiles:
+            source.getTile(x, y, 9)
+        assert len(renders) == 2
+        source._metatiles.clear()
+        cachesClear()
+        for x, y in tiles:
+            source.getTile(x, y, 9)
+        assert renders[2:] == [(88, 204, 9, 4), (88, 208, 9, 4)]
+    finally:
+        config.setConfig('mapnik_map_pool_size', None)
+        config.setConfig('mapnik_metatile', 1)
+
+
 def testTileStyleFromGeotiffs():
     testDir = os.path.dirname(os.path.realpath(__file__))
     imagePath = os.path.join(testDir, 'test_files', 'rgb_geotiff.tiff')
@@ -242,6 +293,17 @@ def testPixel():
         'r': 77, 'g': 82, 'b': 84, 'a': 255, 'bands': {1: 77.0, 2: 82.0, 3: 84.0}}
 
 
+def testGetPixels():
+    testDir = os.path.dirname(os.path.realpath(__file__))
+    imagePath = os.path.join(testDir, 'test_files', 'rgb_geotiff.tiff')
+    source = large_image_source_mapnik.MapnikFileTileSource(imagePath)
+    pixels = source.getPixels([(212, 198), (2120, 198), (0, 0)])
+    assert pixels[0] == {
+        'r': 62, 'g': 65, 'b': 66, 'a': 255, 'bands': {1: 62.0, 2: 65.0, 3: 66.0}}
+    assert pixels[1] == {}
+    assert pixels[2] == source.getPixel(region={'left': 0, 'top': 0})
+
+
 def testSourceErrors():
     testDir = os.path.dirname(os.path.realpath(__file__))
     imagePath = os.path.join(testDir, 'test_files', 'rgb_geotiff.tiff')
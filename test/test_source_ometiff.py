@@ -17,3 +17,134 @@ def testTilesFromOMETiff():
     assert tileMetadata['levels'] == 3
     assert len(tileMetadata['frames']) == 3
     utilities.checkTilesZXY(source, tileMetadata)
+
+
+def _writeOmeTiff(path, frames, **kwargs):
+    """
+    Write a single-level OME TIFF file with one channel per frame.
+
+    :param path: the output path.
+    :param frames: a list of numpy arrays of shape (height, width, 3).
+    :param **kwargs: additional arguments to _writeTiledTiff.
+    """
+    from .test_source_tiff import _writeTiledTiff
+
+    tiffData = ''.join(
+        '<TiffData FirstC="%d" IFD="%d" PlaneCount="1">'
+        '<UUID FileName="sample.ome.tif">urn:uuid:0</UUID></TiffData>' % (frame, frame)
+        for frame in range(len(frames)))
+    description = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06">'
+        '<Image ID="Image:0"><Pixels DimensionOrder="XYCZT" ID="Pixels:0" '
+        'SizeC="%d" SizeT="1" SizeX="%d" SizeY="%d" SizeZ="1" Type="%s">'
+        '%s</Pixels></Image></OME>' % (
+            len(frames), frames[0].shape[1], frames[0].shape[0], frames[0].dtype.name,
+            tiffData)).encode('utf8')
+    _writeTiledTiff(path, frames, description=[description] + [b''] * (len(frames) - 1),
+                    **kwargs)
+
+
+def testFrameDirectoriesShareFileHandle(tmpdir):
+    import numpy
+    import os
+
+    from large_image.cache_util import LRUCache
+
+    frames = [numpy.full((256, 256, 3), frame * 10, dtype=numpy.uint8) for frame in range(6)]
+    imagePath = os.path.join(str(tmpdir), 'sample.ome.tif')
+    _writeOmeTiff(imagePath, frames, tileSize=128)
+    source = large_image_source_ometiff.OMETiffFileTileSource(imagePath)
+    source._directoryCache = LRUCache(3)
+    for frame in range(len(frames)):
+        tile = source.getTile(0, 0, 1, pilImageAllowed=True, numpyAllowed='always', frame=frame)
+        assert (tile == frame * 10).all()
+    # The most recently used directories are kept
+    assert sorted(source._directoryCache.keys()) == [3, 4, 5]
+    directory = source._directoryCache[5]
+    source.getTile(1, 0, 1, frame=5)
+    assert source._directoryCache[5] is directory
+    for directory in list(source._directoryCache.values()) + source._tiffDirectories[1:]:
+        assert directory._fileHandle is source._fileHandle
+
+
+def testTileFrames(tmpdir):
+    import numpy
+    import os
+    import pytest
+
+    from large_image.tilesource import TILE_FORMAT_NUMPY
+
+    frames = [(numpy.random.rand(300, 200, 3) * 65535).astype(numpy.uint16)
+              for _ in range(5)]
+    imagePath = os.path.join(str(tmpdir), 'sample.ome.tif')
+    _writeOmeTiff(imagePath, frames, tileSize=128, deflate=True)
+    source = large_image_source_ometiff.OMETiffFileTileSource(imagePath)
+    stack = source.getTileFrames(1, 2, 2)
+    assert stack.shape == (5, 128, 128, 3)
+    assert stack.dtype == numpy.uint16
+    for frame in range(5):
+        assert (stack[frame] == source.getTile(
+            1, 2, 2, pilImageAllowed=True, numpyAllowed='always', frame=frame)).all()
+    # Tiles on the edge of the image are cropped like other tiles
+    assert (stack[:, :300 - 256, :200 - 128] == numpy.array(frames)[:, 256:, 128:]).all()
+    stack = source.getTileFrames(0, 0, 2, frames=[3, 1])
+    assert (stack == numpy.array(frames)[[3, 1], :128, :128]).all()
+    with pytest.raises(large_image_source_ometiff.TileSourceException):
+        source.getTileFrames(0, 0, 2, frames=[5])
+
+    prefetched = []
+    prefetchTiles = source._prefetchTiles
+    source._prefetchTiles = lambda *args: prefetched.append(args) or prefetchTiles(*args)
+    tiles = list(source.tileIterator(format=TILE_FORMAT_NUMPY, frames=[0, 2, 4]))
+    assert len(tiles) == 6
+    # Rows of single frames aren't prefetched, since they wouldn't be used
+    assert not prefetched
+    assert tiles[0]['tile'].shape == (3, 128, 128, 3)
+    assert (tiles[-1]['tile'] == numpy.array(frames)[[0, 2, 4], 256:, 128:]).all()
+    region, _ = source.getRegion(
+        region={'left': 50, 'top': 60, 'width': 100, 'height': 150},
+        format=TILE_FORMAT_NUMPY, frames=[4, 0])
+    assert (region == numpy.array(frames)[[4, 0], 60:210, 50:150]).all()
+    region, _ = source.getRegion(
+        format=TILE_FORMAT_NUMPY, frames=[1, 2], output={'maxWidth': 100})
+    assert region.shape == (2, 150, 100, 3)
+    with pytest.raises(ValueError):
+        source.getRegion(frames=[0, 1])
+
+
+def testCompositeTile(tmpdir):
+    import json
+    import numpy
+    import os
+    import pytest
+
+    frames = [numpy.zeros((256, 256, 3), dtype=numpy.uint16) for _ in range(3)]
+    frames[0][:, :, 0] = 1000
+    frames[1][:, :, 0] = 4000
+    frames[2][:, :, 0] = 65535
+    imagePath = os.path.join(str(tmpdir), 'sample.ome.tif')
+    _writeOmeTiff(imagePath, frames, tileSize=256, deflate=True)
+    source = large_image_source_ometiff.OMETiffFileTileSource(imagePath)
+    style = {'bands': [
+        {'frame': 0, 'palette': '#ff0000', 'min': 0, 'max': 2000},
+        {'frame': 1, 'palette': '#00ff00', 'min': 2000, 'max': 6000},
+        {'frame': 2, 'palette': '#0000ff'}]}
+    tile = source.getCompositeTile(0, 0, 0, style, numpyAllowed=True)
+    assert tile.dtype == numpy.uint8
+    assert tile.shape == (256, 256, 3)
+    assert tuple(tile[0, 0]) == (128, 128, 255)
+    # Keys in a different order share the cached tile
+    assert source.getCompositeTile(0, 0, 0, json.dumps(
+        style, sort_keys=True), numpyAllowed=True) is tile
+    style['bands'][2]['palette'] = '#ff0000'
+    style['composite'] = 'add'
+    tile = source.getCompositeTile(0, 0, 0, style, numpyAllowed=True)
+    assert tuple(tile[0, 0]) == (255, 128, 0)
+    # Encoded tiles use the source's encoding
+    tile = source.getCompositeTile(0, 0, 0, style)
+    assert tile[:3] == b'\xff\xd8\xff'
+    with pytest.raises(large_image_source_ometiff.TileSourceException):
+        source.getCompositeTile(0, 0, 0, {'bands': [{'frame': 0}], 'composite': 'mix'})
+    with pytest.raises(large_image_source_ometiff.TileSourceException):
+        source.getCompositeTile(0, 0, 0, {'bands': [{'frame': 3}]})
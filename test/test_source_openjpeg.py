@@ -54,3 +54,110 @@ def testBelowLevelTilesFromOpenJPEG():
     large_image_source_openjpeg.OpenjpegFileTileSource._minTileSize = origMin
     large_image_source_openjpeg.OpenjpegFileTileSource._maxTileSize = origMax
     cachesClear()
+
+
+def testTilesDecodedByRow(tmpdir):
+    import glymur
+    import numpy
+    import os
+
+    from large_image.cache_util import cachesClear
+    from large_image.tilesource import TILE_FORMAT_NUMPY
+
+    y, x = numpy.mgrid[0:1100, 0:1500]
+    image = numpy.dstack([x * 255 // 1500, y * 255 // 1100, (x + y) % 256]).astype(numpy.uint8)
+    imagePath = os.path.join(str(tmpdir), 'sample.jp2')
+    glymur.Jp2k(imagePath, data=image, tilesize=(256, 256), numres=4)
+    cachesClear()
+    source = large_image_source_openjpeg.OpenjpegFileTileSource(imagePath)
+    assert source.tileWidth == 256
+    reads = []
+    readWindow = source._readWindow
+    source._readWindow = lambda *args, **kwargs: reads.append(args) or readWindow(
+        *args, **kwargs)
+    region, _ = source.getRegion(format=TILE_FORMAT_NUMPY)
+    # One read per row of tiles
+    assert len(reads) == 5
+    assert (region[:, :, :3] == image).all()
+    assert not source._prefetched
+    # Tiles that are cached aren't decoded again
+    source.getRegion(format=TILE_FORMAT_NUMPY)
+    assert len(reads) == 5
+    # Tiles in their native data type are cached separately
+    source.getRegion(format=TILE_FORMAT_NUMPY, nativeDtype=True)
+    assert len(reads) == 10
+    source.getRegion(format=TILE_FORMAT_NUMPY, nativeDtype=True)
+    assert len(reads) == 10
+    assert not source._prefetched
+    # Levels below the file's lowest resolution are reduced once per row
+    source._minlevel = 2
+    region, _ = source.getRegion(format=TILE_FORMAT_NUMPY, output={'maxWidth': 375})
+    assert region.shape[:2] == (275, 375)
+    assert len(reads) == 12
+    single = numpy.asarray(source.getTile(0, 0, 1, pilImageAllowed=True, frame=1))
+    assert len(reads) == 13
+    # Resampling the row together only changes pixels near the tile's edge
+    assert numpy.abs(
+        region[:248, :248, :3].astype(int) - single[:248, :248, :3].astype(int)).max() <= 2
+    cachesClear()
+
+
+def testSharedHandlePool(tmpdir, monkeypatch):
+    import glymur
+    import numpy
+    import os
+    import threading
+    import time
+    from multiprocessing.pool import ThreadPool
+
+    from large_image import config
+    from large_image.cache_util import cachesClear
+
+    paths = []
+    for idx in range(2):
+        paths.append(os.path.join(str(tmpdir), 'sample%d.jp2' % idx))
+        glymur.Jp2k(paths[-1], data=numpy.full((1024, 1024, 3), idx * 50, dtype=numpy.uint8),
+                    tilesize=(256, 256), numres=3)
+    pool = large_image_source_openjpeg._HandlePool()
+    monkeypatch.setattr(large_image_source_openjpeg, '_handlePool', pool)
+    monkeypatch.setitem(config.getConfig(), 'openjpeg_max_handles', 2)
+    cachesClear()
+    sources = [large_image_source_openjpeg.OpenjpegFileTileSource(path) for path in paths]
+    # The handles the sources keep for their metadata aren't in the pool
+    assert pool._open == 0
+    tiles = [(source, x, y) for source in sources for x in range(4) for y in range(4)]
+    ThreadPool(6).map(lambda entry: entry[0].getTile(entry[1], entry[2], 2), tiles)
+    assert pool._open <= 2
+    assert sum(len(handles) for handles in pool._idle.values()) == pool._open
+
+    # Threads wait their turn when all handles are in use
+    held = [pool.acquire(paths[0]), pool.acquire(paths[1])]
+    assert pool._open == 2
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(pool.acquire(paths[1])))
+    thread.start()
+    time.sleep(0.1)
+    assert not acquired
+    assert pool.stats['waits'] >= 1
+    pool.release(paths[0], held[0])
+    thread.join()
+    # The idle handle of the other file was closed to open this one
+    assert acquired[0] is not held[0]
+    assert pool._open == 2
+    pool.release(paths[1], held[1])
+    pool.release(paths[1], acquired[0])
+
+    # Idle handles are closed
+    monkeypatch.setitem(config.getConfig(), 'openjpeg_handle_idle_time', 0)
+    time.sleep(0.01)
+    pool.release(paths[0], pool.acquire(paths[0]))
+    assert pool._open == 1
+
+    # By default, the number of handles depends on the tile source cache but
+    # is limited
+    monkeypatch.setitem(config.getConfig(), 'openjpeg_max_handles', None)
+    monkeypatch.setattr(large_image_source_openjpeg, 'MaximumTileSources', 2.5)
+    assert pool.maxHandles() == 10
+    monkeypatch.setattr(large_image_source_openjpeg, 'MaximumTileSources', 1000.5)
+    assert pool.maxHandles() == pool.DefaultMaxHandles
+    cachesClear()
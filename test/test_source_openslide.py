@@ -414,3 +414,125 @@ def testTilesFromSmallFile():
     assert tileMetadata['sizeY'] == 1
     assert tileMetadata['levels'] == 1
     utilities.checkTilesZXY(source, tileMetadata)
+
+
+def testTilesFromSingleLevelFile(tmpdir, monkeypatch):
+    from large_image.cache_util import cachesClear
+    from .test_source_tiff import _writeTiledTiff
+
+    y, x = numpy.mgrid[0:2048, 0:1536]
+    image = numpy.dstack([x * 255 // 1536, y * 255 // 2048, (x + y) % 256]).astype(numpy.uint8)
+    imagePath = os.path.join(str(tmpdir), 'sample.tiff')
+    _writeTiledTiff(imagePath, image, tileSize=256)
+    cachesClear()
+    source = large_image_source_openslide.OpenslideFileTileSource(imagePath)
+    assert source.levels == 4
+    assert [level['scale'] for level in source._svslevels] == [8, 4, 2, 1]
+    reads = []
+    readRegion = large_image_source_openslide._lowlevelReadRegion
+    monkeypatch.setattr(
+        large_image_source_openslide, '_lowlevelReadRegion',
+        lambda *args: reads.append(args) or readRegion(*args))
+
+    # Rows of tiles are read together
+    region, _ = source.getRegion(format=constants.TILE_FORMAT_NUMPY)
+    assert len(reads) == 8
+    assert (region[:, :, :3] == image).all()
+    assert not source._prefetched
+
+    # Lower resolution levels are built with a box filter from the tiles of
+    # the next level.  The rows these are built from are read together.
+    del reads[:]
+    tile = numpy.asarray(source.getTile(0, 0, 0, pilImageAllowed=True))
+    assert len(reads) == 8
+    assert not source._prefetched
+    # The part of the tile past the edge of the image is transparent
+    assert tile.shape == (256, 256, 4)
+    eighth = image.reshape(256, 8, 192, 8, 3).mean(axis=(1, 3))
+    assert numpy.abs(tile[:, :192, :3] - eighth).max() < 2
+    assert (tile[:, :192, 3] == 255).all()
+    assert (tile[:, 192:] == 0).all()
+    # The tiles of the intermediate levels are cached and shared
+    tile = numpy.asarray(source.getTile(1, 1, 2, pilImageAllowed=True))
+    assert len(reads) == 8
+    half = image[512:1024, 512:1024].reshape(256, 2, 256, 2, 3).astype(int).sum(axis=(1, 3))
+    assert (tile[:, :, :3] == (half + 2) // 4).all()
+
+    # Transparent pixels don't darken the pixels they are averaged with
+    imagePath = os.path.join(str(tmpdir), 'odd.tiff')
+    _writeTiledTiff(imagePath, image[:300, :517], tileSize=256)
+    source = large_image_source_openslide.OpenslideFileTileSource(imagePath)
+    assert [level['scale'] for level in source._svslevels] == [4, 2, 1]
+    tile = numpy.asarray(source.getTile(1, 0, 1, numpyAllowed='always'))
+    assert tile.shape == (256, 256, 4)
+    edge = image[:300, 516].reshape(150, 2, 3).astype(int).sum(axis=1)
+    assert (tile[:150, 2, :3] == (edge + 1) // 2).all()
+    assert (tile[:150, 2, 3] == 128).all()
+    assert (tile[:, 3:, 3] == 0).all()
+    cachesClear()
+
+
+def testArgbToArray():
+    argb = numpy.array([[
+        0xFF102030, 0x00000000, 0x80404040, 0x40102030, 0x01010101,
+    ]], dtype=numpy.uint32)
+    rgba = large_image_source_openslide._argbToArray(argb)
+    assert rgba.dtype == numpy.uint8
+    assert rgba.tolist() == [[
+        [16, 32, 48, 255], [0, 0, 0, 0], [128, 128, 128, 128], [64, 128, 191, 64],
+        [255, 255, 255, 1]]]
+    # Opaque data has no alpha channel
+    argb = numpy.full((4, 4), 0xFF405060, dtype=numpy.uint32)
+    rgb = large_image_source_openslide._argbToArray(argb)
+    assert rgb.shape == (4, 4, 3)
+    assert (rgb == [64, 80, 96]).all()
+
+
+def testTilesAsArrays(tmpdir, monkeypatch):
+    import ctypes
+    import six
+
+    from large_image.cache_util import cachesClear
+    from .test_source_tiff import _writeTiledTiff
+
+    image = numpy.random.randint(0, 256, (512, 512, 3), dtype=numpy.uint8)
+    imagePath = os.path.join(str(tmpdir), 'sample.tiff')
+    _writeTiledTiff(imagePath, image, tileSize=256)
+    cachesClear()
+    source = large_image_source_openslide.OpenslideFileTileSource(imagePath)
+    tile = source.getTile(1, 0, 1, numpyAllowed=True)
+    assert isinstance(tile, numpy.ndarray)
+    assert tile.shape == (256, 256, 3)
+    assert (tile == image[:256, 256:]).all()
+    tile = source.getTile(1, 0, 1, pilImageAllowed=True)
+    assert tile.mode == 'RGB'
+    assert source.getTile(1, 0, 1)[:3] == b'\xff\xd8\xff'
+
+    # Tiles that extend past the edge of the image are transparent there
+    _writeTiledTiff(imagePath, image[:300, :300], tileSize=256)
+    cachesClear()
+    source = large_image_source_openslide.OpenslideFileTileSource(imagePath)
+    tile = source.getTile(1, 0, 1, numpyAllowed='always')
+    assert tile.shape == (256, 256, 4)
+    assert (tile[:, :44, 3] == 255).all() and (tile[:, 44:, 3] == 0).all()
+    assert (tile[:, :44, :3] == image[:256, 256:300]).all()
+    pngSource = large_image_source_openslide.OpenslideFileTileSource(imagePath, encoding='PNG')
+    tile = PIL.Image.open(six.BytesIO(pngSource.getTile(1, 0, 1)))
+    assert tile.mode == 'RGBA'
+    tile = source.getTile(0, 0, 0, numpyAllowed='always')
+    assert (tile[:150, :150, 3] == 255).all()
+    assert (tile[150:, :, 3] == 0).all() and (tile[:, 150:, 3] == 0).all()
+    # If OpenSlide's private interface is missing or differs, the public one
+    # is used
+    expected = source.getTile(1, 0, 1, numpyAllowed='always')
+
+    def badReadRegion(*args):
+        raise ctypes.ArgumentError('argument 2: wrong type')
+
+    for readRegion in (None, badReadRegion):
+        monkeypatch.setattr(large_image_source_openslide, '_lowlevelReadRegion', readRegion)
+        cachesClear()
+        tile = source.getTile(1, 0, 1, numpyAllowed='always')
+        assert tile.shape == (256, 256, 4)
+        assert (tile == expected).all()
+    cachesClear()
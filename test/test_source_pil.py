@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import numpy
 import os
 import re
 
-from large_image import config
+import PIL.Image
+
+import large_image
+from large_image import config, tilesource
 import large_image_source_pil
+import large_image_source_tiff
 
 from . import utilities
 
@@ -60,3 +65,128 @@ def testReadingVariousColorFormats():
     for name in files:
         imagePath = os.path.join(testDir, 'test_files', name)
         assert large_image_source_pil.PILFileTileSource.canRead(imagePath) is True
+
+
+def testRegionPassthrough(tmpdir):
+    imagePath = os.path.join(str(tmpdir), 'sample.jpg')
+    PIL.Image.new('RGB', (200, 100), (0, 128, 255)).save(imagePath, quality=95)
+    rawimage = open(imagePath, 'rb').read()
+    source = large_image_source_pil.PILFileTileSource(imagePath)
+    # A region that is exactly the single tile is returned without reencoding
+    image, mimeType = source.getRegion(encoding='JPEG')
+    assert image == rawimage
+    assert mimeType == 'image/jpeg'
+    image, mimeType = source.getRegion(
+        encoding='JPEG', output={'maxWidth': 200, 'maxHeight': 100})
+    assert image == rawimage
+    # Anything that changes the pixels or encoding must be reencoded
+    image, mimeType = source.getRegion(encoding='JPEG', jpegQuality=75)
+    assert image != rawimage
+    image, mimeType = source.getRegion(
+        encoding='JPEG', region={'right': 100})
+    assert image != rawimage
+    image, mimeType = source.getRegion(
+        encoding='JPEG', output={'maxWidth': 100})
+    assert image != rawimage
+    image, mimeType = source.getRegion(encoding='PNG')
+    assert image[:len(utilities.PNGHeader)] == utilities.PNGHeader
+
+
+def testSourceSniffingAndMemo(tmpdir):
+    # A PNG file with a TIFF extension is ruled out for the TIFF source before
+    # it is opened
+    imagePath = os.path.join(str(tmpdir), 'sample.tif')
+    PIL.Image.new('RGB', (200, 100), (0, 128, 255)).save(imagePath, format='PNG')
+    header = open(imagePath, 'rb').read(tilesource.SniffHeaderSize)
+    assert not large_image_source_tiff.TiffFileTileSource.sniff(header)
+    assert large_image_source_tiff.TiffFileTileSource.sniff(b'II*\x00\x08\x00\x00\x00')
+    assert large_image_source_pil.PILFileTileSource.sniff(header)
+    source = large_image.getTileSource(imagePath)
+    assert isinstance(source, large_image_source_pil.PILFileTileSource)
+    # The picked source is remembered and the file isn't opened again
+    memoKey = tilesource._sourceMemoKey(tilesource.AvailableTileSources, imagePath)
+    assert tilesource._sourceNameMemo[memoKey] == 'pil'
+    assert large_image.getTileSource(imagePath) is source
+    assert large_image_source_pil.PILFileTileSource.openIfReadable(imagePath) is source
+    assert large_image_source_pil.PILFileTileSource.openIfReadable(
+        os.path.join(str(tmpdir), 'missing.png')) is None
+
+
+def testTilesFromPILPyramid(tmpdir):
+    imagePath = os.path.join(str(tmpdir), 'sample.png')
+    data = numpy.random.randint(0, 256, (600, 1001, 3), dtype=numpy.uint8)
+    PIL.Image.fromarray(data).save(imagePath)
+    source = large_image_source_pil.PILFileTileSource(imagePath, tileSize=256)
+    tileMetadata = source.getMetadata()
+    assert tileMetadata['tileWidth'] == 256
+    assert tileMetadata['tileHeight'] == 256
+    assert tileMetadata['sizeX'] == 1001
+    assert tileMetadata['sizeY'] == 600
+    assert tileMetadata['levels'] == 3
+    utilities.checkTilesZXY(source, tileMetadata)
+    # Full resolution tiles are the image, padded with zeros at the edges
+    tile = source.getTile(3, 2, 2, numpyAllowed='always')
+    assert tile.shape == (256, 256, 3)
+    assert (tile[:88, :233] == data[512:, 768:]).all()
+    assert not tile[88:].any() and not tile[:, 233:].any()
+    # Reduced resolution levels average 2x2 blocks, repeating the last column
+    # of odd sizes
+    tile = source.getTile(1, 0, 1, numpyAllowed='always')
+    assert tile.shape == (256, 256, 3)
+    padded = numpy.concatenate((data, data[:, -1:]), axis=1).astype(float)
+    expected = (padded[0::2, 0::2] + padded[1::2, 0::2] +
+                padded[0::2, 1::2] + padded[1::2, 1::2]) / 4
+    assert numpy.abs(tile[:, :245].astype(float) - expected[:256, 256:]).max() <= 0.5
+    tile = source.getTile(0, 0, 0, numpyAllowed='always')
+    assert tile.shape == (256, 256, 3)
+    assert not tile[150:].any() and not tile[:, 251:].any()
+    # The edge option crops or fills edge tiles
+    source = large_image_source_pil.PILFileTileSource(imagePath, tileSize=256, edge='crop')
+    assert source.getTile(1, 0, 1, numpyAllowed='always').shape == (256, 244, 3)
+    source = large_image_source_pil.PILFileTileSource(imagePath, tileSize=256, edge='#ff0000')
+    tile = source.getTile(1, 0, 1, numpyAllowed='always')
+    assert tile.shape == (256, 256, 3)
+    assert (tile[:, 245:] == [255, 0, 0]).all()
+    # The tile size can be set in the config
+    config.setConfig('pil_tile_size', 512)
+    try:
+        source = large_image_source_pil.PILFileTileSource(imagePath)
+        assert source.getMetadata()['tileWidth'] == 512
+        assert source.getMetadata()['levels'] == 2
+        source = large_image_source_pil.PILFileTileSource(imagePath, tileSize=0)
+        assert source.getMetadata()['levels'] == 1
+        # Sources are shared based on the tile size that is used
+        source = large_image_source_pil.PILFileTileSource(imagePath)
+        assert large_image_source_pil.PILFileTileSource(imagePath, tileSize=512) is source
+        assert source.getTile(0, 0, 1, numpyAllowed='always').shape == (512, 512, 3)
+    finally:
+        config.setConfig('pil_tile_size', None)
+    source = large_image_source_pil.PILFileTileSource(imagePath)
+    assert source.getMetadata()['levels'] == 1
+    assert source.getTile(0, 0, 0, numpyAllowed='always').shape == (600, 1001, 3)
+
+
+def testMemoryMappedImages(tmpdir):
+    data = numpy.random.randint(0, 256, (300, 401, 3), dtype=numpy.uint8)
+    for ext in ('bmp', 'ppm', 'tif', 'png'):
+        imagePath = os.path.join(str(tmpdir), 'sample.' + ext)
+        PIL.Image.fromarray(data).save(imagePath)
+        source = large_image_source_pil.PILFileTileSource(imagePath, tileSize=256)
+        # Nothing is read until a tile is requested
+        assert source._mappedImage is None
+        tile = source.getTile(1, 1, 1, numpyAllowed='always')
+        assert (tile[:44, :145] == data[256:, 256:]).all()
+        assert (source._mappedImage is not None) == (ext != 'png')
+        tile = source.getTile(0, 0, 0, numpyAllowed='always')
+        assert tile.shape == (256, 256, 3)
+    # Native data is mapped and scaled to 8 bits for encoded tiles
+    data16 = data[:, :, 0].astype(numpy.uint16) * 257
+    imagePath = os.path.join(str(tmpdir), 'sample16.tif')
+    PIL.Image.fromarray(data16).save(imagePath)
+    source = large_image_source_pil.PILFileTileSource(imagePath)
+    tile = source.getTile(0, 0, 0, numpyAllowed='always')
+    assert tile.dtype == numpy.uint16
+    assert (tile == data16).all()
+    assert source._mappedImage is not None
+    tile = numpy.asarray(source.getTile(0, 0, 0, pilImageAllowed=True)).astype(int)
+    assert numpy.abs(tile - data[:, :, 0]).max() <= 1
@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import numpy
 import os
+import PIL.Image
 import pytest
+import shutil
+import six
 import struct
+import zlib
 
-from large_image import constants
+from large_image import config, constants
 import large_image_source_tiff
 
 from . import utilities
@@ -508,3 +513,538 @@ def testTilesFromMultipleTiledTIF():
     assert tileMetadata['levels'] == 7
     assert tileMetadata['magnification'] == 40
     utilities.checkTilesZXY(source, tileMetadata)
+
+
+def _splitJpeg(data):
+    """
+    Split a JPEG into its tables and the rest of the frame.
+
+    :param data: a complete JPEG.
+    :returns: the tables as a complete JPEG without an image and the frame
+        starting with the start of image marker.
+    """
+    tables = []
+    pos = 2
+    while data[pos:pos + 2] != b'\xff\xda':
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        if data[pos:pos + 2] in (b'\xff\xdb', b'\xff\xc4'):
+            tables.append(data[pos:pos + 2 + length])
+        pos += 2 + length
+    return b'\xff\xd8' + b''.join(tables) + b'\xff\xd9', data
+
+
+def _encodeTile(tile, jpeg, deflate):
+    """
+    Encode a tile for _writeTiledTiff.
+
+    :param tile: a numpy array of the tile.
+    :param jpeg: True to JPEG compress the tile.
+    :param deflate: True to deflate compress the tile with a predictor.
+    :returns: the JPEG tables or None and the encoded tile.
+    """
+    if jpeg:
+        output = six.BytesIO()
+        PIL.Image.fromarray(tile).save(output, 'JPEG', quality=95)
+        return _splitJpeg(output.getvalue())
+    if deflate:
+        tile[:, 1:] -= tile[:, :-1].copy()
+        return None, zlib.compress(tile.tobytes())
+    return None, tile.tobytes()
+
+
+def _writeTiledTiff(path, image, tileSize=256, bigtiff=False, description=b'',
+                    jpeg=False, deflate=False, orientation=None, maxSampleValue=None):
+    """
+    Write a tiled RGB TIFF file.
+
+    :param path: the output path.
+    :param image: a numpy uint8 or uint16 array of shape (height, width, 3),
+        or a list of such arrays to write one directory per array.
+    :param tileSize: the width and height of the tiles, or a list with a
+        value per directory.
+    :param bigtiff: True to write a BigTIFF file.
+    :param description: an image description, or a list with a value per
+        directory.
+    :param jpeg: if True, JPEG compress the tiles and store the JPEG tables in
+        the directory.
+    :param deflate: if True, deflate compress the tiles using the horizontal
+        differencing predictor.
+    :param orientation: if not None, the TIFF orientation tag value.
+    :param maxSampleValue: if not None, the TIFF MaxSampleValue tag value.
+    """
+    if bigtiff:
+        header = struct.pack('<2sHHHQ', b'II', 43, 8, 0, 16)
+        pointer, countFormat, entryFormat = 'Q', 'Q', '<HHQ8s'
+    else:
+        header = struct.pack('<2sHI', b'II', 42, 8)
+        pointer, countFormat, entryFormat = 'I', 'H', '<HHI4s'
+    pointerSize = struct.calcsize('<' + pointer)
+    data = header
+    # The header points to the first directory; each directory points to the
+    # next.
+    pointerOffset = 8 if bigtiff else 4
+    images = image if isinstance(image, list) else [image]
+    tileSizes = tileSize if isinstance(tileSize, list) else [tileSize] * len(images)
+    descriptions = description if isinstance(description, list) else [description] * len(images)
+    for image, tileSize, description in zip(images, tileSizes, descriptions):
+        height, width = image.shape[:2]
+        tiles = []
+        for ty in range(0, height, tileSize):
+            for tx in range(0, width, tileSize):
+                tile = numpy.zeros((tileSize, tileSize, 3), dtype=image.dtype)
+                part = image[ty:ty + tileSize, tx:tx + tileSize]
+                tile[:part.shape[0], :part.shape[1]] = part
+                jpegTables, tile = _encodeTile(tile, jpeg, deflate)
+                tiles.append(tile)
+        # Tile data precedes each directory.
+        offsets = []
+        for tile in tiles:
+            offsets.append(len(data))
+            data += tile
+
+        def entry(tag, datatype, values):
+            fmt = {2: 's', 3: 'H', 4: 'I', 16: 'Q'}[datatype]
+            if datatype == 2:
+                raw, count = values + b'\0', len(values) + 1
+            else:
+                raw, count = struct.pack('<%d%s' % (len(values), fmt), *values), len(values)
+            return [tag, datatype, count, raw]
+
+        entries = [
+            entry(256, 4, [width]),
+            entry(257, 4, [height]),
+            entry(258, 3, [image.dtype.itemsize * 8] * 3),
+            entry(259, 3, [7 if jpeg else (8 if deflate else 1)]),
+            entry(262, 3, [6 if jpeg else 2]),
+            entry(277, 3, [3]),
+            entry(284, 3, [1]),
+            entry(322, 4, [tileSize]),
+            entry(323, 4, [tileSize]),
+            entry(324, 16 if bigtiff else 4, offsets),
+            entry(325, 16 if bigtiff else 4, [len(tile) for tile in tiles]),
+        ]
+        if description:
+            entries.append(entry(270, 2, description))
+        # Orientation and MaxSampleValue
+        entries.extend(entry(tag, 3, values) for tag, values in (
+            (274, [orientation]), (281, [maxSampleValue] * 3)) if values[0] is not None)
+        if deflate:
+            entries.append(entry(317, 3, [2]))
+        if jpeg:
+            entries.append([347, 7, len(jpegTables), jpegTables])
+            entries.append(entry(530, 3, [2, 2]))
+        entries.sort()
+        entryDataSize = struct.calcsize(entryFormat)
+        ifdOffset = len(data)
+        extraOffset = (ifdOffset + struct.calcsize('<' + countFormat) +
+                       len(entries) * entryDataSize + pointerSize)
+        extra = []
+        ifd = struct.pack('<' + countFormat, len(entries))
+        for tag, datatype, count, raw in entries:
+            if len(raw) <= pointerSize:
+                value = raw
+            else:
+                value = struct.pack('<' + pointer, extraOffset + len(b''.join(extra)))
+                extra.append(raw)
+            ifd += struct.pack(entryFormat, tag, datatype, count, value)
+        ifd += struct.pack('<' + pointer, 0)
+        data = (data[:pointerOffset] + struct.pack('<' + pointer, ifdOffset) +
+                data[pointerOffset + pointerSize:])
+        pointerOffset = len(data) + len(ifd) - pointerSize
+        data += ifd + b''.join(extra)
+    with open(path, 'wb') as fptr:
+        fptr.write(data)
+
+
+@pytest.mark.parametrize('bigtiff', [False, True])
+def testReadTiffInfo(tmpdir, bigtiff):
+    from large_image_source_tiff.tiff_ifd import readTiffInfo
+
+    image = numpy.random.RandomState(0).randint(0, 255, (300, 600, 3)).astype(numpy.uint8)
+    imagePath = os.path.join(str(tmpdir), 'sample.tiff')
+    _writeTiledTiff(imagePath, image, bigtiff=bigtiff, description=b'Aperio|AppMag = 20')
+    info = readTiffInfo(imagePath)
+    assert info['bigtiff'] == bigtiff
+    assert not info['bigEndian']
+    assert len(info['ifds']) == 1
+    tags = info['ifds'][0]['tags']
+    assert tags[256]['data'][0] == 600
+    assert tags[257]['data'][0] == 300
+    assert list(tags[258]['data']) == [8, 8, 8]
+    assert tags[270]['data'] == b'Aperio|AppMag = 20'
+    assert len(tags[324]['data']) == 6
+    # The source is opened and uncompressed tiles are read without libtiff
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    directory = source._tiffDirectories[-1]
+    assert directory._tiffHandle is None
+    assert directory._tiffInfo['imagewidth'] == 600
+    assert directory._tiffInfo['bitspersample'] == 8
+    assert directory._tiffInfo['istiled']
+    assert directory.pixelInfo['magnification'] == 20
+    tile = source.getTile(1, 1, source.levels - 1, pilImageAllowed=True)
+    assert directory._tiffHandle is None
+    assert (numpy.asarray(tile)[:44, :] == image[256:, 256:512]).all()
+    # Files that aren't TIFFs are rejected
+    with pytest.raises(ValueError):
+        readTiffInfo(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                  'test_files', 'yb10kx5k.png'))
+
+
+@pytest.mark.parametrize('bigtiff', [False, True])
+def testJpegTilesWithoutLibtiff(tmpdir, bigtiff):
+    image = numpy.random.RandomState(0).randint(0, 255, (300, 600, 3)).astype(numpy.uint8)
+    # Smooth the image so that the JPEG compression is close to the original
+    image = numpy.repeat(numpy.repeat(image[::20, ::20], 20, axis=0), 20, axis=1)
+    imagePath = os.path.join(str(tmpdir), 'sample.tiff')
+    _writeTiledTiff(imagePath, image, bigtiff=bigtiff, jpeg=True)
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    directory = source._tiffDirectories[-1]
+    offsets, byteCounts = directory._getTileTables()
+    assert len(offsets) == len(byteCounts) == 6
+    tile = source.getTile(1, 1, source.levels - 1)
+    # Tiles are read from the offset tables without opening libtiff
+    assert directory._tiffHandle is None
+    assert tile[:2] == b'\xff\xd8'
+    assert tile.startswith(directory._getJpegPrefix())
+    assert tile[-2:] == b'\xff\xd9'
+    tileImage = numpy.asarray(PIL.Image.open(six.BytesIO(tile)).convert('RGB'))
+    assert numpy.abs(tileImage[:44].astype(int) - image[256:, 256:512]).mean() < 8
+    with pytest.raises(large_image_source_tiff.TileSourceException):
+        source.getTile(3, 0, source.levels - 1)
+
+
+def testPlanCoalescedReads():
+    from large_image_source_tiff.tiff_reader import planCoalescedReads
+
+    ranges = [('c', 300, 50), ('a', 0, 100), ('b', 110, 40), ('d', 1000, 10), ('e', 2000, 0)]
+    assert planCoalescedReads(ranges, 10, 1000) == [
+        (0, 150, [('a', 0, 100), ('b', 110, 40)]),
+        (300, 50, [('c', 0, 50)]),
+        (1000, 10, [('d', 0, 10)]),
+    ]
+    assert planCoalescedReads(ranges, 1000, 1000) == [
+        (0, 350, [('a', 0, 100), ('b', 110, 40), ('c', 300, 50)]),
+        (1000, 10, [('d', 0, 10)]),
+    ]
+    # Ranges larger than the maximum read size are read by themselves
+    assert planCoalescedReads(ranges, 1000, 120) == [
+        (0, 100, [('a', 0, 100)]),
+        (110, 40, [('b', 0, 40)]),
+        (300, 50, [('c', 0, 50)]),
+        (1000, 10, [('d', 0, 10)]),
+    ]
+
+
+def testTileIteratorCoalescesReads(tmpdir, monkeypatch):
+    from large_image_source_tiff import tiff_reader
+
+    image = numpy.random.RandomState(0).randint(0, 255, (600, 1200, 3)).astype(numpy.uint8)
+    imagePath = os.path.join(str(tmpdir), 'sample.tiff')
+    _writeTiledTiff(imagePath, image, jpeg=True)
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    directory = source._tiffDirectories[-1]
+
+    reads = []
+    readRawBytes = tiff_reader.TiledTiffDirectory._readRawBytes
+
+    def countReads(self, offset, length):
+        reads.append(length)
+        return readRawBytes(self, offset, length)
+
+    monkeypatch.setattr(tiff_reader.TiledTiffDirectory, '_readRawBytes', countReads)
+    maxRead = config.getConfig('tiff_coalesce_max_read')
+    config.setConfig('tiff_coalesce_max_read', 0)
+    try:
+        expected = [tile['tile'] for tile in source.tileIterator(
+            format=constants.TILE_FORMAT_NUMPY)]
+    finally:
+        config.setConfig('tiff_coalesce_max_read', maxRead)
+    assert len(reads) == 15
+    source.cache.clear()
+    reads[:] = []
+    tiles = [tile['tile'] for tile in source.tileIterator(format=constants.TILE_FORMAT_NUMPY)]
+    assert all((tile == expected[idx]).all() for idx, tile in enumerate(tiles))
+    # Each row of tiles is read at once
+    assert len(reads) == 3
+    assert not directory._prefetched
+    # Tiles that are already cached aren't read again
+    reads[:] = []
+    tiles = [tile['tile'] for tile in source.tileIterator(format=constants.TILE_FORMAT_NUMPY)]
+    assert not reads
+    assert not directory._prefetched
+    # Tiles requested in their native data type are cached separately
+    tiles = [tile['tile'] for tile in source.tileIterator(
+        format=constants.TILE_FORMAT_NUMPY, nativeDtype=True)]
+    assert len(reads) == 3
+    reads[:] = []
+    tiles = [tile['tile'] for tile in source.tileIterator(
+        format=constants.TILE_FORMAT_NUMPY, nativeDtype=True)]
+    assert not reads
+    assert not directory._prefetched
+
+
+def testDeflateTilesDecodedConcurrently(tmpdir):
+    from multiprocessing.pool import ThreadPool
+
+    image = numpy.random.RandomState(0).randint(0, 255, (600, 1200, 3)).astype(numpy.uint8)
+    imagePath = os.path.join(str(tmpdir), 'sample.tiff')
+    _writeTiledTiff(imagePath, image, deflate=True)
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    directory = source._tiffDirectories[-1]
+    assert directory._canDecode()
+
+    def getTile(pos):
+        return numpy.asarray(directory.getTile(pos[0], pos[1]))
+
+    positions = [(x, y) for y in range(3) for x in range(5)]
+    pool = ThreadPool(4)
+    try:
+        tiles = pool.map(getTile, positions)
+    finally:
+        pool.close()
+    for (x, y), tile in zip(positions, tiles):
+        expected = image[y * 256:y * 256 + 256, x * 256:x * 256 + 256]
+        assert (tile[:expected.shape[0], :expected.shape[1]] == expected).all()
+    # Tiles are decoded without libtiff
+    assert directory._tiffHandle is None
+    # Tiles prefetched by the tile iterator are decoded in bulk
+    region = numpy.zeros(image.shape, dtype=numpy.uint8)
+    for tile in source.tileIterator(format=constants.TILE_FORMAT_NUMPY):
+        region[tile['y']:tile['y'] + tile['height'],
+               tile['x']:tile['x'] + tile['width']] = tile['tile'][:, :, :3]
+    assert (region == image).all()
+    assert not directory._prefetched
+    # Nothing is read or decoded in bulk when coalesced reads are disabled
+    maxRead = config.getConfig('tiff_coalesce_max_read')
+    config.setConfig('tiff_coalesce_max_read', 0)
+    try:
+        directory.prefetchTiles(positions)
+    finally:
+        config.setConfig('tiff_coalesce_max_read', maxRead)
+    assert not directory._prefetched
+    directory.prefetchTiles(positions)
+    assert len(directory._prefetched) == len(positions)
+    directory._prefetched.clear()
+
+
+def testNativeDtype(tmpdir):
+    image = numpy.random.RandomState(0).randint(0, 65535, (600, 700, 3)).astype(numpy.uint16)
+    imagePath = os.path.join(str(tmpdir), 'sample.tiff')
+    _writeTiledTiff(imagePath, image, deflate=True)
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    # Without asking for the native type, tiles are 8 bits per sample
+    tile = numpy.asarray(source.getTile(1, 1, 2, pilImageAllowed=True, numpyAllowed=True))
+    assert tile.dtype == numpy.uint8
+    assert (tile == (image[256:512, 256:512] >> 8)).all()
+    region = numpy.zeros(image.shape, dtype=numpy.uint16)
+    for tile in source.tileIterator(format=constants.TILE_FORMAT_NUMPY, nativeDtype=True):
+        assert tile['tile'].dtype == numpy.uint16
+        region[tile['y']:tile['y'] + tile['height'],
+               tile['x']:tile['x'] + tile['width']] = tile['tile']
+    assert (region == image).all()
+    region, format = source.getRegion(
+        region=dict(left=100, top=50, right=500, bottom=450),
+        format=constants.TILE_FORMAT_NUMPY, nativeDtype=True)
+    assert format == constants.TILE_FORMAT_NUMPY
+    assert region.dtype == numpy.uint16
+    assert (region == image[50:450, 100:500]).all()
+    region, format = source.getRegion(
+        output=dict(maxWidth=350), format=constants.TILE_FORMAT_NUMPY, nativeDtype=True)
+    assert region.dtype == numpy.uint16
+    assert region.shape == (300, 350, 3)
+    # Images are only reduced to 8 bits when encoded
+    region, format = source.getRegion(
+        output=dict(maxWidth=350), encoding='PNG', nativeDtype=True)
+    assert PIL.Image.open(six.BytesIO(region)).mode == 'RGB'
+
+
+def testNativeDtypeFewerBits(tmpdir):
+    # 12-bit samples stored in 16-bit integers
+    image = numpy.random.RandomState(0).randint(0, 4096, (600, 700, 3)).astype(numpy.uint16)
+    imagePath = os.path.join(str(tmpdir), 'sample.tiff')
+    _writeTiledTiff(imagePath, image, deflate=True, maxSampleValue=4095)
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    assert source._nativeBits() == 12
+    # Tiles and regions are reduced to 8 bits the same way
+    tile = numpy.asarray(source.getTile(1, 1, 2, pilImageAllowed=True, numpyAllowed=True))
+    assert tile.dtype == numpy.uint8
+    assert (tile == (image[256:512, 256:512] >> 4)).all()
+    region, format = source.getRegion(
+        region=dict(left=100, top=50, right=500, bottom=450), encoding='PNG', nativeDtype=True)
+    region = numpy.asarray(PIL.Image.open(six.BytesIO(region)))
+    assert (region == (image[50:450, 100:500] >> 4)).all()
+    region, format = source.getRegion(
+        region=dict(left=100, top=50, right=500, bottom=450), encoding='PNG')
+    region = numpy.asarray(PIL.Image.open(six.BytesIO(region)))
+    assert (region[:, :, :3] == (image[50:450, 100:500] >> 4)).all()
+    # Without the tag, dim images aren't brightened
+    _writeTiledTiff(imagePath, image, deflate=True)
+    source = large_image_source_tiff.TiffFileTileSource(imagePath, encoding='PNG')
+    assert source._nativeBits() is None
+    tile = numpy.asarray(source.getTile(1, 1, 2, pilImageAllowed=True))
+    assert (tile == (image[256:512, 256:512] >> 8)).all()
+
+
+@pytest.mark.parametrize('orientation', range(1, 9))
+def testRotatedTilesShareDecodedTiles(tmpdir, monkeypatch, orientation):
+    from large_image_source_tiff import tiff_reader
+
+    image = numpy.random.RandomState(0).randint(0, 255, (500, 700, 3)).astype(numpy.uint8)
+    imagePath = os.path.join(str(tmpdir), 'sample.tiff')
+    _writeTiledTiff(imagePath, image, tileSize=128, deflate=True, orientation=orientation)
+    # Make bands of tiles need more decoded tiles than are usually kept
+    monkeypatch.setattr(tiff_reader.TiledTiffDirectory, 'DecodedTileCacheSize', 2)
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    directory = source._tiffDirectories[-1]
+    expected = image
+    if orientation in {3, 4, 7, 8}:
+        expected = expected[::-1]
+    if orientation in {2, 3, 6, 7}:
+        expected = expected[:, ::-1]
+    if orientation >= 5:
+        expected = expected.swapaxes(0, 1)
+    assert (source.sizeX, source.sizeY) == (expected.shape[1], expected.shape[0])
+    decoded = []
+    getUncompressedTile = directory._getUncompressedTile
+
+    def countDecodes(tileNum, asarray=False):
+        decoded.append(tileNum)
+        return getUncompressedTile(tileNum, asarray)
+
+    monkeypatch.setattr(directory, '_getUncompressedTile', countDecodes)
+    region = numpy.zeros(expected.shape, dtype=numpy.uint8)
+    for tile in source.tileIterator(format=constants.TILE_FORMAT_NUMPY):
+        region[tile['y']:tile['y'] + tile['height'],
+               tile['x']:tile['x'] + tile['width']] = tile['tile'][:, :, :3]
+    assert (region == expected).all()
+    # Each stored tile is decoded once, even though most are used by several
+    # output tiles when the image is flipped.
+    assert sorted(decoded) == list(range(4 * 6))
+    # Once a band is read, the usual number of decoded tiles is kept
+    assert directory._decodedTiles.maxsize == 2
+    assert len(directory._decodedTiles) <= 2
+
+
+def testOverviewsOfMissingLevels(tmpdir, monkeypatch):
+    from large_image import cache_util
+
+    # Use a smooth image so that resampling once or in steps is similar
+    y, x = numpy.mgrid[:768, :1024]
+    image = numpy.dstack((x // 4, y // 3, (x + y) // 8)).astype(numpy.uint8)
+    imagePath = os.path.join(str(tmpdir), 'sample.tiff')
+    # Only the full resolution level and the lowest resolution level exist.
+    _writeTiledTiff(imagePath, [image, image[::8, ::8]], tileSize=128)
+    monkeypatch.setitem(
+        config.getConfig(), 'cache_overview_path', os.path.join(str(tmpdir), 'overviews'))
+    cache_util.cachesClear()
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    assert source.levels == 4
+    assert source._tiffDirectories[1] is None and source._tiffDirectories[2] is None
+    reads = []
+
+    def countReads(source):
+        directory = source._tiffDirectories[-1]
+        getTile = directory.getTile
+
+        def countingGetTile(x, y, *args, **kwargs):
+            reads.append((x, y))
+            return getTile(x, y, *args, **kwargs)
+
+        monkeypatch.setattr(directory, 'getTile', countingGetTile)
+
+    countReads(source)
+    tile = numpy.asarray(source.getTile(0, 0, 1, pilImageAllowed=True))
+    assert len(reads) == 16
+    expected = PIL.Image.fromarray(image[:512, :512]).convert('RGBA').resize(
+        (128, 128), PIL.Image.LANCZOS)
+    assert numpy.abs(tile.astype(int) - numpy.asarray(expected)).max() < 4
+    # Tiles are made once; other processes use the stored tiles
+    cache_util.cachesClear()
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    countReads(source)
+    del reads[:]
+    assert (numpy.asarray(source.getTile(0, 0, 1, pilImageAllowed=True)) == tile).all()
+    assert not reads
+    # Stored tiles can be read by other users, subject to the umask
+    umask = os.umask(0)
+    os.umask(umask)
+    storePath = os.path.join(source._getOverviewStore().path, '1', '0_0.png')
+    assert os.stat(storePath).st_mode & 0o777 == 0o666 & ~umask
+    # Copies of the file elsewhere share the stored tiles
+    os.makedirs(os.path.join(str(tmpdir), 'copy'))
+    copyPath = os.path.join(str(tmpdir), 'copy', 'sample.tiff')
+    shutil.copy(imagePath, copyPath)
+    cache_util.cachesClear()
+    copySource = large_image_source_tiff.TiffFileTileSource(copyPath)
+    assert copySource._getOverviewStore().path == source._getOverviewStore().path
+    countReads(copySource)
+    assert (numpy.asarray(copySource.getTile(0, 0, 1, pilImageAllowed=True)) == tile).all()
+    assert not reads
+    # Generating all of the overviews reads each full resolution tile once
+    assert source.generateOverviews() == 12 + 4
+    assert len(reads) == 48 - 16
+    assert len(set(reads)) == len(reads)
+    cache_util.cachesClear()
+
+
+def testAssociatedImagesReadOnRequest(tmpdir, monkeypatch):
+    image = numpy.random.RandomState(0).randint(0, 255, (1024, 1024, 3)).astype(numpy.uint8)
+    label = numpy.random.RandomState(1).randint(0, 255, (96, 160, 3)).astype(numpy.uint8)
+    imagePath = os.path.join(str(tmpdir), 'sample.tiff')
+    # The label uses a different tile size, so it isn't part of the pyramid
+    _writeTiledTiff(imagePath, [image, image[::4, ::4], label],
+                    tileSize=[128, 128, 32], description=[b'', b'', b'label image'])
+    reads = []
+    readImage = large_image_source_tiff.TiffFileTileSource._readAssociatedImage
+
+    def countReads(self, imageKey):
+        reads.append(imageKey)
+        return readImage(self, imageKey)
+
+    monkeypatch.setattr(
+        large_image_source_tiff.TiffFileTileSource, '_readAssociatedImage', countReads)
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    assert source.getAssociatedImagesList() == ['label']
+    assert not reads
+    assert not source._associatedImages
+    for _ in range(2):
+        data, mimeType = source.getAssociatedImage('label', encoding='PNG')
+        assert (numpy.asarray(PIL.Image.open(six.BytesIO(data))) == label).all()
+    assert reads == ['label']
+    assert source.getAssociatedImage('nosuchimage') is None
+
+
+def testCompressedAssociatedImagesReadOnRequest(tmpdir, monkeypatch):
+    from libtiff import libtiff_ctypes
+
+    image = numpy.random.RandomState(0).randint(0, 255, (1024, 1024, 3)).astype(numpy.uint8)
+    label = numpy.random.RandomState(1).randint(0, 255, (96, 160, 3)).astype(numpy.uint8)
+    imagePath = os.path.join(str(tmpdir), 'sample.tiff')
+    _writeTiledTiff(imagePath, [image, image[::4, ::4], label], deflate=True,
+                    tileSize=[128, 128, 32], description=[b'', b'', b'label image'])
+    decoded = []
+    readImage = libtiff_ctypes.TIFF.read_image
+
+    def countReads(self, *args, **kwargs):
+        decoded.append(True)
+        return readImage(self, *args, **kwargs)
+
+    monkeypatch.setattr(libtiff_ctypes.TIFF, 'read_image', countReads)
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    assert source.getAssociatedImagesList() == ['label']
+    assert not decoded
+    data, mimeType = source.getAssociatedImage('label', encoding='PNG')
+    assert (numpy.asarray(PIL.Image.open(six.BytesIO(data))) == label).all()
+    assert len(decoded) == 1
+
+    # Optrascan xml stored in a compressed image is still found
+    xml = (b'<?xml version="1.0"?><ScanInfo><ScanDetails><Magnification>20'
+           b'</Magnification><PixelResolution>0.5</PixelResolution></ScanDetails>'
+           b'</ScanInfo>')
+    xmlImage = numpy.frombuffer(xml.ljust(32 * 32 * 3, b'\0'), dtype=numpy.uint8)
+    imagePath = os.path.join(str(tmpdir), 'xml.tiff')
+    _writeTiledTiff(imagePath, [image, image[::4, ::4], xmlImage.reshape(32, 32, 3)],
+                    deflate=True, tileSize=[128, 128, 32], description=[b'', b'', b'label'])
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    assert source.getAssociatedImagesList() == []
+    assert source.getNativeMagnification()['magnification'] == 20
@@ -50,3 +50,42 @@ def test_conversion_missing_file():
 def test_conversion_failure():
     with pytest.raises(Exception):
         tasks.create_tiff(os.path.realpath(__file__))
+
+
+def test_generate_overviews():
+    testDir = os.path.dirname(os.path.realpath(__file__))
+    imagePath = os.path.join(testDir, 'test_files', 'yb10kx5k.png')
+    tmpdir = tempfile.mkdtemp()
+    outputPath = tasks.create_tiff(imagePath, 'temp.tiff', tmpdir)
+    # vips writes every level, so there are no missing levels to generate
+    assert tasks.generate_overviews(outputPath, os.path.join(tmpdir, 'overviews')) == 0
+    shutil.rmtree(tmpdir)
+
+
+def test_generate_overviews_sparse():
+    import large_image
+    import numpy
+
+    from .test_source_tiff import _writeTiledTiff
+
+    tmpdir = tempfile.mkdtemp()
+    imagePath = os.path.join(tmpdir, 'sparse.tiff')
+    image = numpy.random.RandomState(0).randint(0, 255, (768, 1024, 3)).astype(numpy.uint8)
+    # Only the full resolution and lowest resolution levels exist
+    _writeTiledTiff(imagePath, [image, image[::8, ::8]], tileSize=128)
+    overviewPath = os.path.join(tmpdir, 'overviews')
+    # The two missing levels have 12 and 4 tiles
+    assert tasks.generate_overviews(imagePath, overviewPath) == 12 + 4
+    stored = [name for _, _, names in os.walk(overviewPath) for name in names]
+    assert len(stored) == 12 + 4
+    # The configured path is not changed
+    assert large_image.config.getConfig('cache_overview_path') is None
+    # The path must match a configured path
+    large_image.config.setConfig('cache_overview_path', overviewPath)
+    try:
+        assert tasks.generate_overviews(imagePath) == 12 + 4
+        with pytest.raises(Exception):
+            tasks.generate_overviews(imagePath, os.path.join(tmpdir, 'other'))
+    finally:
+        large_image.config.setConfig('cache_overview_path', None)
+    shutil.rmtree(tmpdir)